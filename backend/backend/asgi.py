@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Load the shared embedding model before the first search request
+from documents.embeddings import warm_up  # noqa: E402
+
+warm_up()
@@ -1,8 +1,16 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 app = Celery('backend')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def preload_embedding_model(**kwargs):
+    # Load the model once per worker process instead of on the first task
+    from documents.embeddings import warm_up
+    warm_up()
@@ -176,6 +176,115 @@ CELERY_TIMEZONE = 'UTC'
 
 # AI Configuration
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', 'gemini-2.0-flash')
+
+# Persistent LLM response cache: entry lifetime, total size budget and how
+# many stores between pruning passes
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+LLM_CACHE_PRUNE_EVERY = int(os.getenv('LLM_CACHE_PRUNE_EVERY', 50))
+
+# LLM client: 'gemini' or 'fake' (deterministic offline replies for load
+# tests and CI, after LLM_FAKE_LATENCY_SECONDS)
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'gemini')
+LLM_FAKE_LATENCY_SECONDS = float(os.getenv('LLM_FAKE_LATENCY_SECONDS', 0))
+# Per-attempt timeout, retries of transient failures and their jittered
+# exponential backoff (base doubling per retry, capped at max)
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv('LLM_REQUEST_TIMEOUT_SECONDS', 60))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', 0.5))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', 8))
+# Model calls per minute across all workers (0 disables) and the burst
+# allowed above that rate; the bucket lives in Redis unless the URL is empty
+LLM_RATE_LIMIT_PER_MINUTE = int(os.getenv('LLM_RATE_LIMIT_PER_MINUTE', 0))
+LLM_RATE_LIMIT_BURST = int(os.getenv('LLM_RATE_LIMIT_BURST', 0))
+LLM_RATE_LIMIT_REDIS_URL = os.getenv('LLM_RATE_LIMIT_REDIS_URL', os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+# Embedding model shared by ingestion and search (one instance per process)
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_PRELOAD = os.getenv('EMBEDDING_PRELOAD', 'true').lower() == 'true'
+# 'torch' (fp32 PyTorch) or 'onnx-int8' (quantized ONNX export on onnxruntime).
+# Check with `manage.py check_embedding_parity` and run `manage.py rebuild_search_index` after switching.
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE', 'onnx/model_qint8_avx2.onnx')
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', 0))  # 0 = runtime default
+# Precision of vectors stored in DocumentChunk.embeddings ('float32' or 'float16')
+EMBEDDING_STORAGE_DTYPE = os.getenv('EMBEDDING_STORAGE_DTYPE', 'float32')
+
+# Document chunking and ingestion batch size (chunks persisted/embedded together)
+DOCUMENT_CHUNK_SIZE = int(os.getenv('DOCUMENT_CHUNK_SIZE', 1000))
+DOCUMENT_CHUNK_OVERLAP = int(os.getenv('DOCUMENT_CHUNK_OVERLAP', 200))
+INGESTION_BATCH_SIZE = int(os.getenv('INGESTION_BATCH_SIZE', 64))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+
+# Celery queue for each ingestion stage (extract -> chunk -> embed -> index)
+INGESTION_QUEUES = {
+    'extract': os.getenv('INGESTION_EXTRACT_QUEUE', 'celery'),
+    'chunk': os.getenv('INGESTION_CHUNK_QUEUE', 'celery'),
+    'embed': os.getenv('INGESTION_EMBED_QUEUE', 'celery'),
+    'index': os.getenv('INGESTION_INDEX_QUEUE', 'celery'),
+}
+
+# Parallel PDF text extraction: process count, minimum page count and pages per work unit
+PDF_EXTRACTION_WORKERS = int(os.getenv('PDF_EXTRACTION_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv('PDF_PARALLEL_PAGE_THRESHOLD', 100))
+PDF_EXTRACTION_SPAN = int(os.getenv('PDF_EXTRACTION_SPAN', 25))
+
+# Byte budget for the per-process cache of loaded FAISS indexes
+FAISS_INDEX_CACHE_BYTES = int(os.getenv('FAISS_INDEX_CACHE_BYTES', 256 * 1024 * 1024))
+
+# Index structure: exact Flat search up to ANN_FLAT_MAX_VECTORS vectors per
+# user, then 'ivf' (optionally product-quantized with ANN_PQ_SUBQUANTIZERS
+# bytes per vector) or 'hnsw'; approximate indexes are retrained once the
+# vector count changes by ANN_REBUILD_GROWTH times
+ANN_FLAT_MAX_VECTORS = int(os.getenv('ANN_FLAT_MAX_VECTORS', 50000))
+ANN_LARGE_INDEX_TYPE = os.getenv('ANN_LARGE_INDEX_TYPE', 'ivf')
+ANN_IVF_NPROBE = int(os.getenv('ANN_IVF_NPROBE', 16))
+ANN_PQ_SUBQUANTIZERS = int(os.getenv('ANN_PQ_SUBQUANTIZERS', 0))
+ANN_HNSW_M = int(os.getenv('ANN_HNSW_M', 32))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv('ANN_HNSW_EF_CONSTRUCTION', 80))
+ANN_HNSW_EF_SEARCH = int(os.getenv('ANN_HNSW_EF_SEARCH', 64))
+ANN_REBUILD_GROWTH = float(os.getenv('ANN_REBUILD_GROWTH', 2))
+ANN_RECALL_QUERIES = int(os.getenv('ANN_RECALL_QUERIES', 200))
+
+# Hybrid search: BM25 inverted indexes fused with FAISS results
+LEXICAL_INDEX_CACHE_BYTES = int(os.getenv('LEXICAL_INDEX_CACHE_BYTES', 64 * 1024 * 1024))
+LEXICAL_FAST_PATH_MAX_WORDS = int(os.getenv('LEXICAL_FAST_PATH_MAX_WORDS', 3))
+HYBRID_CANDIDATE_FACTOR = int(os.getenv('HYBRID_CANDIDATE_FACTOR', 4))
+
+# Per-process caches of query embeddings and of search results; results are
+# keyed by the index version of every searched document, so reindexing misses
+QUERY_EMBEDDING_CACHE_BYTES = int(os.getenv('QUERY_EMBEDDING_CACHE_BYTES', 8 * 1024 * 1024))
+SEARCH_RESULT_CACHE_BYTES = int(os.getenv('SEARCH_RESULT_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Async search endpoint: threads running searches, extra requests allowed to
+# wait for one (more are rejected with 503) and seconds before a 504
+SEARCH_EXECUTOR_WORKERS = int(os.getenv('SEARCH_EXECUTOR_WORKERS', min(4, os.cpu_count() or 1)))
+SEARCH_EXECUTOR_QUEUE_DEPTH = int(os.getenv('SEARCH_EXECUTOR_QUEUE_DEPTH', 16))
+SEARCH_TIMEOUT_SECONDS = float(os.getenv('SEARCH_TIMEOUT_SECONDS', 30))
+
+# Quiz prompt context: token budget, candidate chunks considered and the MMR
+# weight given to diversity over centrality (0..1)
+QUIZ_CONTEXT_TOKEN_BUDGET = int(os.getenv('QUIZ_CONTEXT_TOKEN_BUDGET', 2000))
+QUIZ_CONTEXT_MAX_CANDIDATES = int(os.getenv('QUIZ_CONTEXT_MAX_CANDIDATES', 2000))
+QUIZ_CONTEXT_DIVERSITY = float(os.getenv('QUIZ_CONTEXT_DIVERSITY', 0.5))
+
+# SAQ/LAQ grading: concurrent Gemini calls per submission, seconds allowed
+# per call and answers graded per prompt (0 or 1 grades each separately)
+GRADING_CONCURRENCY = int(os.getenv('GRADING_CONCURRENCY', 8))
+GRADING_TIMEOUT_SECONDS = float(os.getenv('GRADING_TIMEOUT_SECONDS', 30))
+GRADING_BATCH_SIZE = int(os.getenv('GRADING_BATCH_SIZE', 0))
+
+# Quiz generation jobs still pending or running after this long are
+# treated as lost, so an identical request starts a new one
+QUIZ_JOB_STALE_SECONDS = int(os.getenv('QUIZ_JOB_STALE_SECONDS', 600))
+
+# Streaming quiz generation (Server-Sent Events): threads generating at once,
+# extra streams allowed to wait for one (more get 503) and seconds of silence
+# before a keep-alive comment
+QUIZ_STREAM_WORKERS = int(os.getenv('QUIZ_STREAM_WORKERS', 8))
+QUIZ_STREAM_QUEUE_DEPTH = int(os.getenv('QUIZ_STREAM_QUEUE_DEPTH', 16))
+QUIZ_STREAM_KEEPALIVE_SECONDS = float(os.getenv('QUIZ_STREAM_KEEPALIVE_SECONDS', 15))
 
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
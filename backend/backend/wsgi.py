@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Load the shared embedding model before the first search request
+from documents.embeddings import warm_up  # noqa: E402
+
+warm_up()
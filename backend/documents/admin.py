@@ -6,7 +6,7 @@ class DocumentAdmin(admin.ModelAdmin):
     list_display = ('title', 'user', 'document_type', 'processed', 'uploaded_at', 'page_count')
     list_filter = ('document_type', 'processed', 'uploaded_at')
     search_fields = ('title', 'user__username')
-    readonly_fields = ('uploaded_at', 'file_size', 'page_count')
+    readonly_fields = ('uploaded_at', 'file_size', 'page_count', 'content_hash', 'source')
 
 @admin.register(DocumentChunk)
 class DocumentChunkAdmin(admin.ModelAdmin):
@@ -0,0 +1,143 @@
+import math
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+ANN_INDEX_TYPES = ('ivf', 'hnsw')
+
+# Faiss recommends at least this many training vectors per IVF list
+IVF_MIN_POINTS_PER_LIST = 39
+IVF_MAX_TRAINING_POINTS_PER_LIST = 256
+
+
+def choose_index_spec(count, dimension):
+    """
+    Index structure for a corpus of count vectors: exact Flat search below
+    ANN_FLAT_MAX_VECTORS, otherwise the configured approximate index (IVF,
+    optionally product-quantized, or HNSW) with parameters scaled to count
+    """
+    if count < settings.ANN_FLAT_MAX_VECTORS:
+        return {'type': 'flat'}
+
+    index_type = settings.ANN_LARGE_INDEX_TYPE
+    if index_type == 'hnsw':
+        return {
+            'type': 'hnsw',
+            'm': settings.ANN_HNSW_M,
+            'ef_construction': settings.ANN_HNSW_EF_CONSTRUCTION,
+            'ef_search': settings.ANN_HNSW_EF_SEARCH,
+        }
+    if index_type != 'ivf':
+        raise ImproperlyConfigured(
+            f"Unknown ANN_LARGE_INDEX_TYPE {index_type!r}; expected one of {', '.join(ANN_INDEX_TYPES)}"
+        )
+
+    nlist = max(1, min(int(4 * math.sqrt(count)), count // IVF_MIN_POINTS_PER_LIST))
+    spec = {'type': 'ivf', 'nlist': nlist, 'nprobe': min(nlist, settings.ANN_IVF_NPROBE)}
+
+    pq_m = settings.ANN_PQ_SUBQUANTIZERS
+    if pq_m:
+        if dimension % pq_m:
+            raise ImproperlyConfigured(
+                f"ANN_PQ_SUBQUANTIZERS={pq_m} must divide the embedding dimension {dimension}"
+            )
+        spec['pq_m'] = pq_m
+    return spec
+
+
+def build_index(spec, vectors):
+    """
+    Build (and train, for IVF) a faiss index of the given spec holding
+    vectors, which must be a float32 array in the order of their ids
+    """
+    import faiss
+
+    dimension = vectors.shape[1]
+    if spec['type'] == 'flat':
+        index = faiss.IndexFlatL2(dimension)
+    elif spec['type'] == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, spec['m'])
+        index.hnsw.efConstruction = spec['ef_construction']
+    else:
+        quantizer = faiss.IndexFlatL2(dimension)
+        if 'pq_m' in spec:
+            index = faiss.IndexIVFPQ(quantizer, dimension, spec['nlist'], spec['pq_m'], 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, spec['nlist'])
+        index.train(_training_sample(vectors, spec['nlist'] * IVF_MAX_TRAINING_POINTS_PER_LIST))
+
+    index.add(vectors)
+    configure_search(index, spec)
+    return index
+
+
+def configure_search(index, spec):
+    """
+    Apply the query-time parameters of spec to a built or loaded index
+    """
+    if spec['type'] == 'hnsw':
+        index.hnsw.efSearch = spec['ef_search']
+    elif spec['type'] == 'ivf':
+        index.nprobe = spec['nprobe']
+
+
+def search_parameters(spec, selector=None, exhaustive=False):
+    """
+    Per-query faiss parameters: the ID selector restricting the search and
+    the spec's nprobe/efSearch, which explicit parameters would otherwise
+    reset. exhaustive probes every IVF list.
+    """
+    import faiss
+
+    if spec['type'] == 'ivf':
+        return faiss.SearchParametersIVF(sel=selector, nprobe=spec['nlist'] if exhaustive else spec['nprobe'])
+    if spec['type'] == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=spec['ef_search'])
+    return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+
+def _training_sample(vectors, size):
+    if len(vectors) <= size:
+        return vectors
+    rng = np.random.default_rng(0)
+    return vectors[np.sort(rng.choice(len(vectors), size, replace=False))]
+
+
+def measure_recall(index, vectors, k=10, queries=None):
+    """
+    recall@k of index against exact Flat search over the same vectors,
+    probing with a sample of the indexed vectors
+    """
+    import faiss
+
+    if not len(vectors):
+        return 1.0
+    k = min(k, len(vectors))
+    probes = _training_sample(vectors, queries or settings.ANN_RECALL_QUERIES)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, expected = exact.search(probes, k)
+    _, actual = index.search(probes, k)
+    return round(float(np.mean([
+        len(set(e) & set(a)) / k for e, a in zip(expected, actual)
+    ])), 4)
+
+
+def needs_rebuild(spec, count, dimension):
+    """
+    Whether an index built as spec should be rebuilt now that it holds count
+    vectors: the chosen structure changed, vectors were dropped without
+    removing them from an index that cannot delete (HNSW), or an approximate
+    index grew or shrank by ANN_REBUILD_GROWTH since it was trained
+    """
+    if spec.get('stale'):
+        return True
+    if choose_index_spec(count, dimension)['type'] != spec['type']:
+        return True
+    if spec['type'] == 'flat':
+        return False
+
+    built = spec.get('built_vectors') or 1
+    growth = settings.ANN_REBUILD_GROWTH
+    return not built / growth <= count <= built * growth
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by an approximate byte budget. Every entry
+    carries a version; a lookup with a different version is a miss, so callers
+    can key by an on-disk file and pass its mtime, or by a query and pass the
+    model that embedded it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, version, value, size):
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (version, value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+                self.invalidations += 1
+
+    def _discard(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            }
@@ -0,0 +1,196 @@
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from langchain_core.embeddings import Embeddings
+from .cache import LRUCache
+
+_provider = None
+_provider_lock = threading.Lock()
+
+# One-byte prefix on stored vectors recording their dtype
+_DTYPE_CODES = {'float16': b'h', 'float32': b'f'}
+_CODE_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+
+
+EMBEDDING_BACKENDS = ('torch', 'onnx-int8')
+
+
+def normalize_query(text):
+    """
+    Cache key form of a query: case-folded with whitespace collapsed, which
+    the default uncased MiniLM model embeds identically
+    """
+    return ' '.join(text.lower().split())
+
+
+def _load_model(model_name, backend, batch_size, threads):
+    """
+    Build the sentence-transformers model for a backend: 'torch' is the
+    default fp32 PyTorch path, 'onnx-int8' runs the model's int8-quantized
+    ONNX export on onnxruntime (needs the optimum[onnxruntime] extra)
+    """
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    model_kwargs = {'device': 'cpu'}
+    if backend == 'torch':
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+    elif backend == 'onnx-int8':
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImproperlyConfigured(
+                "EMBEDDING_BACKEND='onnx-int8' requires onnxruntime; install optimum[onnxruntime]"
+            )
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+        model_kwargs.update({
+            'backend': 'onnx',
+            'model_kwargs': {
+                'file_name': settings.EMBEDDING_ONNX_FILE,
+                'provider': 'CPUExecutionProvider',
+                'session_options': session_options,
+            },
+        })
+    else:
+        raise ImproperlyConfigured(
+            f"Unknown EMBEDDING_BACKEND {backend!r}; expected one of {', '.join(EMBEDDING_BACKENDS)}"
+        )
+
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={'batch_size': batch_size}
+    )
+
+
+class EmbeddingProvider(Embeddings):
+    """
+    Process-wide wrapper around the sentence-transformers model that
+    records how long the model took to load and how often it is called
+    """
+
+    def __init__(self, model_name, backend='torch', batch_size=32, threads=0):
+        self.model_name = model_name
+        self.backend = backend
+        # Vectors from different backends are not interchangeable, so the
+        # backend is part of the tag stored next to each chunk's embedding
+        self.model_tag = model_name if backend == 'torch' else f'{model_name}@{backend}'
+        started = time.perf_counter()
+        self._model = _load_model(model_name, backend, batch_size, threads)
+        self.load_time = time.perf_counter() - started
+
+        self._stats_lock = threading.Lock()
+        self.document_calls = 0
+        self.documents_embedded = 0
+        self.query_calls = 0
+        self.embed_time = 0.0
+        self.query_cache = LRUCache(settings.QUERY_EMBEDDING_CACHE_BYTES)
+
+    def _record(self, started, documents=0, queries=0):
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self.document_calls += 1 if documents else 0
+            self.documents_embedded += documents
+            self.query_calls += queries
+            self.embed_time += elapsed
+
+    def embed_documents(self, texts):
+        started = time.perf_counter()
+        vectors = self._model.embed_documents(list(texts))
+        self._record(started, documents=len(vectors))
+        return vectors
+
+    def embed_query(self, text):
+        # Repeated queries skip the model; the tag keeps vectors from another
+        # model or backend from being served. Only the cache key is
+        # normalized: the model sees the query as typed, like the documents.
+        key = normalize_query(text)
+        vector = self.query_cache.get(key, self.model_tag)
+        if vector is None:
+            started = time.perf_counter()
+            vector = self._model.embed_query(text)
+            self._record(started, queries=1)
+            self.query_cache.put(key, self.model_tag, vector, len(vector) * 8 + len(key))
+        return list(vector)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'loaded': True,
+                'model_name': self.model_name,
+                'backend': self.backend,
+                'load_time_seconds': round(self.load_time, 3),
+                'document_calls': self.document_calls,
+                'documents_embedded': self.documents_embedded,
+                'query_calls': self.query_calls,
+                'embed_time_seconds': round(self.embed_time, 3),
+                'query_cache': self.query_cache.stats(),
+            }
+
+
+def get_embeddings():
+    """
+    Return the shared embedding provider, loading the model on first use
+    """
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = create_provider(settings.EMBEDDING_BACKEND)
+    return _provider
+
+
+def create_provider(backend):
+    """
+    Build a standalone provider for a backend using the configured model,
+    batch size and thread count
+    """
+    return EmbeddingProvider(
+        settings.EMBEDDING_MODEL_NAME,
+        backend=backend,
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+        threads=settings.EMBEDDING_THREADS
+    )
+
+
+def warm_up():
+    """
+    Load the embedding model ahead of the first request when preloading is enabled
+    """
+    if settings.EMBEDDING_PRELOAD:
+        return get_embeddings()
+    return None
+
+
+def get_embedding_stats():
+    """
+    Load time and call counters for this process's embedding provider
+    """
+    if _provider is None:
+        return {
+            'loaded': False,
+            'model_name': settings.EMBEDDING_MODEL_NAME,
+            'backend': settings.EMBEDDING_BACKEND,
+        }
+    return _provider.stats()
+
+
+def encode_embedding(vector):
+    """
+    Pack a vector for DocumentChunk.embeddings using EMBEDDING_STORAGE_DTYPE
+    """
+    dtype = settings.EMBEDDING_STORAGE_DTYPE
+    return _DTYPE_CODES[dtype] + np.asarray(vector, dtype=dtype).tobytes()
+
+
+def decode_embedding(blob):
+    """
+    Unpack a stored vector as float32, whatever precision it was stored in
+    """
+    blob = bytes(blob)
+    return np.frombuffer(blob[1:], dtype=_CODE_DTYPES[blob[:1]]).astype(np.float32)
@@ -0,0 +1,99 @@
+from collections import deque
+from itertools import islice
+from billiard import Pool
+from PyPDF2 import PdfReader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from django.conf import settings
+
+
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=settings.DOCUMENT_CHUNK_SIZE,
+        chunk_overlap=settings.DOCUMENT_CHUNK_OVERLAP,
+        length_function=len
+    )
+
+
+def iter_page_texts(reader):
+    """
+    Yield (page_number, text) for every page with extractable text, one page at a time
+    """
+    for page_num, page in enumerate(reader.pages, start=1):
+        page_text = page.extract_text()
+        if page_text:
+            yield page_num, page_text
+
+
+def _extract_page_range(path, start, stop):
+    """
+    Worker body: extract pages [start, stop) of the PDF at path
+    """
+    reader = PdfReader(path)
+    pages = []
+    for page_index in range(start, stop):
+        page_text = reader.pages[page_index].extract_text()
+        if page_text:
+            pages.append((page_index + 1, page_text))
+    return pages
+
+
+def iter_page_texts_parallel(path, page_count, workers, span):
+    """
+    Yield (page_number, text) in page order while a process pool extracts
+    spans of pages ahead of the consumer. At most two spans per worker are in
+    flight, so memory stays bounded however long the book is.
+    """
+    ranges = iter([(start, min(start + span, page_count)) for start in range(0, page_count, span)])
+    # billiard (Celery's multiprocessing fork) lets prefork worker processes start children
+    pool = Pool(processes=workers)
+    try:
+        pending = deque()
+        for start, stop in islice(ranges, workers * 2):
+            pending.append(pool.apply_async(_extract_page_range, (path, start, stop)))
+
+        while pending:
+            pages = pending.popleft().get()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(pool.apply_async(_extract_page_range, (path, *next_range)))
+            yield from pages
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def open_page_texts(file_field, reader):
+    """
+    Page text iterator for a stored PDF: parallel across a process pool for
+    large books on local storage, otherwise serial from the open reader
+    """
+    page_count = len(reader.pages)
+    workers = settings.PDF_EXTRACTION_WORKERS
+    if workers > 1 and page_count >= settings.PDF_PARALLEL_PAGE_THRESHOLD:
+        try:
+            path = file_field.path
+        except NotImplementedError:
+            path = None
+        if path:
+            span = max(1, min(settings.PDF_EXTRACTION_SPAN, -(-page_count // workers)))
+            return iter_page_texts_parallel(path, page_count, workers, span)
+
+    return iter_page_texts(reader)
+
+
+def iter_chunks(pages, splitter=None):
+    """
+    Split pages into (page_number, chunk_text) pairs as they arrive
+    """
+    splitter = splitter or get_text_splitter()
+    for page_number, page_text in pages:
+        for chunk_text in splitter.split_text(page_text):
+            yield page_number, chunk_text
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
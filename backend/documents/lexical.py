@@ -0,0 +1,178 @@
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+from django.conf import settings
+from .models import DocumentChunk
+from .cache import LRUCache
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+# Typographic apostrophes (common in extracted PDF text) and possessive 's
+APOSTROPHE_RE = re.compile(r"[\u2018\u2019\u02bc\u2032`]")
+POSSESSIVE_RE = re.compile(r"'s\b")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were
+what which who why how with define explain describe
+""".split())
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+# Approximate CPython memory of a parsed index, which is about ten times
+# its JSON file: per [position, tf] posting, per [chunk_id, length] row and
+# per term (key string, dict slot and postings list)
+POSTING_BYTES = 120
+CHUNK_BYTES = 128
+TERM_BYTES = 160
+
+lexical_cache = LRUCache(settings.LEXICAL_INDEX_CACHE_BYTES)
+
+
+def tokenize(text):
+    """
+    Search terms of text: "Kirchhoff's" and "Kirchhoff’s" both give
+    kirchhoff, other apostrophes are dropped ("don't" gives dont)
+    """
+    text = POSSESSIVE_RE.sub('', APOSTROPHE_RE.sub("'", text.lower())).replace("'", '')
+    return [
+        token for token in TOKEN_RE.findall(text)
+        if token not in STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+def is_keyword_query(query):
+    """
+    Short queries made only of search terms, e.g. "snells law" or "kirchhoff"
+    """
+    return 0 < len(query.split()) <= settings.LEXICAL_FAST_PATH_MAX_WORDS
+
+
+def lexical_index_path(document_id):
+    """
+    Inverted index for the chunks owned by document_id; documents sharing
+    those chunks through deduplication use the owner's file
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'lexical_index', f'{document_id}.json')
+
+
+def build_lexical_index(document_id):
+    """
+    Build and store the BM25 postings for a document's own chunks
+    """
+    chunks = []
+    postings = {}
+    total_length = 0
+    rows = DocumentChunk.objects.filter(document_id=document_id).values_list('id', 'content')
+
+    for position, (chunk_id, content) in enumerate(rows.iterator(chunk_size=settings.INGESTION_BATCH_SIZE)):
+        terms = Counter(tokenize(content))
+        length = sum(terms.values())
+        chunks.append([chunk_id, length])
+        total_length += length
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append([position, tf])
+
+    index_path = lexical_index_path(document_id)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(f'{index_path}.tmp', 'w', encoding='utf-8') as index_file:
+        json.dump({'chunks': chunks, 'postings': postings, 'total_length': total_length}, index_file)
+    os.replace(f'{index_path}.tmp', index_path)
+    lexical_cache.invalidate(index_path)
+    return len(chunks)
+
+
+def move_lexical_index(from_document_id, to_document_id):
+    """
+    Follow shared chunks to their new owner
+    """
+    from_path = lexical_index_path(from_document_id)
+    if os.path.exists(from_path):
+        os.replace(from_path, lexical_index_path(to_document_id))
+        lexical_cache.invalidate(from_path)
+
+
+def remove_lexical_index(document_id):
+    index_path = lexical_index_path(document_id)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    lexical_cache.invalidate(index_path)
+
+
+def index_memory_bytes(index):
+    """
+    Estimated in-memory size of a parsed index, charged to the cache budget
+    """
+    postings = index['postings']
+    return (
+        sum(len(term_postings) for term_postings in postings.values()) * POSTING_BYTES
+        + len(index['chunks']) * CHUNK_BYTES
+        + sum(TERM_BYTES + len(term) for term in postings)
+    )
+
+
+def load_lexical_index(document_id):
+    index_path = lexical_index_path(document_id)
+    try:
+        index_stat = os.stat(index_path)
+    except FileNotFoundError:
+        return None
+
+    version = (index_stat.st_mtime_ns, index_stat.st_size)
+    index = lexical_cache.get(index_path, version)
+    if index is None:
+        with open(index_path, encoding='utf-8') as index_file:
+            index = json.load(index_file)
+        lexical_cache.put(index_path, version, index, index_memory_bytes(index))
+    return index
+
+
+def get_lexical_cache_stats():
+    return lexical_cache.stats()
+
+
+def bm25_search(query, documents, k):
+    """
+    Rank the chunks of documents against query with BM25. Corpus statistics
+    (chunk count, average length, document frequency) are taken over the
+    documents being searched. Returns (document_id, chunk_id, score) tuples.
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+
+    indexes = []
+    for document in documents:
+        index = load_lexical_index(document.chunk_document_id)
+        if index is not None and index['chunks']:
+            indexes.append((document.id, index))
+
+    chunk_total = sum(len(index['chunks']) for _, index in indexes)
+    if not chunk_total:
+        return []
+    average_length = sum(index['total_length'] for _, index in indexes) / chunk_total or 1
+
+    idf = {}
+    for term in terms:
+        df = sum(len(index['postings'].get(term, ())) for _, index in indexes)
+        if df:
+            idf[term] = math.log(1 + (chunk_total - df + 0.5) / (df + 0.5))
+
+    scored = []
+    for document_id, index in indexes:
+        scores = Counter()
+        for term, term_idf in idf.items():
+            for position, tf in index['postings'].get(term, ()):
+                length = index['chunks'][position][1]
+                norm = tf + K1 * (1 - B + B * length / average_length)
+                scores[position] += term_idf * tf * (K1 + 1) / norm
+        scored.extend(
+            (score, document_id, index['chunks'][position][0]) for position, score in scores.items()
+        )
+
+    return [
+        (document_id, chunk_id, score)
+        for score, document_id, chunk_id in heapq.nlargest(k, scored)
+    ]
@@ -0,0 +1,74 @@
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from documents.embeddings import create_provider
+from documents.models import DocumentChunk
+
+
+def _top_k(queries, corpus, k):
+    # Squared L2 distance, the metric of the flat FAISS index
+    distances = (
+        (queries ** 2).sum(axis=1)[:, None]
+        - 2 * queries @ corpus.T
+        + (corpus ** 2).sum(axis=1)[None, :]
+    )
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare an embedding backend against a reference backend on a sample of stored "
+        "chunks: vector agreement, retrieval recall@k and throughput"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default=settings.EMBEDDING_BACKEND)
+        parser.add_argument('--reference', default='torch')
+        parser.add_argument('--sample', type=int, default=500, help="Number of chunks to embed")
+        parser.add_argument('--queries', type=int, default=50, help="Number of probe queries")
+        parser.add_argument('-k', type=int, default=5)
+        parser.add_argument(
+            '--min-recall', type=float, default=0.9,
+            help="Fail when mean recall@k against the reference is lower"
+        )
+
+    def handle(self, *args, **options):
+        k = options['k']
+        texts = list(DocumentChunk.objects.order_by('?').values_list('content', flat=True)[:options['sample']])
+        if len(texts) <= k:
+            raise CommandError(f"Need more than {k} stored chunks, found {len(texts)}")
+
+        # Probe queries: the opening of randomly chosen chunks
+        rng = np.random.default_rng(0)
+        query_texts = [texts[i][:120] for i in rng.choice(len(texts), min(options['queries'], len(texts)), replace=False)]
+
+        results = {}
+        for name in (options['reference'], options['backend']):
+            provider = create_provider(name)
+            started = time.perf_counter()
+            corpus = np.asarray(provider.embed_documents(texts), dtype=np.float32)
+            elapsed = time.perf_counter() - started
+            queries = np.asarray([provider.embed_query(text) for text in query_texts], dtype=np.float32)
+            results[name] = (corpus, queries, elapsed, provider.load_time)
+
+        ref_corpus, ref_queries, ref_time, _ = results[options['reference']]
+        corpus, queries, elapsed, load_time = results[options['backend']]
+
+        cosine = (ref_corpus * corpus).sum(axis=1) / (
+            np.linalg.norm(ref_corpus, axis=1) * np.linalg.norm(corpus, axis=1)
+        )
+        expected = _top_k(ref_queries, ref_corpus, k)
+        actual = _top_k(queries, corpus, k)
+        recall = np.mean([len(set(e) & set(a)) / k for e, a in zip(expected, actual)])
+
+        self.stdout.write(f"chunks: {len(texts)}, queries: {len(query_texts)}, k: {k}")
+        self.stdout.write(f"cosine similarity to reference: mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+        self.stdout.write(f"recall@{k} against reference: {recall:.4f}")
+        self.stdout.write(
+            f"{options['reference']}: {len(texts) / ref_time:.1f} chunks/s; "
+            f"{options['backend']}: {len(texts) / elapsed:.1f} chunks/s (model load {load_time:.2f}s)"
+        )
+
+        if recall < options['min_recall']:
+            raise CommandError(f"recall@{k} {recall:.4f} is below --min-recall {options['min_recall']}")
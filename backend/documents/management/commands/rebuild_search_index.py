@@ -0,0 +1,39 @@
+import shutil
+from django.core.management.base import BaseCommand
+from documents.lexical import build_lexical_index
+from documents.models import Document
+from documents.utils import create_faiss_index
+from documents.vector_index import get_user_index_spec, index_lock, user_index_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the consolidated per-user FAISS indexes from the vectors stored on "
+        "document chunks, embedding only chunks without a vector from the current model, "
+        "and the BM25 indexes of the documents that own chunks"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Only rebuild the index of this user id")
+
+    def handle(self, *args, **options):
+        documents = Document.objects.filter(processed=True)
+        if options['user']:
+            documents = documents.filter(user_id=options['user'])
+
+        user_ids = documents.order_by().values_list('user_id', flat=True).distinct()
+        for user_id in user_ids:
+            with index_lock(user_id):
+                shutil.rmtree(user_index_path(user_id), ignore_errors=True)
+
+            document_ids = documents.filter(user_id=user_id).values_list('id', flat=True)
+            for document_id in document_ids:
+                create_faiss_index(document_id)
+
+            for document_id in document_ids.filter(source__isnull=True):
+                build_lexical_index(document_id)
+
+            self.stdout.write(
+                f"Rebuilt index for user {user_id} ({len(document_ids)} documents): "
+                f"{get_user_index_spec(user_id) or 'empty'}"
+            )
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:20
+
+import hashlib
+from django.db import migrations, models
+
+
+def hash_existing_chunks(apps, schema_editor):
+    DocumentChunk = apps.get_model('documents', 'DocumentChunk')
+    chunks = []
+    for chunk in DocumentChunk.objects.only('id', 'content').iterator(chunk_size=500):
+        chunk.content_hash = hashlib.sha256(chunk.content.encode('utf-8')).hexdigest()
+        chunks.append(chunk)
+        if len(chunks) >= 500:
+            DocumentChunk.objects.bulk_update(chunks, ['content_hash'])
+            chunks = []
+    if chunks:
+        DocumentChunk.objects.bulk_update(chunks, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0004_document_content_hash_document_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='processing_stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(hash_existing_chunks, migrations.RunPython.noop),
+    ]
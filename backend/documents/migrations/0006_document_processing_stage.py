@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+def mark_processed_documents_done(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Document.objects.filter(processed=True).update(
+        processing_stage='done', processing_status='done', processing_progress=100
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_chunk_content_hash_processing_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='processing_stage',
+            field=models.CharField(choices=[('queued', 'Queued'), ('extract', 'Extracting text'), ('chunk', 'Chunking'), ('embed', 'Embedding'), ('index', 'Indexing'), ('done', 'Done')], default='queued', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed'), ('done', 'Done')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processing_progress',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processing_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(mark_processed_documents_done, migrations.RunPython.noop),
+    ]
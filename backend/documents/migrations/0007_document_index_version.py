@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_document_processing_stage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
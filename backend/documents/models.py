@@ -7,6 +7,20 @@ class Document(models.Model):
         ('ncert', 'NCERT'),
         ('uploaded', 'Uploaded'),
     )
+    PROCESSING_STAGES = (
+        ('queued', 'Queued'),
+        ('extract', 'Extracting text'),
+        ('chunk', 'Chunking'),
+        ('embed', 'Embedding'),
+        ('index', 'Indexing'),
+        ('done', 'Done'),
+    )
+    PROCESSING_STATUSES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+        ('done', 'Done'),
+    )
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='documents')
     title = models.CharField(max_length=255)
@@ -16,19 +30,43 @@ class Document(models.Model):
     processed = models.BooleanField(default=False)
     file_size = models.BigIntegerField(default=0)
     page_count = models.IntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    processing_stats = models.JSONField(default=dict, blank=True)
+    processing_stage = models.CharField(max_length=10, choices=PROCESSING_STAGES, default='queued')
+    processing_status = models.CharField(max_length=10, choices=PROCESSING_STATUSES, default='pending')
+    processing_progress = models.IntegerField(default=0)  # percent of the current stage
+    processing_error = models.TextField(blank=True, default='')
+    index_version = models.IntegerField(default=0)  # bumped whenever the document is (re)indexed
+    # Processed document with identical content whose chunks this one shares
+    source = models.ForeignKey(
+        'self', on_delete=models.DO_NOTHING, null=True, blank=True, related_name='shared_copies'
+    )
     
     class Meta:
         ordering = ['-uploaded_at']
     
     def __str__(self):
         return f"{self.title} ({self.user.username})"
+    
+    @property
+    def chunk_document_id(self):
+        """
+        Id of the document that owns this document's chunks
+        """
+        return self.source_id or self.id
+    
+    @property
+    def shared_chunks(self):
+        return DocumentChunk.objects.filter(document_id=self.chunk_document_id)
 
 class DocumentChunk(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='chunks')
     content = models.TextField()
+    content_hash = models.CharField(max_length=64, blank=True, default='')
     chunk_index = models.IntegerField()
     page_number = models.IntegerField()
     embeddings = models.BinaryField(null=True, blank=True)
+    embedding_model = models.CharField(max_length=255, blank=True, default='')
     
     class Meta:
         unique_together = ['document', 'chunk_index']
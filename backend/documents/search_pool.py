@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class SearchPoolFull(Exception):
+    """
+    Every worker is busy and the wait queue is full
+    """
+
+
+class BoundedExecutor:
+    """
+    Thread pool for CPU-bound search work (embedding forward pass, FAISS and
+    BM25 scoring) called from async views. At most workers + queue_depth
+    calls are admitted at once; beyond that submit() fails fast so the
+    caller can shed load instead of queueing without limit. The model and
+    FAISS release the GIL, so the worker threads run in parallel.
+    """
+
+    def __init__(self, workers, queue_depth):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='search')
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _run(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            # Worker threads live outside the request cycle, so close their
+            # database connections the way Django does after a request
+            close_old_connections()
+
+    def _release(self, future):
+        self._slots.release()
+        with self._stats_lock:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.rejected += 1
+            raise SearchPoolFull()
+
+        with self._stats_lock:
+            self.in_flight += 1
+        future = self._executor.submit(self._run, fn, args)
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn, *args, timeout=None):
+        """
+        Await fn(*args) on the pool. Raises SearchPoolFull when saturated and
+        asyncio.TimeoutError after timeout seconds; a call that already
+        started keeps its slot until it finishes, so timeouts still count
+        against the pool's capacity.
+        """
+        future = self.submit(fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+            }
+
+
+def get_search_pool():
+    """
+    Return the process-wide search pool, created on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BoundedExecutor(
+                    settings.SEARCH_EXECUTOR_WORKERS, settings.SEARCH_EXECUTOR_QUEUE_DEPTH
+                )
+    return _pool
+
+
+def get_search_pool_stats():
+    if _pool is None:
+        return {'started': False}
+    return dict(_pool.stats(), started=True)
@@ -7,23 +7,45 @@ class DocumentChunkSerializer(serializers.ModelSerializer):
         fields = ['id', 'content', 'chunk_index', 'page_number']
 
 class DocumentSerializer(serializers.ModelSerializer):
-    chunks = DocumentChunkSerializer(many=True, read_only=True)
+    """
+    Document metadata, processing status and chunk count; the chunks
+    themselves are paged through /documents/<id>/chunks/
+    """
     file_size_mb = serializers.SerializerMethodField()
+    chunk_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Document
         fields = [
             'id', 'title', 'document_type', 'file', 'uploaded_at', 
-            'processed', 'file_size', 'file_size_mb', 'page_count', 'chunks'
+            'processed', 'file_size', 'file_size_mb', 'page_count', 'processing_stage',
+            'processing_status', 'processing_progress', 'processing_error', 'processing_stats', 'chunk_count'
+        ]
+        read_only_fields = [
+            'uploaded_at', 'processed', 'file_size', 'page_count', 'processing_stage',
+            'processing_status', 'processing_progress', 'processing_error', 'processing_stats'
         ]
-        read_only_fields = ['uploaded_at', 'processed', 'file_size', 'page_count']
     
     def get_file_size_mb(self, obj):
         if obj.file_size:
             return round(obj.file_size / (1024 * 1024), 2)
         return 0
     
+    def get_chunk_count(self, obj):
+        # Annotated by DocumentViewSet.get_queryset; counted for fresh instances
+        if hasattr(obj, 'chunk_count'):
+            return obj.chunk_count
+        return obj.shared_chunks.filter(chunk_index__gte=0).count()
+    
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
         document = super().create(validated_data)
-        return document
\ No newline at end of file
+        return document
+
+class DocumentStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Document
+        fields = [
+            'id', 'processed', 'processing_stage', 'processing_status',
+            'processing_progress', 'processing_error', 'processing_stats'
+        ]
@@ -0,0 +1,13 @@
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from .models import Document
+from .utils import release_shared_chunks
+
+
+@receiver(pre_delete, sender=Document)
+def keep_shared_chunks(sender, instance, **kwargs):
+    """
+    Move chunks shared with identical uploads to a surviving copy before the
+    owning document (and, by cascade, its chunks) is deleted
+    """
+    release_shared_chunks(instance)
@@ -1,3 +1,671 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
 
-# Create your tests here.
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+from .ann import build_index
+from .cache import LRUCache
+from .embeddings import EmbeddingProvider, decode_embedding, encode_embedding
+from .extraction import batched
+from .lexical import (
+    bm25_search, build_lexical_index, index_memory_bytes, lexical_cache, lexical_index_path, load_lexical_index,
+    tokenize
+)
+from .models import Document, DocumentChunk
+from .utils import (
+    _sync_chunks, embed_document_chunks, process_pdf, reciprocal_rank_fusion, search_documents
+)
+from .vector_index import (
+    CHUNK_ID, DOCUMENT_ID, LABEL, MANIFEST_FILE, UserIndex, invalidate_user_index, load_user_index,
+    save_user_index, user_index_path
+)
+
+DIMENSION = 16
+SPECS = {
+    'flat': {'type': 'flat'},
+    'ivf': {'type': 'ivf', 'nlist': 4, 'nprobe': 1},
+    'hnsw': {'type': 'hnsw', 'm': 8, 'ef_construction': 40, 'ef_search': 64},
+}
+
+
+def unit_vectors(count, seed):
+    vectors = np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_nearest(vectors, query, k):
+    return np.argsort(((vectors - query) ** 2).sum(axis=1), kind='stable')[:k].tolist()
+
+
+@unittest.skipIf(faiss is None, "faiss is not installed")
+class UserIndexTests(TestCase):
+    """
+    Label bookkeeping of UserIndex for every index structure: hits must map
+    back to the (document_id, chunk_id) the vector was added under, through
+    adds, deletes, document filters and a save/load round trip
+    """
+
+    user_id = 987654
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        invalidate_user_index(self.user_id)
+
+    def tearDown(self):
+        invalidate_user_index(self.user_id)
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def build(self, index_type):
+        """
+        An index over two documents (ids 1 and 2, 100 chunks each) and the
+        vector behind every (document_id, chunk_id)
+        """
+        documents = {1: unit_vectors(100, seed=1), 2: unit_vectors(100, seed=2)}
+        vectors = {
+            (document_id, 1000 * document_id + position): vector
+            for document_id, matrix in documents.items()
+            for position, vector in enumerate(matrix)
+        }
+
+        if index_type == 'flat':
+            user_index = UserIndex.empty(DIMENSION)
+            for document_id, matrix in documents.items():
+                user_index.add(document_id, [1000 * document_id + i for i in range(len(matrix))], matrix)
+        else:
+            keys = list(vectors)
+            user_index = UserIndex(
+                build_index(dict(SPECS[index_type]), np.vstack([vectors[key] for key in keys])),
+                np.array([[label, *key] for label, key in enumerate(keys)], dtype=np.int64),
+                dict(SPECS[index_type])
+            )
+        return user_index, vectors
+
+    def assert_exact_hits(self, user_index, vectors, query, k=5, document_ids=None):
+        keys = [key for key in vectors if document_ids is None or key[0] in document_ids]
+        expected = [keys[i] for i in exact_nearest(np.vstack([vectors[key] for key in keys]), query, k)]
+
+        hits = user_index.search(query, k, document_ids)
+        self.assertEqual([(document_id, chunk_id) for document_id, chunk_id, _ in hits], expected)
+        for document_id, chunk_id, distance in hits:
+            self.assertAlmostEqual(
+                distance, float(((vectors[document_id, chunk_id] - query) ** 2).sum()), places=4
+            )
+
+    def check_structure(self, index_type):
+        user_index, vectors = self.build(index_type)
+        # IVF probes a single list by default; compare exhaustive results
+        if index_type == 'ivf':
+            user_index.spec['nprobe'] = user_index.spec['nlist']
+
+        query = vectors[2, 2007]
+        self.assertEqual(user_index.search(query, 1)[0][:2], (2, 2007))
+        self.assert_exact_hits(user_index, vectors, query)
+        self.assert_exact_hits(user_index, vectors, query, document_ids={1})
+        self.assertEqual(user_index.search(query, 5, {3}), [])
+
+        # New vectors get fresh labels that map back to them
+        added = unit_vectors(10, seed=3)
+        user_index.add(3, [3000 + i for i in range(10)], added)
+        vectors.update({(3, 3000 + i): vector for i, vector in enumerate(added)})
+        self.assertEqual(user_index.search(added[4], 1)[0][:2], (3, 3004))
+        self.assert_exact_hits(user_index, vectors, added[4], document_ids={1, 3})
+
+        # Deleted vectors are never returned, with or without a filter
+        deleted = {1000 + i for i in range(0, 100, 2)}
+        self.assertEqual(user_index.delete(1, deleted), len(deleted))
+        for chunk_id in deleted:
+            del vectors[1, chunk_id]
+        self.assertEqual(user_index.delete(1, deleted), 0)
+        self.assertEqual(len(user_index), len(vectors))
+        self.assertEqual(user_index.chunk_ids(1), {1000 + i for i in range(1, 100, 2)})
+        for query in (vectors[1, 1001], unit_vectors(1, seed=4)[0]):
+            self.assert_exact_hits(user_index, vectors, query, k=10)
+            self.assert_exact_hits(user_index, vectors, query, k=10, document_ids={1})
+        return user_index, vectors
+
+    def check_round_trip(self, user_index):
+        save_user_index(self.user_id, user_index)
+        query = unit_vectors(1, seed=5)[0]
+        expected = user_index.search(query, 10)
+
+        for cached in (True, False):
+            loaded = load_user_index(self.user_id, cached=cached)
+            np.testing.assert_array_equal(np.asarray(loaded.entries), user_index.entries)
+            self.assertEqual(loaded.spec, user_index.spec)
+            self.assertEqual(
+                [hit[:2] for hit in loaded.search(query, 10)], [hit[:2] for hit in expected]
+            )
+            self.assertEqual(
+                [hit[:2] for hit in loaded.search(query, 10, {1})],
+                [hit[:2] for hit in user_index.search(query, 10, {1})]
+            )
+        # Readers share the cached, memory-mapped instance
+        self.assertIs(load_user_index(self.user_id), load_user_index(self.user_id))
+
+        # A writer patches a private copy and saves a new generation
+        writable = load_user_index(self.user_id, cached=False)
+        writable.delete(2)
+        save_user_index(self.user_id, writable)
+        index_path = user_index_path(self.user_id)
+        self.assertEqual(
+            sorted(os.listdir(index_path)), sorted([MANIFEST_FILE, 'entries.2.npy', 'index.2.faiss'])
+        )
+        reloaded = load_user_index(self.user_id)
+        self.assertEqual(set(np.asarray(reloaded.entries)[:, DOCUMENT_ID].tolist()), {1, 3})
+        self.assertTrue(all(document_id != 2 for document_id, _, _ in reloaded.search(query, 10)))
+
+    def test_flat(self):
+        user_index, _ = self.check_structure('flat')
+        # Flat indexes relabel by position after deletes
+        np.testing.assert_array_equal(user_index.entries[:, LABEL], np.arange(len(user_index)))
+        self.check_round_trip(user_index)
+
+    def test_ivf(self):
+        user_index, _ = self.check_structure('ivf')
+        # IVF labels stay stable: still sorted, with gaps where vectors were deleted
+        labels = user_index.entries[:, LABEL]
+        self.assertTrue((np.diff(labels) > 0).all())
+        self.assertGreater(labels[-1], len(user_index) - 1)
+        self.check_round_trip(user_index)
+
+    def test_ivf_filter_outside_probed_lists(self):
+        user_index, vectors = self.build('ivf')
+        # With one probed list, a filtered query must still fill k hits
+        hits = user_index.search(vectors[1, 1000], 20, {2})
+        self.assertEqual(len(hits), 20)
+        self.assertTrue(all(document_id == 2 for document_id, _, _ in hits))
+
+    def test_hnsw(self):
+        user_index, _ = self.check_structure('hnsw')
+        # Deleted vectors stay in the graph until the next rebuild
+        self.assertTrue(user_index.spec.get('stale'))
+        self.assertGreater(user_index.index.ntotal, len(user_index))
+        self.check_round_trip(user_index)
+
+    def test_empty_filter_and_small_k(self):
+        user_index, vectors = self.build('flat')
+        self.assertEqual(user_index.search(vectors[1, 1000], 5, set()), [])
+        self.assertEqual(len(user_index.search(vectors[1, 1000], 500, {1})), 100)
+
+
+@unittest.skipIf(faiss is None, "faiss is not installed")
+class RestructureTests(TestCase):
+    """
+    Rebuilding from stored chunk embeddings when the vector count calls for
+    another structure
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        user = get_user_model().objects.create_user(username='indexer', password='unused')
+        self.document = Document.objects.create(user=user, title='Mechanics', file='documents/mechanics.pdf')
+        self.vectors = unit_vectors(300, seed=6)
+        chunks = DocumentChunk.objects.bulk_create([
+            DocumentChunk(
+                document=self.document, content=f'chunk {i}', chunk_index=i, page_number=i // 10,
+                embeddings=encode_embedding(vector)
+            )
+            for i, vector in enumerate(self.vectors)
+        ])
+        self.chunk_ids = [chunk.id for chunk in chunks]
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def check_rebuild(self, index_type):
+        user_index = UserIndex.empty(DIMENSION)
+        user_index.add(self.document.id, self.chunk_ids, self.vectors)
+        with override_settings(ANN_FLAT_MAX_VECTORS=100, ANN_LARGE_INDEX_TYPE=index_type, ANN_RECALL_QUERIES=50):
+            self.assertTrue(user_index.restructure())
+            self.assertFalse(user_index.restructure())
+
+        self.assertEqual(user_index.spec['type'], index_type)
+        self.assertEqual(user_index.spec['built_vectors'], 300)
+        self.assertIn('recall_at_10', user_index.spec)
+        np.testing.assert_array_equal(user_index.entries[:, LABEL], np.arange(300))
+        np.testing.assert_array_equal(user_index.entries[:, CHUNK_ID], self.chunk_ids)
+        document_id, chunk_id, _ = user_index.search(self.vectors[42], 1, {self.document.id})[0]
+        self.assertEqual((document_id, chunk_id), (self.document.id, self.chunk_ids[42]))
+
+    def test_flat_to_ivf(self):
+        self.check_rebuild('ivf')
+
+    def test_flat_to_hnsw(self):
+        self.check_rebuild('hnsw')
+
+    def test_hnsw_delete_rebuilds(self):
+        user_index = UserIndex(
+            build_index(dict(SPECS['hnsw']), self.vectors),
+            np.array([[i, self.document.id, chunk_id] for i, chunk_id in enumerate(self.chunk_ids)]),
+            dict(SPECS['hnsw'], built_vectors=300)
+        )
+        user_index.delete(self.document.id, self.chunk_ids[:150])
+        with override_settings(ANN_FLAT_MAX_VECTORS=100, ANN_LARGE_INDEX_TYPE='hnsw', ANN_RECALL_QUERIES=50):
+            self.assertTrue(user_index.restructure())
+        self.assertFalse(user_index.spec.get('stale'))
+        self.assertEqual(user_index.index.ntotal, 150)
+        np.testing.assert_array_equal(user_index.entries[:, CHUNK_ID], self.chunk_ids[150:])
+        self.assertEqual(user_index.search(self.vectors[200], 1)[0][1], self.chunk_ids[200])
+
+
+class ProcessPdfDedupTests(TestCase):
+    """
+    process_pdf shares the chunks of an identical processed upload, but never
+    relinks a document that owns chunks of its own
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='reader', password='unused')
+        # An earlier processed upload of the same file
+        self.original = self.upload('Mechanics', processed=True, chunks=2)
+        patchers = [
+            mock.patch('documents.utils.create_faiss_index', return_value=2),
+            mock.patch('documents.utils.ingestion_chain'),
+        ]
+        self.create_faiss_index, self.ingestion_chain = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def upload(self, title, processed=False, chunks=0, source=None):
+        document = Document.objects.create(
+            user=self.user, title=title, file=f'documents/{title}.pdf', content_hash='same-content',
+            processed=processed, source=source
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=document, content=f'{title} chunk {i}', chunk_index=i, page_number=1)
+            for i in range(chunks)
+        ])
+        return document
+
+    def test_new_upload_links_to_processed_copy(self):
+        document = self.upload('Mechanics copy')
+        process_pdf(document.id)
+
+        document.refresh_from_db()
+        self.assertEqual(document.source_id, self.original.id)
+        self.assertTrue(document.processed)
+        self.ingestion_chain.assert_not_called()
+
+    def test_reprocessing_an_owner_with_copies_keeps_its_chunks(self):
+        # Uploaded before the original finished processing, so it owns chunks too
+        owner = self.upload('Mechanics again', chunks=3)
+        copy = self.upload('Mechanics again copy', processed=True, source=owner)
+        chunk_ids = set(owner.chunks.values_list('id', flat=True))
+
+        # What the reprocess action does before queueing process_pdf
+        Document.objects.filter(id=owner.id).update(processed=False)
+        process_pdf(owner.id)
+
+        owner.refresh_from_db()
+        copy.refresh_from_db()
+        self.assertIsNone(owner.source_id)
+        self.assertEqual(set(owner.chunks.values_list('id', flat=True)), chunk_ids)
+        self.assertEqual(copy.source_id, owner.id)
+        self.ingestion_chain.assert_called_once_with(owner.id)
+        self.create_faiss_index.assert_not_called()
+
+    def test_reprocessing_an_owner_without_chunks_keeps_its_copies(self):
+        owner = self.upload('Mechanics failed')
+        copy = self.upload('Mechanics failed copy', processed=True, source=owner)
+        process_pdf(owner.id)
+
+        owner.refresh_from_db()
+        copy.refresh_from_db()
+        self.assertIsNone(owner.source_id)
+        self.assertEqual(copy.source_id, owner.id)
+        self.ingestion_chain.assert_called_once_with(owner.id)
+
+    def test_reprocessing_a_copy_relinks_to_its_source(self):
+        copy = self.upload('Mechanics copy', processed=True, source=self.original)
+        process_pdf(copy.id)
+
+        copy.refresh_from_db()
+        self.assertEqual(copy.source_id, self.original.id)
+        self.ingestion_chain.assert_not_called()
+
+
+class FakeEmbeddings:
+    """
+    Embedding model stand-in recording the texts it was asked to embed
+    """
+
+    model_tag = 'fake-model'
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+
+class SyncChunksTests(TestCase):
+    """
+    Reprocessing diffs chunks by content hash: unchanged text keeps its row
+    and stored vector, new text gets a row for the embed stage, and text
+    that is gone is deleted
+    """
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='reader', password='unused')
+        self.document = Document.objects.create(user=user, title='Optics', file='documents/optics.pdf')
+        self.embeddings = FakeEmbeddings()
+        for target in ('documents.utils.get_embeddings', 'documents.vector_index.get_embeddings'):
+            patcher = mock.patch(target, return_value=self.embeddings)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sync(self, pages, batch_size=2):
+        stats = {'rows': 0, 'seconds': 0.0, 'reused': 0, 'added': 0, 'removed': 0}
+        _sync_chunks(self.document, batched(pages, batch_size), stats)
+        return stats
+
+    def chunks(self):
+        return {
+            chunk.content: chunk
+            for chunk in DocumentChunk.objects.filter(document=self.document).order_by('chunk_index')
+        }
+
+    def test_resync_reuses_unchanged_chunks(self):
+        self.sync([
+            (1, 'Light travels in straight lines.'),
+            (1, 'Mirrors reflect light.'),
+            (2, 'Lenses refract light.'),
+        ])
+        embed_document_chunks(self.document.id)
+        before = self.chunks()
+        self.assertEqual(len(self.embeddings.embedded), 3)
+
+        self.embeddings.embedded.clear()
+        stats = self.sync([
+            (1, 'Light travels in straight lines.'),
+            (2, 'Lenses refract light.'),
+            (2, 'Prisms split white light.'),
+        ])
+        after = self.chunks()
+
+        self.assertEqual((stats['rows'], stats['reused'], stats['added'], stats['removed']), (3, 2, 1, 1))
+        self.assertEqual(list(after), [
+            'Light travels in straight lines.', 'Lenses refract light.', 'Prisms split white light.'
+        ])
+        self.assertEqual([chunk.chunk_index for chunk in after.values()], [0, 1, 2])
+        for content in ('Light travels in straight lines.', 'Lenses refract light.'):
+            with self.subTest(content):
+                self.assertEqual(after[content].id, before[content].id)
+                self.assertEqual(bytes(after[content].embeddings), bytes(before[content].embeddings))
+        # Moved to another position and page without losing its vector
+        self.assertEqual(after['Lenses refract light.'].page_number, 2)
+        self.assertFalse(DocumentChunk.objects.filter(id=before['Mirrors reflect light.'].id).exists())
+        self.assertIsNone(after['Prisms split white light.'].embeddings)
+
+        # Only the new chunk goes to the model
+        embed_document_chunks(self.document.id)
+        self.assertEqual(self.embeddings.embedded, ['Prisms split white light.'])
+        self.assertEqual(
+            decode_embedding(self.chunks()['Prisms split white light.'].embeddings).tolist(),
+            self.embeddings.embed_documents(['Prisms split white light.'])[0]
+        )
+
+    def test_changed_chunk_is_replaced_and_reembedded(self):
+        self.sync([(1, 'Focal length of a lens.'), (1, 'Power of a lens.')])
+        embed_document_chunks(self.document.id)
+        before = self.chunks()
+
+        self.embeddings.embedded.clear()
+        stats = self.sync([(1, 'Focal length of a convex lens.'), (1, 'Power of a lens.')])
+        after = self.chunks()
+
+        self.assertEqual((stats['reused'], stats['added'], stats['removed']), (1, 1, 1))
+        self.assertNotIn(after['Focal length of a convex lens.'].id, {chunk.id for chunk in before.values()})
+        self.assertEqual(after['Power of a lens.'].id, before['Power of a lens.'].id)
+        embed_document_chunks(self.document.id)
+        self.assertEqual(self.embeddings.embedded, ['Focal length of a convex lens.'])
+
+    def test_repeated_text_reuses_one_row_per_occurrence(self):
+        self.sync([(1, 'Exercises'), (2, 'Exercises'), (3, 'Summary')], batch_size=1)
+        first_ids = set(
+            DocumentChunk.objects.filter(document=self.document, content='Exercises').values_list('id', flat=True)
+        )
+
+        stats = self.sync([(1, 'Exercises'), (3, 'Summary'), (4, 'Exercises'), (5, 'Exercises')], batch_size=3)
+        rows = list(DocumentChunk.objects.filter(document=self.document).order_by('chunk_index'))
+
+        self.assertEqual((stats['reused'], stats['added'], stats['removed']), (3, 1, 0))
+        self.assertEqual([row.content for row in rows], ['Exercises', 'Summary', 'Exercises', 'Exercises'])
+        self.assertEqual([row.chunk_index for row in rows], [0, 1, 2, 3])
+        self.assertTrue(first_ids <= {row.id for row in rows})
+
+    def test_removed_chunks_are_deleted(self):
+        self.sync([(1, 'Chapter one.'), (2, 'Chapter two.')])
+        stats = self.sync([])
+        self.assertEqual(stats['removed'], 2)
+        self.assertFalse(DocumentChunk.objects.filter(document=self.document).exists())
+
+
+class SearchScoresTests(TestCase):
+    """
+    score stays the dense cosine similarity in every search mode; BM25 and
+    fusion scores have fields of their own
+    """
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='searcher', password='unused')
+        self.document = Document.objects.create(
+            user=user, title='Waves', file='documents/waves.pdf', processed=True
+        )
+        self.chunks = DocumentChunk.objects.bulk_create([
+            DocumentChunk(document=self.document, content=f'Wave chunk {i}', chunk_index=i, page_number=i)
+            for i in range(3)
+        ])
+        chunk_ids = [chunk.id for chunk in self.chunks]
+        dense = [(self.document.id, chunk_ids[0], 0.91), (self.document.id, chunk_ids[1], 0.74)]
+        lexical = [(self.document.id, chunk_ids[1], 7.25), (self.document.id, chunk_ids[2], 3.5)]
+        patchers = [
+            mock.patch('documents.utils.search_user_index', return_value=dense),
+            mock.patch('documents.utils.bm25_search', return_value=lexical),
+            # Ids repeat across tests, so results must not come from another test's cache
+            mock.patch('documents.utils.search_cache', LRUCache(1024 * 1024)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def search(self, mode):
+        results = search_documents('how do standing waves form', [self.document], k=3, mode=mode)
+        return {result['chunk_id']: result for result in results}
+
+    def test_scores_per_mode(self):
+        first, second, third = [chunk.id for chunk in self.chunks]
+        cases = [
+            ('dense', {first: (0.91, None), second: (0.74, None)}),
+            ('lexical', {second: (None, 7.25), third: (None, 3.5)}),
+            ('hybrid', {first: (0.91, None), second: (0.74, 7.25), third: (None, 3.5)}),
+        ]
+        for mode, expected in cases:
+            with self.subTest(mode):
+                results = self.search(mode)
+                self.assertEqual(
+                    {chunk_id: (result['score'], result['bm25_score']) for chunk_id, result in results.items()},
+                    expected
+                )
+                self.assertEqual(all('rrf_score' in result for result in results.values()), mode == 'hybrid')
+
+    def test_fusion_ranks_by_rrf_score(self):
+        results = list(self.search('hybrid').values())
+        # Found by both retrievers, so it ranks first despite the lower similarity
+        self.assertEqual(results[0]['chunk_id'], self.chunks[1].id)
+        self.assertEqual(results[0]['rrf_score'], round(1 / 62 + 1 / 61, 6))
+        self.assertEqual([result['rrf_score'] for result in results], sorted(
+            (result['rrf_score'] for result in results), reverse=True
+        ))
+
+    def test_fusion_limit_keeps_best(self):
+        rankings = [
+            [{'document_id': 1, 'chunk_id': chunk_id, 'score': 0.5} for chunk_id in (1, 2, 3)],
+            [{'document_id': 1, 'chunk_id': chunk_id, 'bm25_score': 2.0} for chunk_id in (3, 4)],
+        ]
+        self.assertEqual(
+            [result['chunk_id'] for result in reciprocal_rank_fusion(rankings, limit=2)],
+            [3, 1]
+        )
+
+
+class EmbedQueryTests(TestCase):
+    def setUp(self):
+        self.model = mock.Mock()
+        self.model.embed_query.side_effect = lambda text: [float(len(text)), float(text.strip()[0].isupper())]
+        with mock.patch('documents.embeddings._load_model', return_value=self.model):
+            self.provider = EmbeddingProvider('cased-model')
+
+    def test_model_embeds_the_query_as_typed(self):
+        self.assertEqual(self.provider.embed_query(' Newton   Laws'), [14.0, 1.0])
+        self.model.embed_query.assert_called_once_with(' Newton   Laws')
+
+    def test_normalized_query_is_the_cache_key(self):
+        first = self.provider.embed_query('Newton Laws')
+        self.assertEqual(self.provider.embed_query('newton   laws'), first)
+        self.assertEqual(self.model.embed_query.call_count, 1)
+        self.assertEqual(self.provider.stats()['query_cache']['hits'], 1)
+
+
+def deep_size(value):
+    """
+    Memory of a parsed JSON value, counting objects shared by identity once
+    """
+    seen = set()
+    stack = [value]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return total
+
+
+class TokenizeTests(TestCase):
+    def test_tokenize(self):
+        cases = [
+            ("Kirchhoff's law", ['kirchhoff', 'law']),
+            ("Kirchhoff\u2019s law", ['kirchhoff', 'law']),
+            ("KIRCHHOFF\u2018S LAW", ['kirchhoff', 'law']),
+            ("Newton's  laws of motion", ['newton', 'laws', 'motion']),
+            ("the students' answers", ['students', 'answers']),
+            ("don't and won\u2019t", ['dont', 'wont']),
+            ("it's its", []),
+            # Single letters are dropped, single digits kept
+            ("What is the 2nd law? Explain F = m a in 3 steps", ['2nd', 'law', '3', 'steps']),
+            ("Ohm\u02bcs law, 3 V", ['ohm', 'law', '3']),
+            ("", []),
+        ]
+        for text, expected in cases:
+            with self.subTest(text):
+                self.assertEqual(tokenize(text), expected)
+
+    def test_query_and_text_apostrophes_match(self):
+        self.assertEqual(tokenize("Snell\u2019s law"), tokenize("snell's LAW"))
+
+
+class BM25Tests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        user = get_user_model().objects.create_user(username='reader', password='unused')
+        self.documents = []
+        texts = {
+            'Electricity': [
+                "Kirchhoff\u2019s current law: currents into a junction sum to zero.",
+                "Ohm's law relates voltage, current and resistance.",
+                "Resistors in series add their resistance.",
+            ],
+            'Optics': [
+                "Snell's law describes refraction at a boundary.",
+                "Total internal reflection needs a critical angle.",
+                "Kirchhoff also studied spectra and black body radiation in optics labs.",
+            ],
+        }
+        for title, contents in texts.items():
+            document = Document.objects.create(user=user, title=title, file=f'documents/{title}.pdf', processed=True)
+            DocumentChunk.objects.bulk_create([
+                DocumentChunk(document=document, content=content, chunk_index=i, page_number=1)
+                for i, content in enumerate(contents)
+            ])
+            build_lexical_index(document.id)
+            self.documents.append(document)
+
+    def tearDown(self):
+        for document in self.documents:
+            lexical_cache.invalidate(lexical_index_path(document.id))
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def contents(self, hits):
+        chunks = DocumentChunk.objects.in_bulk([chunk_id for _, chunk_id, _ in hits])
+        return [chunks[chunk_id].content for _, chunk_id, _ in hits]
+
+    def test_ranking(self):
+        cases = [
+            ("kirchhoff's law", 2, [
+                "Kirchhoff\u2019s current law: currents into a junction sum to zero.",
+                "Kirchhoff also studied spectra and black body radiation in optics labs.",
+            ]),
+            ("Snell\u2019s law", 1, ["Snell's law describes refraction at a boundary."]),
+            ("resistance", 3, [
+                "Resistors in series add their resistance.",
+                "Ohm's law relates voltage, current and resistance.",
+            ]),
+            ("what is the", 3, []),
+            ("quantum", 3, []),
+        ]
+        for query, k, expected in cases:
+            with self.subTest(query):
+                hits = bm25_search(query, self.documents, k)
+                self.assertEqual(self.contents(hits), expected)
+                scores = [score for _, _, score in hits]
+                self.assertEqual(scores, sorted(scores, reverse=True))
+                self.assertTrue(all(score > 0 for score in scores))
+
+    def test_hits_are_limited_to_searched_documents(self):
+        hits = bm25_search("kirchhoff", self.documents[1:], 5)
+        self.assertEqual([document_id for document_id, _, _ in hits], [self.documents[1].id])
+
+    def test_rare_terms_outweigh_common_ones(self):
+        # "law" occurs in three chunks, "refraction" in one
+        hits = bm25_search("law refraction", self.documents, 1)
+        self.assertEqual(self.contents(hits), ["Snell's law describes refraction at a boundary."])
+
+    def test_cache_charges_estimated_memory(self):
+        index = load_lexical_index(self.documents[0].id)
+        charged = lexical_cache.stats()['current_bytes']
+        self.assertEqual(charged, index_memory_bytes(index))
+        self.assertGreater(charged, os.path.getsize(lexical_index_path(self.documents[0].id)))
+
+    def test_memory_estimate_tracks_parsed_size(self):
+        postings = {f'term{t}': [[position, 1 + position % 3] for position in range(t, 2000, 7)] for t in range(300)}
+        index = {'chunks': [[10000 + i, 40] for i in range(2000)], 'postings': postings, 'total_length': 80000}
+        parsed = json.loads(json.dumps(index))
+        self.assertLess(abs(index_memory_bytes(parsed) / deep_size(parsed) - 1), 0.25)
@@ -1,10 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DocumentViewSet
+from .views import DocumentViewSet, async_search
 
 router = DefaultRouter()
 router.register(r'', DocumentViewSet, basename='document')
 
 urlpatterns = [
+    # Non-blocking search for ASGI deployments (see backend/asgi.py)
+    path('search/async/', async_search, name='document-search-async'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
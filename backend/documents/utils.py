@@ -1,144 +1,463 @@
+import hashlib
+import heapq
+import json
+import logging
 import os
-import tempfile
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
-from celery import shared_task
+from celery import chain, shared_task
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from .cache import LRUCache
+from .embeddings import get_embeddings, normalize_query
+from .extraction import batched, iter_chunks, open_page_texts
+from .lexical import (
+    bm25_search, build_lexical_index, is_keyword_query, move_lexical_index, remove_lexical_index
+)
 from .models import Document, DocumentChunk
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from .vector_index import embed_chunks, replace_document_vectors, remove_document_vectors, search_user_index
+
+logger = logging.getLogger(__name__)
+
+
+INGESTION_STAGES = ['extract', 'chunk', 'embed', 'index']
+
+# Update the stored percentage every this many pages
+PROGRESS_PAGE_INTERVAL = 10
+
+search_cache = LRUCache(settings.SEARCH_RESULT_CACHE_BYTES)
 
 
 @shared_task
 def process_pdf(document_id):
     """
-    Process PDF document: extract text, split into chunks, and create embeddings
+    Entry point for ingestion: share the chunks of an identical processed
+    upload, or schedule the extract -> chunk -> embed -> index stages
+    """
+    document = Document.objects.get(id=document_id)
+    
+    # Identical content was already processed: share its chunks and stored
+    # vectors instead of extracting and embedding again. A document that owns
+    # chunks (or has copies sharing them) is being reprocessed and keeps them.
+    source = document.source
+    if source is None and not document.chunks.exists() and not document.shared_copies.exists():
+        source = find_processed_copy(document.content_hash, exclude_id=document.id)
+    if source is not None:
+        with _run_stage(document_id, 'index'):
+            return _link_to_source(document, source)
+    
+    Document.objects.filter(id=document_id).update(processed=False)
+    _set_stage(document_id, INGESTION_STAGES[0], 'pending')
+    ingestion_chain(document_id).apply_async()
+    return f"Scheduled ingestion of {document.title}"
+
+def ingestion_chain(document_id, start_stage=INGESTION_STAGES[0]):
+    """
+    Celery chain running the ingestion stages from start_stage onwards, each
+    on its configured queue
+    """
+    stages = INGESTION_STAGES[INGESTION_STAGES.index(start_stage):]
+    return chain(*[
+        STAGE_TASKS[stage].si(document_id).set(queue=settings.INGESTION_QUEUES[stage])
+        for stage in stages
+    ])
+
+def resume_ingestion(document):
+    """
+    Re-run ingestion from the stage that failed, keeping earlier stages' output
+    """
+    stage = document.processing_stage if document.processing_stage in INGESTION_STAGES else INGESTION_STAGES[0]
+    _set_stage(document.id, stage, 'pending')
+    return ingestion_chain(document.id, stage).apply_async()
+
+def _set_stage(document_id, stage, status, progress=0, error=''):
+    Document.objects.filter(id=document_id).update(
+        processing_stage=stage,
+        processing_status=status,
+        processing_progress=progress,
+        processing_error=error
+    )
+
+def _set_progress(document_id, done, total):
+    progress = min(100, done * 100 // total) if total else 100
+    Document.objects.filter(id=document_id).update(processing_progress=progress)
+
+@contextmanager
+def _run_stage(document_id, stage):
+    """
+    Record a stage as running, then as failed (with the error) or handed on
+    to the next stage
     """
+    _set_stage(document_id, stage, 'running')
     try:
+        yield
+    except Exception as e:
+        Document.objects.filter(id=document_id).update(
+            processed=False, processing_status='failed', processing_error=str(e)
+        )
+        raise
+    
+    next_stages = INGESTION_STAGES[INGESTION_STAGES.index(stage) + 1:]
+    if next_stages:
+        _set_stage(document_id, next_stages[0], 'pending')
+    else:
+        _set_stage(document_id, 'done', 'done', progress=100)
+
+def _track_pages(document_id, pages, page_count):
+    for page_number, page_text in pages:
+        yield page_number, page_text
+        if page_number % PROGRESS_PAGE_INTERVAL == 0:
+            _set_progress(document_id, page_number, page_count)
+
+def extracted_pages_path(document_id):
+    return os.path.join(settings.MEDIA_ROOT, 'extracted', f'{document_id}.jsonl')
+
+@shared_task
+def extract_document_pages(document_id):
+    """
+    Stage 1: stream page texts from the stored PDF into a JSON-lines file
+    """
+    with _run_stage(document_id, 'extract'):
         document = Document.objects.get(id=document_id)
+        pages_path = extracted_pages_path(document_id)
+        os.makedirs(os.path.dirname(pages_path), exist_ok=True)
         
-        # Extract text from PDF
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            for chunk in document.file.chunks():
-                tmp_file.write(chunk)
-            tmp_file_path = tmp_file.name
+        with document.file.open('rb') as pdf_file:
+            reader = PdfReader(pdf_file)
+            page_count = len(reader.pages)
+            Document.objects.filter(id=document_id).update(page_count=page_count)
+            
+            pages = _track_pages(document_id, open_page_texts(document.file, reader), page_count)
+            with open(f'{pages_path}.tmp', 'w', encoding='utf-8') as pages_file:
+                for page in pages:
+                    pages_file.write(json.dumps(page) + '\n')
         
-        # Read PDF
-        text = ""
-        reader = PdfReader(tmp_file_path)
-        document.page_count = len(reader.pages)
+        os.replace(f'{pages_path}.tmp', pages_path)
+        return page_count
+
+@shared_task
+def chunk_document(document_id):
+    """
+    Stage 2: split the extracted pages and sync them into DocumentChunk rows
+    """
+    with _run_stage(document_id, 'chunk'):
+        document = Document.objects.get(id=document_id)
+        pages_path = extracted_pages_path(document_id)
         
-        for page_num, page in enumerate(reader.pages):
-            page_text = page.extract_text()
-            if page_text:
-                text += f"Page {page_num + 1}:\n{page_text}\n\n"
+        with open(pages_path, encoding='utf-8') as pages_file:
+            pages = _track_pages(
+                document_id, (json.loads(line) for line in pages_file), document.page_count
+            )
+            stats = {'rows': 0, 'seconds': 0.0, 'reused': 0, 'added': 0, 'removed': 0}
+            _sync_chunks(document, batched(iter_chunks(pages), settings.INGESTION_BATCH_SIZE), stats)
         
-        # Clean up temp file
-        os.unlink(tmp_file_path)
+        rows_per_second = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+        logger.info(
+            "Persisted %d chunks for document %s in %.3fs (%.0f rows/s)",
+            stats['rows'], document_id, stats['seconds'], rows_per_second
+        )
         
-        # Split text into chunks
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len
+        document.processing_stats = {
+            'chunks_reused': stats['reused'],
+            'chunks_added': stats['added'],
+            'chunks_removed': stats['removed'],
+        }
+        document.save(update_fields=['processing_stats'])
+        os.remove(pages_path)
+        return stats['rows']
+
+@shared_task
+def embed_document_chunks(document_id):
+    """
+    Stage 3: embed chunks without a vector from the current model, in
+    EMBEDDING_BATCH_SIZE batches. A retry only picks up what is still missing.
+    """
+    with _run_stage(document_id, 'embed'):
+        document = Document.objects.get(id=document_id)
+        model_tag = get_embeddings().model_tag
+        pending_ids = list(
+            document.chunks.filter(Q(embeddings__isnull=True) | ~Q(embedding_model=model_tag))
+            .values_list('id', flat=True)
         )
         
-        chunks = splitter.split_text(text)
+        for done, chunk_ids in enumerate(batched(pending_ids, settings.EMBEDDING_BATCH_SIZE), start=1):
+            chunks = list(DocumentChunk.objects.filter(id__in=chunk_ids))
+            embed_chunks(chunks)
+            DocumentChunk.objects.bulk_update(chunks, ['embeddings', 'embedding_model'])
+            _set_progress(document_id, done * settings.EMBEDDING_BATCH_SIZE, len(pending_ids))
         
-        # Save chunks to database
-        for idx, chunk_text in enumerate(chunks):
-            DocumentChunk.objects.create(
-                document=document,
-                content=chunk_text,
-                chunk_index=idx,
-                page_number=(idx % document.page_count) + 1
-            )
+        document.processing_stats['chunks_embedded'] = len(pending_ids)
+        document.save(update_fields=['processing_stats'])
+        return len(pending_ids)
+
+@shared_task
+def index_document(document_id):
+    """
+    Stage 4: patch the owner's FAISS index from the stored vectors and
+    expose the document to search
+    """
+    with _run_stage(document_id, 'index'):
+        # Lexical index first: create_faiss_index bumps index_version, which
+        # must only happen once both indexes are current
+        build_lexical_index(document_id)
+        chunk_count = create_faiss_index(document_id)
         
-        # Update document status
+        document = Document.objects.get(id=document_id)
         document.processed = True
         document.file_size = document.file.size
-        document.save()
+        document.save(update_fields=['processed', 'file_size'])
+        
+        # Identical uploads share these chunks: bring their index entries up to date
+        for copy_id in document.shared_copies.values_list('id', flat=True):
+            create_faiss_index(copy_id)
         
-        # Create FAISS index
-        create_faiss_index(document_id)
+        return f"Successfully processed {document.title} with {chunk_count} chunks"
+
+STAGE_TASKS = {
+    'extract': extract_document_pages,
+    'chunk': chunk_document,
+    'embed': embed_document_chunks,
+    'index': index_document,
+}
+
+def compute_content_hash(file):
+    """
+    SHA-256 of an uploaded or stored file, read in chunks
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def find_processed_copy(content_hash, exclude_id=None):
+    """
+    Processed document that owns the chunks for this content, if any
+    """
+    if not content_hash:
+        return None
+    return Document.objects.filter(
+        content_hash=content_hash, processed=True, source__isnull=True
+    ).exclude(id=exclude_id).order_by('uploaded_at').first()
+
+def _link_to_source(document, source):
+    document.source = source
+    document.page_count = source.page_count
+    document.file_size = source.file_size
+    document.save(update_fields=['source', 'page_count', 'file_size'])
+    chunk_count = create_faiss_index(document.id)
+    
+    document.processed = True
+    document.save(update_fields=['processed'])
+    return f"Linked {document.title} to processed copy {source.id} with {chunk_count} chunks"
+
+def release_shared_chunks(document):
+    """
+    Hand the chunks owned by document over to one of the documents sharing
+    them, so they survive the document being deleted
+    """
+    copies = list(document.shared_copies.order_by('uploaded_at'))
+    if not copies:
+        return None
+    
+    heir, others = copies[0], copies[1:]
+    with transaction.atomic():
+        DocumentChunk.objects.filter(document=document).update(document=heir)
+        Document.objects.filter(id=heir.id).update(source=None)
+        Document.objects.filter(id__in=[copy.id for copy in others]).update(source=heir)
+    move_lexical_index(document.id, heir.id)
+    return heir
+
+def chunk_content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _sync_chunks(document, batches, stats):
+    """
+    Diff each batch of (page_number, text) pairs against the document's
+    existing chunks by content hash. Unchanged chunks keep their row and
+    stored vector and only get their position updated; new ones are bulk
+    inserted without a vector for the embed stage to fill in, one
+    transaction per batch. Chunks that no longer occur are deleted at the
+    end, so a retried run simply reuses what it wrote before.
+    """
+    # Park existing rows on negative (unique) indexes so new positions never collide
+    with transaction.atomic():
+        document.chunks.filter(chunk_index__gte=0).update(chunk_index=-F('id'))
+    
+    existing = defaultdict(deque)
+    for chunk_id, content_hash in document.chunks.values_list('id', 'content_hash'):
+        existing[content_hash].append(chunk_id)
+    
+    chunk_index = 0
+    for batch in batches:
+        kept, added = [], []
+        for offset, (page_number, chunk_text) in enumerate(batch):
+            content_hash = chunk_content_hash(chunk_text)
+            chunk = DocumentChunk(
+                document=document,
+                content=chunk_text,
+                content_hash=content_hash,
+                chunk_index=chunk_index + offset,
+                page_number=page_number
+            )
+            if existing[content_hash]:
+                chunk.id = existing[content_hash].popleft()
+                kept.append(chunk)
+            else:
+                added.append(chunk)
         
-        return f"Successfully processed {document.title} with {len(chunks)} chunks"
+        started = time.perf_counter()
+        with transaction.atomic():
+            DocumentChunk.objects.bulk_update(kept, ['chunk_index', 'page_number'])
+            DocumentChunk.objects.bulk_create(added)
         
-    except Exception as e:
-        document = Document.objects.get(id=document_id)
-        document.processed = False
-        document.save()
-        raise e
+        stats['rows'] += len(batch)
+        stats['seconds'] += time.perf_counter() - started
+        stats['reused'] += len(kept)
+        stats['added'] += len(added)
+        chunk_index += len(batch)
+    
+    removed, _ = document.chunks.filter(chunk_index__lt=0).delete()
+    stats['removed'] += removed
 
 def create_faiss_index(document_id):
     """
-    Create FAISS vector store for a document
+    Add (or replace) a document's chunks in its owner's consolidated FAISS index
     """
     document = Document.objects.get(id=document_id)
-    chunks = DocumentChunk.objects.filter(document=document)
-    
-    if not chunks:
-        return
+    chunks = document.shared_chunks.iterator(chunk_size=settings.INGESTION_BATCH_SIZE)
     
-    # Create embeddings
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
+    chunk_count = replace_document_vectors(
+        document.user_id, document.id, batched(chunks, settings.INGESTION_BATCH_SIZE)
     )
+    # Cached search results over this document are keyed by the old version
+    Document.objects.filter(id=document_id).update(index_version=F('index_version') + 1)
+    return chunk_count
+
+@shared_task
+def remove_document_from_index(user_id, document_id):
+    """
+    Remove a deleted document's vectors from its owner's index
+    """
+    remove_lexical_index(document_id)
+    return remove_document_vectors(user_id, document_id)
+
+def search_documents(query, documents, k=3, mode='hybrid'):
+    """
+    Search for relevant chunks across documents. 'hybrid' fuses BM25 and
+    FAISS rankings with reciprocal rank fusion, 'dense' and 'lexical' use one
+    retriever. Short keyword queries with lexical matches skip the embedding
+    model entirely. In every mode a result's score is the dense cosine
+    similarity (see _result). Results are cached per process until one of
+    the searched documents is reindexed.
+    """
+    documents = {document.id: document for document in documents if document.processed}
+    if not documents:
+        return []
     
-    chunk_texts = [chunk.content for chunk in chunks]
-    
-    # Create FAISS index
-    vector_store = FAISS.from_texts(chunk_texts, embeddings)
+    user_id = next(iter(documents.values())).user_id
+    cache_key = (user_id, tuple(sorted(documents)), normalize_query(query), k, mode)
+    version = tuple(documents[document_id].index_version for document_id in cache_key[1])
+    results = search_cache.get(cache_key, version)
+    if results is None:
+        results = _search(query, documents, k, mode)
+        size = sum(len(result['content']) + 200 for result in results) + len(query)
+        search_cache.put(cache_key, version, results, size)
+    return results
+
+def get_search_cache_stats():
+    return search_cache.stats()
+
+def _search(query, documents, k, mode):
+    candidates = k * settings.HYBRID_CANDIDATE_FACTOR if mode == 'hybrid' else k
+    lexical_hits = []
+    if mode in ('hybrid', 'lexical'):
+        lexical_hits = _lexical_results(query, documents, candidates)
+        if mode == 'lexical' or (lexical_hits and is_keyword_query(query)):
+            return lexical_hits[:k]
     
-    # Save index to file
-    index_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index', str(document_id))
-    os.makedirs(index_path, exist_ok=True)
-    vector_store.save_local(index_path)
+    dense_hits = _dense_results(query, documents, candidates)
+    if mode == 'dense' or not lexical_hits:
+        return dense_hits[:k]
     
-    return index_path
+    return reciprocal_rank_fusion([dense_hits, lexical_hits], limit=k)
 
-def search_documents(query, documents, k=3):
+def _result(document, chunk_id, page_number, content, score=None, bm25_score=None):
     """
-    Search for relevant chunks in documents
+    One search hit. score is always the cosine similarity from the vector
+    index (None for hits only the lexical retriever found) and bm25_score
+    the BM25 relevance (None for dense-only hits); fused results add the
+    rrf_score they are ranked by.
     """
-    results = []
+    return {
+        'document_id': document.id,
+        'document_title': document.title,
+        'chunk_id': chunk_id,
+        'page_number': page_number,
+        'content': content,
+        'score': score,
+        'bm25_score': bm25_score
+    }
+
+def _dense_results(query, documents, k):
+    user_id = next(iter(documents.values())).user_id
+    try:
+        hits = search_user_index(user_id, query, documents.keys(), k)
+    except Exception:
+        logger.exception("Error searching index for user %s", user_id)
+        return []
     
-    for document in documents:
-        if not document.processed:
-            continue
-            
-        index_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index', str(document.id))
-        if not os.path.exists(index_path):
-            continue
-        
-        # Load FAISS index
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
+    # The index stores ids only; text and page numbers come from the chunks
+    chunks = DocumentChunk.objects.only('content', 'page_number').in_bulk(
+        [chunk_id for _, chunk_id, _ in hits]
+    )
+    return [
+        _result(
+            documents[document_id], chunk_id, chunks[chunk_id].page_number,
+            chunks[chunk_id].content, similarity
         )
-        
-        try:
-            vector_store = FAISS.load_local(
-                index_path, 
-                embeddings, 
-                allow_dangerous_deserialization=True
-            )
-            
-            # Search for similar chunks
-            similar_docs = vector_store.similarity_search(query, k=k)
-            
-            for doc in similar_docs:
-                results.append({
-                    'document_id': document.id,
-                    'document_title': document.title,
-                    'content': doc.page_content,
-                    'score': doc.metadata.get('score', 0) if hasattr(doc, 'metadata') else 0
-                })
-                
-        except Exception as e:
-            print(f"Error searching document {document.id}: {e}")
-            continue
+        for document_id, chunk_id, similarity in hits
+        if chunk_id in chunks
+    ]
+
+def _lexical_results(query, documents, k):
+    hits = bm25_search(query, documents.values(), k)
+    chunks = DocumentChunk.objects.only('content', 'page_number').in_bulk(
+        [chunk_id for _, chunk_id, _ in hits]
+    )
+    return [
+        _result(
+            documents[document_id], chunk_id, chunks[chunk_id].page_number,
+            chunks[chunk_id].content, bm25_score=round(score, 4)
+        )
+        for document_id, chunk_id, score in hits
+        if chunk_id in chunks
+    ]
+
+def reciprocal_rank_fusion(rankings, k=60, limit=None):
+    """
+    Merge ranked result lists: each result gets rrf_score sum(1 / (k + rank))
+    over the lists it appears in, which needs no score calibration between
+    them. The retrievers' own scores are kept, merged across lists. With
+    limit, only the best limit results are kept, selected with a heap.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, start=1):
+            key = (result['document_id'], result['chunk_id'])
+            entry = fused.setdefault(key, dict(result, rrf_score=0))
+            for name in ('score', 'bm25_score'):
+                if result.get(name) is not None:
+                    entry[name] = result[name]
+            entry['rrf_score'] += 1 / (k + rank)
     
-    # Sort by relevance score
-    results.sort(key=lambda x: x['score'], reverse=True)
-    return results[:k]
\ No newline at end of file
+    if limit is None:
+        results = sorted(fused.values(), key=lambda result: result['rrf_score'], reverse=True)
+    else:
+        results = heapq.nlargest(limit, fused.values(), key=lambda result: result['rrf_score'])
+    for result in results:
+        result['rrf_score'] = round(result['rrf_score'], 6)
+    return results
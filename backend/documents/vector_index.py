@@ -0,0 +1,502 @@
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+from filelock import FileLock
+from django.conf import settings
+from .ann import (
+    build_index, choose_index_spec, configure_search, measure_recall, needs_rebuild, search_parameters
+)
+from .cache import LRUCache
+from .embeddings import decode_embedding, encode_embedding, get_embeddings
+from .models import DocumentChunk
+
+logger = logging.getLogger(__name__)
+
+# Current generation, structure and size of a saved index; the index and
+# entry files of each save carry the generation in their names
+MANIFEST_FILE = 'manifest.json'
+FLAT_SPEC = {'type': 'flat'}
+
+# Columns of UserIndex.entries
+LABEL, DOCUMENT_ID, CHUNK_ID = range(3)
+
+
+def user_index_path(user_id):
+    """
+    Directory holding the consolidated FAISS index for all of a user's documents
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'faiss_index', f'user_{user_id}')
+
+
+@contextmanager
+def index_lock(user_id):
+    """
+    Serialize read-modify-write cycles on a user's index across worker processes
+    """
+    index_path = user_index_path(user_id)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with FileLock(f'{index_path}.lock'):
+        yield
+
+
+index_cache = LRUCache(settings.FAISS_INDEX_CACHE_BYTES)
+
+
+class UserIndex:
+    """
+    A user's vectors: a faiss index plus an (n, 3) int64 table of
+    (faiss label, document id, chunk id) rows sorted by label. Chunk text
+    and page numbers are not stored with the index; callers read them from
+    DocumentChunk by id. document id is the document searched, which differs
+    from the chunk's own document when chunks are shared by identical uploads.
+    """
+
+    def __init__(self, index, entries, spec):
+        self.index = index
+        self.entries = entries
+        self.spec = spec
+
+    @classmethod
+    def empty(cls, dimension):
+        import faiss
+
+        return cls(faiss.IndexFlatL2(dimension), np.empty((0, 3), dtype=np.int64), dict(FLAT_SPEC))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def chunk_ids(self, document_id):
+        return set(self.entries[self.entries[:, DOCUMENT_ID] == document_id, CHUNK_ID].tolist())
+
+    def add(self, document_id, chunk_ids, vectors):
+        """
+        Add vectors under new labels. Flat and HNSW indexes label vectors by
+        position; IVF keeps labels stable across deletes, so new labels
+        continue after the highest one in use.
+        """
+        if not len(chunk_ids):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.spec['type'] == 'ivf':
+            first_label = int(self.entries[-1, LABEL]) + 1 if len(self.entries) else 0
+            labels = np.arange(first_label, first_label + len(chunk_ids), dtype=np.int64)
+            self.index.add_with_ids(vectors, labels)
+        else:
+            first_label = self.index.ntotal
+            self.index.add(vectors)
+            labels = np.arange(first_label, first_label + len(chunk_ids), dtype=np.int64)
+
+        rows = np.column_stack([
+            labels,
+            np.full(len(chunk_ids), document_id, dtype=np.int64),
+            np.asarray(chunk_ids, dtype=np.int64),
+        ])
+        self.entries = np.concatenate([self.entries, rows])
+
+    def delete(self, document_id, chunk_ids=None):
+        """
+        Remove a document's vectors, or only those of chunk_ids. Returns the
+        number removed.
+        """
+        mask = self.entries[:, DOCUMENT_ID] == document_id
+        if chunk_ids is not None:
+            mask &= np.isin(self.entries[:, CHUNK_ID], list(chunk_ids))
+        removed = int(mask.sum())
+        if not removed:
+            return 0
+
+        if self.spec['type'] == 'hnsw':
+            # HNSW cannot remove vectors: forget them and rebuild before saving
+            self.spec = dict(self.spec, stale=True)
+        else:
+            self.index.remove_ids(np.ascontiguousarray(self.entries[mask, LABEL]))
+        self.entries = self.entries[~mask]
+        if self.spec['type'] == 'flat':
+            # Flat indexes close the gaps, shifting later vectors down
+            self.entries[:, LABEL] = np.arange(len(self.entries))
+        return removed
+
+    def search(self, query_vector, k, document_ids=None):
+        """
+        Up to k (document_id, chunk_id, squared L2 distance) hits, nearest
+        first, restricted to document_ids with a faiss ID selector so the
+        filter is exact rather than applied to a candidate pool
+        """
+        import faiss
+
+        allowed = None
+        if document_ids is not None:
+            mask = np.isin(self.entries[:, DOCUMENT_ID], list(document_ids))
+            if not mask.any():
+                return []
+            if not mask.all():
+                allowed = np.ascontiguousarray(self.entries[mask, LABEL])
+        if allowed is None and self.spec.get('stale'):
+            # A stale HNSW index still holds deleted vectors: only search live labels
+            allowed = np.ascontiguousarray(self.entries[:, LABEL])
+        candidates = len(self.entries) if allowed is None else len(allowed)
+        k = min(k, candidates)
+        if not k:
+            return []
+
+        selector = faiss.IDSelectorBatch(len(allowed), faiss.swig_ptr(allowed)) if allowed is not None else None
+        query = np.asarray([query_vector], dtype=np.float32)
+        distances, labels = self.index.search(query, k, params=search_parameters(self.spec, selector))
+        if self.spec['type'] == 'ivf' and (labels[0] == -1).any():
+            # The probed lists held too few allowed vectors: probe them all
+            distances, labels = self.index.search(
+                query, k, params=search_parameters(self.spec, selector, exhaustive=True)
+            )
+
+        hits = []
+        for distance, label in zip(distances[0], labels[0]):
+            if label == -1:
+                continue
+            position = np.searchsorted(self.entries[:, LABEL], label)
+            if position == len(self.entries) or self.entries[position, LABEL] != label:
+                continue
+            row = self.entries[position]
+            hits.append((int(row[DOCUMENT_ID]), int(row[CHUNK_ID]), float(distance)))
+        return hits
+
+    def restructure(self, force=False):
+        """
+        Rebuild the faiss index when the vector count calls for a different
+        structure (see ann.choose_index_spec) or an approximate index needs
+        retraining. Vectors come from DocumentChunk.embeddings so lossy (PQ)
+        indexes are rebuilt from exact values. Approximate builds record
+        their recall@10 against exact Flat search in the spec.
+        """
+        dimension = self.index.d
+        if not len(self.entries) or not (force or needs_rebuild(self.spec, len(self.entries), dimension)):
+            return False
+
+        vectors, keep = _stored_vectors(self.entries[:, CHUNK_ID], dimension)
+        entries = self.entries[keep]
+        spec = choose_index_spec(len(entries), dimension)
+        self.index = build_index(spec, vectors)
+        entries[:, LABEL] = np.arange(len(entries))
+        self.entries = entries
+
+        spec['built_vectors'] = len(entries)
+        if spec['type'] != 'flat':
+            spec['recall_at_10'] = measure_recall(self.index, vectors)
+        self.spec = spec
+        logger.info("Built %s index over %d vectors: %s", spec['type'], len(entries), spec)
+        return True
+
+
+def _stored_vectors(chunk_ids, dimension):
+    """
+    Stored embeddings for chunk_ids as a float32 matrix, and a mask of the
+    ids that still have one
+    """
+    blobs = {}
+    unique_ids = list(set(chunk_ids.tolist()))
+    batch_size = settings.INGESTION_BATCH_SIZE * 16
+    for start in range(0, len(unique_ids), batch_size):
+        blobs.update(
+            DocumentChunk.objects.filter(
+                id__in=unique_ids[start:start + batch_size], embeddings__isnull=False
+            ).values_list('id', 'embeddings')
+        )
+
+    keep = np.array([chunk_id in blobs for chunk_id in chunk_ids.tolist()], dtype=bool)
+    if not keep.any():
+        return np.empty((0, dimension), dtype=np.float32), keep
+    vectors = np.vstack([decode_embedding(blobs[chunk_id]) for chunk_id in chunk_ids[keep].tolist()])
+    return vectors, keep
+
+
+def _read_manifest(index_path):
+    try:
+        with open(os.path.join(index_path, MANIFEST_FILE), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def _index_files(index_path, generation):
+    return (
+        os.path.join(index_path, f'index.{generation}.faiss'),
+        os.path.join(index_path, f'entries.{generation}.npy'),
+    )
+
+
+def _has_legacy_index(index_path):
+    return os.path.exists(os.path.join(index_path, 'index.pkl'))
+
+
+def _convert_legacy_index(user_id):
+    """
+    Rewrite an index saved by LangChain's save_local (faiss file plus a
+    pickled docstore) in the current format. Runs under the index lock.
+    """
+    index_path = user_index_path(user_id)
+    if _read_manifest(index_path) is not None or not _has_legacy_index(index_path):
+        return
+
+    from langchain_community.vectorstores import FAISS
+
+    # Our own files, written by earlier versions of this module
+    store = FAISS.load_local(index_path, get_embeddings(), allow_dangerous_deserialization=True)
+    labels = sorted(store.index_to_docstore_id)
+    metadatas = [store.docstore.search(store.index_to_docstore_id[label]).metadata for label in labels]
+    entries = np.array(
+        [[label, metadata['document_id'], metadata['chunk_id']] for label, metadata in zip(labels, metadatas)],
+        dtype=np.int64
+    ).reshape(-1, 3)
+
+    try:
+        with open(os.path.join(index_path, 'index.json'), encoding='utf-8') as spec_file:
+            spec = json.load(spec_file)
+    except FileNotFoundError:
+        spec = dict(FLAT_SPEC)
+
+    save_user_index(user_id, UserIndex(store.index, entries, spec))
+    logger.info("Converted legacy index of user %s (%d vectors)", user_id, len(entries))
+
+
+def _read_faiss_index(path, spec, mmap):
+    import faiss
+
+    flags = 0
+    if mmap:
+        # Map the vectors read-only and share them through the page cache
+        # instead of copying: IVF maps its inverted lists, other structures
+        # their flat codes (faiss >= 1.10). The two flags cannot be combined,
+        # since the IVF mapping needs a plain file reader.
+        if spec['type'] == 'ivf':
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        else:
+            flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(path, flags)
+
+
+def load_user_index(user_id, cached=True):
+    """
+    Load a user's index. Searches share cached, memory-mapped read-only
+    instances; writers pass cached=False (while holding the index lock) to
+    get a private in-memory copy they can patch.
+    """
+    index_path = user_index_path(user_id)
+    manifest = _read_manifest(index_path)
+    if manifest is None:
+        if not _has_legacy_index(index_path):
+            return None
+        if cached:
+            with index_lock(user_id):
+                _convert_legacy_index(user_id)
+        else:
+            _convert_legacy_index(user_id)
+        manifest = _read_manifest(index_path)
+        if manifest is None:
+            return None
+
+    try:
+        version = (manifest['generation'], os.stat(os.path.join(index_path, MANIFEST_FILE)).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    if cached:
+        user_index = index_cache.get(index_path, version)
+        if user_index is not None:
+            return user_index
+
+    index_file, entries_file = _index_files(index_path, manifest['generation'])
+    try:
+        index = _read_faiss_index(index_file, manifest['spec'], mmap=cached)
+        entries = np.load(entries_file, mmap_mode='r' if cached else None)
+    except (FileNotFoundError, RuntimeError):
+        # A writer replaced this generation between reading the manifest and its files
+        if cached:
+            return load_user_index(user_id, cached=False)
+        raise
+    configure_search(index, manifest['spec'])
+    user_index = UserIndex(index, entries, manifest['spec'])
+
+    if cached:
+        index_cache.put(index_path, version, user_index, manifest['bytes'])
+    return user_index
+
+
+def invalidate_user_index(user_id):
+    index_cache.invalidate(user_index_path(user_id))
+
+
+def get_index_cache_stats():
+    return index_cache.stats()
+
+
+def save_user_index(user_id, user_index):
+    """
+    Write a new generation of the user's index and point the manifest at
+    it; readers holding the previous generation keep their mapped files
+    """
+    import faiss
+
+    index_path = user_index_path(user_id)
+    invalidate_user_index(user_id)
+    if not len(user_index):
+        shutil.rmtree(index_path, ignore_errors=True)
+        return None
+
+    os.makedirs(index_path, exist_ok=True)
+    previous = _read_manifest(index_path)
+    generation = previous['generation'] + 1 if previous else 1
+    index_file, entries_file = _index_files(index_path, generation)
+    faiss.write_index(user_index.index, index_file)
+    np.save(entries_file, np.ascontiguousarray(user_index.entries, dtype=np.int64))
+
+    manifest = {
+        'generation': generation,
+        'spec': user_index.spec,
+        'count': len(user_index),
+        'bytes': os.path.getsize(index_file) + os.path.getsize(entries_file),
+    }
+    with open(os.path.join(index_path, f'{MANIFEST_FILE}.tmp'), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(index_path, f'{MANIFEST_FILE}.tmp'), os.path.join(index_path, MANIFEST_FILE))
+
+    current = {MANIFEST_FILE, *map(os.path.basename, (index_file, entries_file))}
+    for name in os.listdir(index_path):
+        if name not in current:
+            os.remove(os.path.join(index_path, name))
+    return index_path
+
+
+def get_user_index_spec(user_id):
+    manifest = _read_manifest(user_index_path(user_id))
+    return manifest['spec'] if manifest else None
+
+
+def embed_chunks(chunks):
+    """
+    Fill in DocumentChunk.embeddings for chunks that have no vector from the
+    current model. Returns the chunks that were (re-)embedded so callers can
+    persist them.
+    """
+    embeddings = get_embeddings()
+    missing = [
+        chunk for chunk in chunks
+        if not chunk.embeddings or chunk.embedding_model != embeddings.model_tag
+    ]
+    if missing:
+        vectors = embeddings.embed_documents([chunk.content for chunk in missing])
+        for chunk, vector in zip(missing, vectors):
+            chunk.embeddings = encode_embedding(vector)
+            chunk.embedding_model = embeddings.model_tag
+    return missing
+
+
+def document_vectors(chunk_batches, skip_ids=()):
+    """
+    Collect vectors batch by batch, reusing vectors stored on the chunks and
+    only running the model for chunks without one. Chunks whose id is in
+    skip_ids are already indexed and left out. Returns the ids and vectors
+    to add and the ids of every chunk seen.
+    """
+    wanted = set()
+    chunk_ids = []
+    vectors = []
+
+    for chunks in chunk_batches:
+        wanted.update(chunk.id for chunk in chunks)
+        chunks = [chunk for chunk in chunks if chunk.id not in skip_ids]
+        if not chunks:
+            continue
+
+        reembedded = embed_chunks(chunks)
+        if reembedded:
+            DocumentChunk.objects.bulk_update(reembedded, ['embeddings', 'embedding_model'])
+
+        chunk_ids.extend(chunk.id for chunk in chunks)
+        vectors.extend(decode_embedding(chunk.embeddings) for chunk in chunks)
+
+    return chunk_ids, vectors, wanted
+
+
+def replace_document_vectors(user_id, document_id, chunk_batches):
+    """
+    Sync a document's vectors in the user's index with the given chunk
+    batches, patching the index in place: vectors that are still wanted are
+    kept, stale ones removed and only new ones added. Embedding happens
+    before taking the lock so other documents of the same user are only
+    blocked for the load/patch/save step.
+    """
+    current_index = load_user_index(user_id)
+    indexed_ids = current_index.chunk_ids(document_id) if current_index is not None else set()
+    chunk_ids, vectors, wanted = document_vectors(chunk_batches, indexed_ids)
+
+    with index_lock(user_id):
+        user_index = load_user_index(user_id, cached=False)
+        present_ids = set()
+
+        if user_index is not None:
+            present_ids = user_index.chunk_ids(document_id)
+            stale_ids = (present_ids - wanted) | (present_ids & set(chunk_ids))
+            if stale_ids:
+                user_index.delete(document_id, stale_ids)
+            present_ids -= stale_ids
+
+        # Vectors assumed indexed may have been dropped by a concurrent writer
+        missing_ids = wanted - present_ids - set(chunk_ids)
+        if missing_ids:
+            missing_chunk_ids, missing_vectors, _ = document_vectors(
+                [list(DocumentChunk.objects.filter(id__in=missing_ids))]
+            )
+            chunk_ids += missing_chunk_ids
+            vectors += missing_vectors
+
+        if chunk_ids:
+            if user_index is None:
+                user_index = UserIndex.empty(len(vectors[0]))
+            user_index.add(document_id, chunk_ids, np.vstack(vectors))
+
+        if user_index is not None:
+            user_index.restructure()
+            save_user_index(user_id, user_index)
+
+    return len(wanted)
+
+
+def remove_document_vectors(user_id, document_id):
+    """
+    Drop every vector belonging to a document from the user's index
+    """
+    with index_lock(user_id):
+        user_index = load_user_index(user_id, cached=False)
+        if user_index is None:
+            return 0
+
+        removed = user_index.delete(document_id)
+        if removed:
+            user_index.restructure()
+            save_user_index(user_id, user_index)
+        return removed
+
+
+def search_user_index(user_id, query, document_ids, k):
+    """
+    Run one ANN query over the user's index restricted to document_ids and
+    return up to k (document_id, chunk_id, similarity) tuples, best first
+    """
+    user_index = load_user_index(user_id)
+    if user_index is None:
+        return []
+
+    query_vector = get_embeddings().embed_query(query)
+    return [
+        (document_id, chunk_id, distance_to_similarity(distance))
+        for document_id, chunk_id, distance in user_index.search(query_vector, k, document_ids)
+    ]
+
+
+def distance_to_similarity(distance):
+    """
+    Cosine similarity from the squared L2 distance the index reports;
+    exact for the unit-length vectors sentence-transformers models produce
+    """
+    return round(1 - float(distance) / 2, 4)
@@ -1,11 +1,135 @@
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.permissions import IsAdminUser
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Document
-from .serializers import DocumentSerializer
-from .utils import process_pdf, search_documents
+from .models import Document, DocumentChunk
+from .serializers import DocumentChunkSerializer, DocumentSerializer, DocumentStatusSerializer
+from .embeddings import get_embedding_stats
+from .lexical import get_lexical_cache_stats
+from .search_pool import SearchPoolFull, get_search_pool, get_search_pool_stats
+from .vector_index import get_index_cache_stats, invalidate_user_index
+from .utils import (
+    compute_content_hash, find_processed_copy, process_pdf, remove_document_from_index,
+    get_search_cache_stats, resume_ingestion, search_documents
+)
+
+SEARCH_MODES = ('hybrid', 'dense', 'lexical')
+
+class ChunkCursorPagination(CursorPagination):
+    """
+    Keyset pagination over a document's chunks: each page continues from
+    the last chunk_index seen, so deep pages cost the same as the first
+    """
+    ordering = 'chunk_index'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+def _search_params(data):
+    """
+    Validated (query, document_id, mode, error) from a search request body
+    """
+    query = data.get('query', '').strip()
+    document_id = data.get('document_id')
+    mode = data.get('mode', 'hybrid')
+    
+    if not query:
+        return query, document_id, mode, "Query parameter is required"
+    if mode not in SEARCH_MODES:
+        return query, document_id, mode, f"mode must be one of: {', '.join(SEARCH_MODES)}"
+    return query, document_id, mode, None
+
+def _run_search(user, query, document_id, mode):
+    """
+    Search the user's processed documents; returns (payload, status code)
+    """
+    if document_id:
+        documents = Document.objects.filter(id=document_id, user=user, processed=True)
+    else:
+        documents = Document.objects.filter(user=user, processed=True)
+    
+    if not documents.exists():
+        return {"error": "No processed documents found"}, status.HTTP_404_NOT_FOUND
+    
+    results = search_documents(query, documents, mode=mode)
+    return {
+        'query': query,
+        'mode': mode,
+        'results': results,
+        'total_results': len(results)
+    }, status.HTTP_200_OK
+
+def authenticate_request(request):
+    """
+    Run the API's authentication classes (including the session CSRF check)
+    on a plain Django request
+    """
+    drf_request = Request(
+        request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    )
+    return drf_request.user
+
+@csrf_exempt
+async def async_search(request):
+    """
+    Search endpoint for ASGI deployments: the embedding forward pass and
+    index scoring run on the bounded search pool, so the event loop keeps
+    serving other requests. Saturation returns 503, a slow search 504.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Method not allowed"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    try:
+        user = await sync_to_async(authenticate_request)(request)
+    except APIException as e:
+        return JsonResponse({"error": str(e.detail)}, status=e.status_code)
+    if not user or not user.is_authenticated:
+        return JsonResponse(
+            {"error": "Authentication credentials were not provided."},
+            status=status.HTTP_403_FORBIDDEN
+        )
+    
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        data = request.POST
+    
+    query, document_id, mode, error = _search_params(data)
+    if error:
+        return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        payload, status_code = await get_search_pool().run(
+            _run_search, user, query, document_id, mode, timeout=settings.SEARCH_TIMEOUT_SECONDS
+        )
+    except SearchPoolFull:
+        response = JsonResponse(
+            {"error": "Search is busy, please retry shortly"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        response['Retry-After'] = '1'
+        return response
+    except asyncio.TimeoutError:
+        return JsonResponse({"error": "Search timed out"}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+    
+    return JsonResponse(payload, status=status_code)
 
 class DocumentViewSet(viewsets.ModelViewSet):
     serializer_class = DocumentSerializer
@@ -14,13 +138,37 @@ class DocumentViewSet(viewsets.ModelViewSet):
     filterset_fields = ['document_type', 'processed']
     
     def get_queryset(self):
-        return Document.objects.filter(user=self.request.user)
+        # Chunks live on the document that owns them (see Document.source);
+        # negative chunk_index rows are parked mid-reprocess
+        chunk_count = DocumentChunk.objects.filter(
+            document_id=Coalesce(OuterRef('source_id'), OuterRef('id')), chunk_index__gte=0
+        ).order_by().values('document_id').annotate(count=Count('id')).values('count')
+        return Document.objects.filter(user=self.request.user).annotate(
+            chunk_count=Coalesce(Subquery(chunk_count, output_field=IntegerField()), 0)
+        )
     
     def perform_create(self, serializer):
-        document = serializer.save(user=self.request.user)
+        upload = serializer.validated_data['file']
+        content_hash = compute_content_hash(upload)
+        
+        extra = {}
+        source = find_processed_copy(content_hash)
+        if source is not None:
+            # Same content already processed: point at its stored file and chunks
+            extra = {'file': source.file.name, 'source': source}
+        
+        document = serializer.save(
+            user=self.request.user, content_hash=content_hash, file_size=upload.size, **extra
+        )
         # Process PDF in background
         process_pdf.delay(document.id)
     
+    def perform_destroy(self, instance):
+        user_id, document_id = instance.user_id, instance.id
+        instance.delete()
+        # Drop the document's vectors from the shared user index in background
+        remove_document_from_index.delay(user_id, document_id)
+    
     def create(self, request, *args, **kwargs):
         # Check if user has reached upload limit (optional)
         user_docs_count = Document.objects.filter(user=request.user).count()
@@ -34,43 +182,90 @@ class DocumentViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['post'])
     def search(self, request):
-        query = request.data.get('query', '').strip()
-        document_id = request.data.get('document_id')
+        query, document_id, mode, error = _search_params(request.data)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
         
-        if not query:
-            return Response(
-                {"error": "Query parameter is required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        payload, status_code = _run_search(request.user, query, document_id, mode)
+        return Response(payload, status=status_code)
+    
+    @action(detail=True, methods=['post'])
+    def reprocess(self, request, pk=None):
+        document = self.get_object()
+        document.processed = False
+        document.save()
         
-        if document_id:
-            documents = Document.objects.filter(id=document_id, user=request.user, processed=True)
-        else:
-            documents = Document.objects.filter(user=request.user, processed=True)
+        invalidate_user_index(document.user_id)
         
-        if not documents.exists():
-            return Response(
-                {"error": "No processed documents found"},
-                status=status.HTTP_404_NOT_FOUND
-            )
+        # Existing chunks are kept: process_pdf diffs them by content hash and
+        # only embeds new or changed ones, recording counts in processing_stats
+        task = process_pdf.delay(document.id)
         
-        results = search_documents(query, documents)
         return Response({
-            'query': query,
-            'results': results,
-            'total_results': len(results)
+            "message": "Document reprocessing started",
+            "task_id": task.id
         })
     
-    @action(detail=True, methods=['post'])
-    def reprocess(self, request, pk=None):
+    @action(detail=True, methods=['get'], pagination_class=ChunkCursorPagination)
+    def chunks(self, request, pk=None):
+        """
+        A document's chunks in chunk_index order, optionally limited to
+        pages page_from..page_to
+        """
         document = self.get_object()
-        document.processed = False
-        document.save()
+        chunks = document.shared_chunks.filter(chunk_index__gte=0)
         
-        # Delete existing chunks
-        document.chunks.all().delete()
+        for param, lookup in (('page_from', 'page_number__gte'), ('page_to', 'page_number__lte')):
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                chunks = chunks.filter(**{lookup: int(value)})
+            except ValueError:
+                return Response(
+                    {"error": f"{param} must be an integer"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
         
-        # Reprocess document
-        process_pdf.delay(document.id)
+        page = self.paginate_queryset(chunks)
+        serializer = DocumentChunkSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+    
+    @action(detail=True, methods=['get'], url_path='status')
+    def processing_status(self, request, pk=None):
+        """
+        Lightweight processing status for polling
+        """
+        document = self.get_object()
+        return Response(DocumentStatusSerializer(document).data)
+    
+    @action(detail=True, methods=['post'])
+    def retry(self, request, pk=None):
+        """
+        Resume a failed ingestion from the stage that failed
+        """
+        document = self.get_object()
+        if document.processing_status != 'failed':
+            return Response(
+                {"error": "Only failed documents can be retried"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        return Response({"message": "Document reprocessing started"})
\ No newline at end of file
+        task = resume_ingestion(document)
+        return Response({
+            "message": f"Document processing resumed at the {document.processing_stage} stage",
+            "task_id": task.id
+        })
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def metrics(self, request):
+        """
+        Per-process embedding and search metrics for this worker
+        """
+        return Response({
+            'embeddings': get_embedding_stats(),
+            'index_cache': get_index_cache_stats(),
+            'lexical_cache': get_lexical_cache_stats(),
+            'search_cache': get_search_cache_stats(),
+            'search_pool': get_search_pool_stats()
+        })
\ No newline at end of file
@@ -26,7 +26,8 @@ def update_user_progress(quiz_attempt):
     
     # Update basic stats
     progress.total_quizzes_taken += 1
-    progress.total_questions_attempted += quiz_attempt.total_questions
+    # Answers that could not be evaluated count neither right nor wrong
+    progress.total_questions_attempted += quiz_attempt.total_questions - quiz_attempt.ungraded_questions
     progress.total_correct_answers += quiz_attempt.score
     
     # Calculate average score
@@ -47,7 +48,7 @@ def update_topic_analysis(progress, quiz_attempt):
     """
     Analyze user performance by topic to identify strengths and weaknesses
     """
-    user_answers = UserAnswer.objects.filter(attempt=quiz_attempt)
+    user_answers = UserAnswer.objects.filter(attempt=quiz_attempt, is_correct__isnull=False)
     
     topic_performance = {}
     
@@ -96,7 +97,7 @@ def update_study_session(user, document, quiz_attempt):
         )
     
     # Update session stats
-    session.questions_attempted += quiz_attempt.total_questions
+    session.questions_attempted += quiz_attempt.total_questions - quiz_attempt.ungraded_questions
     session.correct_answers += quiz_attempt.score
     session.time_spent += quiz_attempt.time_taken
     session.end_time = timezone.now()
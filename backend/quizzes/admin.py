@@ -3,7 +3,7 @@ from django.contrib import admin
 # Register your models here.
 
 from django.contrib import admin
-from .models import Quiz, Question, QuizAttempt, UserAnswer
+from .models import LLMResponse, Quiz, Question, QuizAttempt, QuizGenerationJob, UserAnswer
 
 class QuestionInline(admin.TabularInline):
     model = Question
@@ -40,4 +40,17 @@ class UserAnswerAdmin(admin.ModelAdmin):
     list_display = ('attempt', 'question', 'is_correct', 'time_taken')
     list_filter = ('is_correct',)
     search_fields = ('attempt__user__username', 'question__question_text')
-    readonly_fields = ('time_taken',)
\ No newline at end of file
+    readonly_fields = ('time_taken',)
+
+@admin.register(QuizGenerationJob)
+class QuizGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('document', 'user', 'quiz_type', 'questions_count', 'status', 'created_at')
+    list_filter = ('status', 'quiz_type')
+    search_fields = ('user__username', 'document__title')
+    readonly_fields = ('request_key', 'created_at', 'updated_at')
+
+@admin.register(LLMResponse)
+class LLMResponseAdmin(admin.ModelAdmin):
+    list_display = ('key', 'model_name', 'size', 'hits', 'last_used_at', 'expires_at')
+    list_filter = ('model_name',)
+    readonly_fields = ('created_at',)
\ No newline at end of file
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class QuizzesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'quizzes'
+
+    def ready(self):
+        # Registers the Celery tasks defined in utils with the worker
+        from . import utils  # noqa: F401
@@ -0,0 +1,163 @@
+import numpy as np
+from django.conf import settings
+from documents.embeddings import decode_embedding
+
+# Rough characters-per-token ratio for English prose
+CHARS_PER_TOKEN = 4
+
+# Shortest repeat between neighbouring chunks treated as splitter overlap
+MIN_OVERLAP_CHARS = 20
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _word_boundary(text, position):
+    """
+    Whether position in text falls between words rather than inside one
+    """
+    if position <= 0 or position >= len(text):
+        return True
+    return not (text[position - 1].isalnum() and text[position].isalnum())
+
+
+def strip_overlap(previous, current):
+    """
+    Drop the start of current that repeats the end of previous, as the text
+    splitter repeats up to DOCUMENT_CHUNK_OVERLAP characters between
+    neighbouring chunks of a page. Only whole-word repeats of at least
+    MIN_OVERLAP_CHARS count, so chunks that merely happen to share a
+    letter or digit at the seam are left intact.
+    """
+    for size in range(min(len(previous), len(current), settings.DOCUMENT_CHUNK_OVERLAP), MIN_OVERLAP_CHARS - 1, -1):
+        if (
+            previous.endswith(current[:size])
+            and _word_boundary(previous, len(previous) - size)
+            and _word_boundary(current, size)
+        ):
+            return current[size:].lstrip()
+    return current
+
+
+def _spread(items, count):
+    """
+    count items evenly spaced across items, in order
+    """
+    if len(items) <= count:
+        return list(items)
+    positions = np.linspace(0, len(items) - 1, count).round().astype(int)
+    return [items[position] for position in sorted(set(positions.tolist()))]
+
+
+def _coverage_order(count):
+    """
+    Positions 0..count-1 ordered so that every prefix is spread across the
+    range: the start, then the middle, then the quarters and so on
+    """
+    order = []
+    seen = set()
+    step = max(count, 1)
+    while step:
+        for position in range(0, count, step):
+            if position not in seen:
+                seen.add(position)
+                order.append(position)
+        step //= 2
+    return order
+
+
+def _mmr_order(vectors, diversity):
+    """
+    Maximal marginal relevance order of vectors, lazily: each pick balances
+    similarity to the document centroid (coverage of its main themes)
+    against similarity to what is already picked (redundancy)
+    """
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    centroid = vectors.mean(axis=0)
+    relevance = vectors @ (centroid / max(np.linalg.norm(centroid), 1e-12))
+
+    redundancy = np.zeros(len(vectors))
+    remaining = np.ones(len(vectors), dtype=bool)
+    while remaining.any():
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[~remaining] = -np.inf
+        pick = int(scores.argmax())
+        remaining[pick] = False
+        redundancy = np.maximum(redundancy, vectors @ vectors[pick])
+        yield pick
+
+
+def pack_chunks(rows, order, token_budget):
+    """
+    Positions of rows (chunk_index, page_number, content) taken in order
+    while they fit token_budget, and the text of each in reading order.
+    A chunk whose predecessor on the same page is also taken loses the
+    splitter's overlap, and the budget is charged for the text that is
+    actually kept, so taking a neighbour can make a chunk cheaper.
+    """
+    # The splitter only overlaps neighbouring chunks of the same page
+    follows = [
+        position > 0 and chunk_index == rows[position - 1][0] + 1 and page_number == rows[position - 1][1]
+        for position, (chunk_index, page_number, _) in enumerate(rows)
+    ]
+    full_sizes = [estimate_tokens(content) for _, _, content in rows]
+    stripped = {}
+
+    def stripped_text(position):
+        if position not in stripped:
+            stripped[position] = strip_overlap(rows[position - 1][2], rows[position][2])
+        return stripped[position]
+
+    selected = set()
+    used = 0
+    # No chunk costs less than this, even with overlap stripped on both sides
+    overlap_tokens = settings.DOCUMENT_CHUNK_OVERLAP // CHARS_PER_TOKEN + 1
+    smallest = max(min(full_sizes) - 2 * overlap_tokens, 1)
+    for position in order:
+        if follows[position] and position - 1 in selected:
+            cost = estimate_tokens(stripped_text(position))
+        else:
+            cost = full_sizes[position]
+        following = position + 1
+        if following < len(rows) and follows[following] and following in selected:
+            # The next chunk's overlap with this one is no longer needed
+            cost -= full_sizes[following] - estimate_tokens(stripped_text(following))
+        if used + cost <= token_budget:
+            selected.add(position)
+            used += cost
+        if token_budget - used < smallest:
+            break
+
+    texts = [
+        stripped_text(position) if follows[position] and position - 1 in selected else rows[position][2]
+        for position in sorted(selected)
+    ]
+    return sorted(selected), texts
+
+
+def select_context(document, token_budget=None):
+    """
+    Quiz prompt context from across a document within token_budget tokens.
+    Chunks are picked by MMR over their stored embeddings (or evenly spaced
+    when vectors are missing), then laid out in reading order with the
+    splitter's overlap between neighbouring chunks removed (see pack_chunks).
+    """
+    token_budget = token_budget or settings.QUIZ_CONTEXT_TOKEN_BUDGET
+    chunks = document.shared_chunks.filter(chunk_index__gte=0).order_by('chunk_index')
+    # Bound the MMR work on very long books by thinning candidates evenly first
+    candidate_ids = _spread(list(chunks.values_list('id', flat=True)), settings.QUIZ_CONTEXT_MAX_CANDIDATES)
+    if not candidate_ids:
+        return ''
+    rows = list(
+        chunks.filter(id__in=candidate_ids).values_list('chunk_index', 'page_number', 'content', 'embeddings')
+    )
+
+    vectors = [decode_embedding(blob) for _, _, _, blob in rows if blob]
+    if len(vectors) == len(rows) and len({len(vector) for vector in vectors}) == 1:
+        order = _mmr_order(np.vstack(vectors), settings.QUIZ_CONTEXT_DIVERSITY)
+    else:
+        order = _coverage_order(len(rows))
+
+    _, texts = pack_chunks([row[:3] for row in rows], order, token_budget)
+    return "\n\n".join(text for text in texts if text)
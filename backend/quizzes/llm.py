@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+from .llm_client import get_llm_client
+from .models import LLMResponse
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0, 'evicted': 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def cache_key(model_name, prompt, generation_config=None):
+    payload = json.dumps([model_name, prompt, generation_config or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _cached_response(key):
+    now = timezone.now()
+    response = LLMResponse.objects.filter(key=key, expires_at__gt=now).only('id', 'response_text').first()
+    if response is not None:
+        LLMResponse.objects.filter(id=response.id).update(hits=F('hits') + 1, last_used_at=now)
+    return response
+
+
+def _store_response(key, model_name, text):
+    now = timezone.now()
+    LLMResponse.objects.update_or_create(
+        key=key,
+        defaults={
+            'model_name': model_name,
+            'response_text': text,
+            'size': len(text.encode()),
+            'last_used_at': now,
+            'expires_at': now + timedelta(seconds=settings.LLM_CACHE_TTL_SECONDS),
+        }
+    )
+    _count('stored')
+    with _stats_lock:
+        prune = _stats['stored'] % max(settings.LLM_CACHE_PRUNE_EVERY, 1) == 0
+    if prune:
+        prune_cache()
+
+
+def prune_cache():
+    """
+    Delete expired responses, then the least recently used ones until the
+    cache fits LLM_CACHE_MAX_BYTES
+    """
+    evicted, _ = LLMResponse.objects.filter(expires_at__lte=timezone.now()).delete()
+
+    total = LLMResponse.objects.aggregate(total=Sum('size'))['total'] or 0
+    if total > settings.LLM_CACHE_MAX_BYTES:
+        kept = 0
+        stale_ids = []
+        for response_id, size in LLMResponse.objects.order_by('-last_used_at').values_list('id', 'size'):
+            kept += size
+            if kept > settings.LLM_CACHE_MAX_BYTES:
+                stale_ids.append(response_id)
+        evicted += LLMResponse.objects.filter(id__in=stale_ids).delete()[0]
+
+    _count('evicted', evicted)
+    return evicted
+
+
+def generate(prompt, parse=None, model_name=None, generation_config=None, use_cache=True, deadline=None,
+             cache_if=None):
+    """
+    Run prompt on the model and return parse(response text), or the text
+    itself without parse. Responses are cached by model, prompt and
+    generation parameters; only responses that parse are stored, so a
+    malformed reply is never replayed, and cache_if(result), when given,
+    can veto storing one that parsed (e.g. a truncated reply). use_cache=False
+    skips the lookup (e.g. for fresh questions) but still stores the new
+    response. deadline (a time.monotonic() value) bounds rate limiting,
+    retries and the call.
+    """
+    client = get_llm_client()
+    model_name = model_name or settings.LLM_MODEL_NAME
+    model_tag = client.model_tag(model_name)
+    parse = parse or (lambda text: text)
+    key = cache_key(model_tag, prompt, generation_config)
+
+    if use_cache:
+        cached = _cached_response(key)
+        if cached is not None:
+            _count('hits')
+            return parse(cached.response_text)
+        _count('misses')
+    else:
+        _count('bypassed')
+
+    text = client.complete(prompt, model_name, generation_config, deadline=deadline)
+    result = parse(text)
+    if cache_if is None or cache_if(result):
+        _store_response(key, model_tag, text)
+    return result
+
+
+def generate_stream(prompt, parse=None, model_name=None, generation_config=None, use_cache=True, deadline=None,
+                    cache_if=None):
+    """
+    Like generate(), but yield the response text in chunks as the model
+    produces them; a cached response is yielded whole. The complete text is
+    stored once the stream ends, if parse (when given) accepts it and
+    cache_if approves the result.
+    """
+    client = get_llm_client()
+    model_name = model_name or settings.LLM_MODEL_NAME
+    model_tag = client.model_tag(model_name)
+    key = cache_key(model_tag, prompt, generation_config)
+
+    if use_cache:
+        cached = _cached_response(key)
+        if cached is not None:
+            _count('hits')
+            yield cached.response_text
+            return
+        _count('misses')
+    else:
+        _count('bypassed')
+
+    chunks = []
+    for chunk in client.stream(prompt, model_name, generation_config, deadline=deadline):
+        chunks.append(chunk)
+        yield chunk
+
+    text = ''.join(chunks)
+    if parse is not None:
+        try:
+            result = parse(text)
+        except Exception:
+            return
+        if cache_if is not None and not cache_if(result):
+            return
+    _store_response(key, model_tag, text)
+
+
+def get_cache_stats():
+    """
+    This process's hit counters plus the persistent size and total saved calls
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    totals = LLMResponse.objects.aggregate(bytes=Sum('size'), saved_calls=Sum('hits'))
+    stats.update({
+        'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0,
+        'entries': LLMResponse.objects.count(),
+        'bytes': totals['bytes'] or 0,
+        'max_bytes': settings.LLM_CACHE_MAX_BYTES,
+        'saved_calls': totals['saved_calls'] or 0,
+    })
+    return stats
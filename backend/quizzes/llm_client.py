@@ -0,0 +1,438 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+LLM_PROVIDERS = ('gemini', 'fake')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class LLMError(Exception):
+    """
+    The model call failed and was not (or no longer) worth retrying
+    """
+
+
+class RetryableLLMError(LLMError):
+    """
+    A transient failure: rate limited, overloaded or timed out
+    """
+
+
+class LLMDeadlineExceeded(LLMError):
+    """
+    The caller's deadline passed before the model answered
+    """
+
+
+class GeminiProvider:
+    """
+    Google Gemini through google-generativeai. The library keeps one gRPC
+    channel per process; model objects are built once per model name and
+    reused rather than per call.
+    """
+
+    name = 'gemini'
+
+    def __init__(self, api_key):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self._models = {}
+        self._models_lock = threading.Lock()
+
+    def _model(self, model_name):
+        with self._models_lock:
+            if model_name not in self._models:
+                self._models[model_name] = self._genai.GenerativeModel(model_name)
+            return self._models[model_name]
+
+    @contextmanager
+    def _translate_errors(self):
+        from google.api_core import exceptions as google_exceptions
+
+        try:
+            yield
+        except (
+            google_exceptions.TooManyRequests,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+        ) as e:
+            raise RetryableLLMError(str(e)) from e
+        except google_exceptions.GoogleAPIError as e:
+            raise LLMError(str(e)) from e
+
+    def _generate_content(self, prompt, model_name, generation_config, timeout, stream=False):
+        return self._model(model_name).generate_content(
+            prompt,
+            generation_config=generation_config,
+            stream=stream,
+            request_options={'timeout': timeout} if timeout else None
+        )
+
+    def complete(self, prompt, model_name, generation_config=None, timeout=None):
+        with self._translate_errors():
+            return self._generate_content(prompt, model_name, generation_config, timeout).text
+
+    def stream(self, prompt, model_name, generation_config=None, timeout=None):
+        with self._translate_errors():
+            for chunk in self._generate_content(prompt, model_name, generation_config, timeout, stream=True):
+                # The final chunk may carry only the finish reason
+                if chunk.parts:
+                    yield chunk.text
+
+
+class FakeProvider:
+    """
+    Deterministic offline stand-in for load tests and CI: the same prompt
+    always gets the same well-formed reply, after LLM_FAKE_LATENCY_SECONDS.
+    Quiz prompts get questions of the requested count and type; grading
+    prompts are marked correct when the answer shares at least half of the
+    expected answer's words.
+    """
+
+    name = 'fake'
+
+    QUIZ_PATTERN = re.compile(r'Generate (\d+) (MCQ|SAQ|LAQ) questions')
+    ITEM_PATTERN = re.compile(
+        r"(?:ID: (\d+)\s*)?QUESTION: (.*?)\s*EXPECTED ANSWER: (.*?)\s*STUDENT'S ANSWER: (.*?)\s*(?=ID: |Provide evaluation|$)",
+        re.DOTALL
+    )
+
+    # Characters per streamed chunk
+    CHUNK_SIZE = 64
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def _wait(self, seconds, timeout):
+        if timeout is not None and seconds > timeout:
+            time.sleep(max(timeout, 0))
+            raise RetryableLLMError("Fake provider timed out")
+        time.sleep(seconds)
+
+    def complete(self, prompt, model_name, generation_config=None, timeout=None):
+        if self.latency:
+            self._wait(self.latency, timeout)
+        return self._reply(prompt)
+
+    def stream(self, prompt, model_name, generation_config=None, timeout=None):
+        text = self._reply(prompt)
+        chunks = [text[start:start + self.CHUNK_SIZE] for start in range(0, len(text), self.CHUNK_SIZE)]
+        # The whole reply takes latency seconds, spread evenly over its chunks
+        started = time.monotonic()
+        for number, chunk in enumerate(chunks, 1):
+            if self.latency:
+                elapsed = time.monotonic() - started
+                self._wait(
+                    max(self.latency * number / len(chunks) - elapsed, 0),
+                    timeout - elapsed if timeout else None
+                )
+            yield chunk
+
+    def _reply(self, prompt):
+        rng = random.Random(hashlib.sha256(prompt.encode()).hexdigest())
+        quiz = self.QUIZ_PATTERN.search(prompt)
+        if quiz:
+            reply = {'questions': [
+                self._question(quiz.group(2).lower(), number, rng)
+                for number in range(1, int(quiz.group(1)) + 1)
+            ]}
+        else:
+            evaluations = [
+                dict(self._evaluate(expected, answer), id=int(position) if position else index)
+                for index, (position, _, expected, answer) in enumerate(self.ITEM_PATTERN.findall(prompt))
+            ]
+            if '"results"' in prompt:
+                reply = {'results': evaluations}
+            elif evaluations:
+                reply = evaluations[0]
+                reply.pop('id')
+            else:
+                reply = {'text': f"Fake response {rng.getrandbits(32):08x}"}
+        return json.dumps(reply)
+
+    @staticmethod
+    def _question(quiz_type, number, rng):
+        question = {
+            'question_text': f"Sample {quiz_type.upper()} question {number}?",
+            'explanation': f"Explanation for question {number}.",
+            'topic': f"Topic {rng.randint(1, 5)}",
+        }
+        if quiz_type == 'mcq':
+            question.update({
+                f'option_{option}': f"Option {option.upper()} for question {number}" for option in 'abcd'
+            })
+            question['correct_answer'] = rng.choice('abcd')
+        else:
+            question['expected_answer'] = f"Model answer for question {number}."
+        return question
+
+    @staticmethod
+    def _evaluate(expected, answer):
+        expected_words = set(re.findall(r'\w+', expected.lower()))
+        answer_words = set(re.findall(r'\w+', answer.lower()))
+        overlap = len(expected_words & answer_words) / len(expected_words) if expected_words else 0
+        return {
+            'is_correct': overlap >= 0.5,
+            'feedback': f"Covers {round(overlap * 100)}% of the key terms in the expected answer.",
+            'score': round(overlap * 10),
+        }
+
+
+class LocalTokenBucket:
+    """
+    In-process token bucket, used when no shared limiter is configured or
+    Redis cannot be reached
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, returning how many seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(-self._tokens, 0) / self.rate
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every web and Celery worker through one Redis
+    hash, refilled by the script from Redis' own clock so worker clocks
+    need not agree. Tokens are reserved ahead: a caller that finds the
+    bucket empty still takes a token and is told how long to wait for it,
+    which keeps callers in order instead of racing on every refill.
+    """
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate) - 1
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+    return tostring(math.max(-tokens, 0) / rate)
+    """
+
+    def __init__(self, url, key, rate, capacity):
+        import redis
+
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self._script = redis.Redis.from_url(url, socket_timeout=1).register_script(self.SCRIPT)
+        self._fallback = LocalTokenBucket(rate, capacity)
+
+    def reserve(self):
+        import redis
+
+        try:
+            return float(self._script(keys=[self.key], args=[self.rate, self.capacity]))
+        except redis.RedisError as e:
+            logger.warning("Shared LLM rate limiter unavailable, limiting per process: %s", e)
+            return self._fallback.reserve()
+
+
+class LLMClient:
+    """
+    Single entry point for model calls: rate limited by a token bucket,
+    retried with jittered exponential backoff on transient failures and
+    bounded by the caller's deadline (a time.monotonic() value), which
+    caps each attempt's timeout, the rate limiter wait and every backoff.
+    """
+
+    def __init__(self, provider, limiter=None):
+        self.provider = provider
+        self.limiter = limiter
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0,
+            'deadline_exceeded': 0, 'throttled': 0, 'throttled_seconds': 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def model_tag(self, model_name):
+        """
+        Cache namespace for model_name: other providers must not share
+        cached responses with the real model
+        """
+        if self.provider.name == 'gemini':
+            return model_name
+        return f"{self.provider.name}:{model_name}"
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._count('deadline_exceeded')
+            raise LLMDeadlineExceeded("Deadline passed before the model answered")
+        return remaining
+
+    def _throttle(self, deadline):
+        if self.limiter is None:
+            return
+        wait = self.limiter.reserve()
+        if wait <= 0:
+            return
+        self._count('throttled')
+        self._count('throttled_seconds', wait)
+        remaining = self._remaining(deadline)
+        if remaining is not None and wait >= remaining:
+            self._count('deadline_exceeded')
+            raise LLMDeadlineExceeded("Rate limit wait exceeds the deadline")
+        time.sleep(wait)
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform between zero and the capped exponential step
+        ceiling = min(settings.LLM_BACKOFF_MAX_SECONDS, settings.LLM_BACKOFF_BASE_SECONDS * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def _start_attempt(self, deadline):
+        """
+        Wait for the rate limiter and return this attempt's timeout
+        """
+        self._throttle(deadline)
+        remaining = self._remaining(deadline)
+        self._count('attempts')
+        if remaining is None:
+            return settings.LLM_REQUEST_TIMEOUT_SECONDS
+        return min(settings.LLM_REQUEST_TIMEOUT_SECONDS, remaining)
+
+    def _wait_to_retry(self, error, attempt, deadline):
+        if attempt >= settings.LLM_MAX_RETRIES:
+            self._count('failures')
+            raise LLMError(f"Model unavailable after {attempt + 1} attempts: {error}") from error
+        delay = self._backoff(attempt)
+        remaining = self._remaining(deadline)
+        if remaining is not None and delay >= remaining:
+            self._count('deadline_exceeded')
+            raise LLMDeadlineExceeded(f"No time left to retry: {error}") from error
+        self._count('retries')
+        time.sleep(delay)
+
+    def complete(self, prompt, model_name=None, generation_config=None, deadline=None):
+        """
+        Return the model's reply text for prompt. Raises LLMDeadlineExceeded
+        when deadline passes first, and LLMError once a failure is permanent
+        or LLM_MAX_RETRIES retries are used up.
+        """
+        model_name = model_name or settings.LLM_MODEL_NAME
+        self._count('calls')
+        attempt = 0
+        while True:
+            timeout = self._start_attempt(deadline)
+            try:
+                return self.provider.complete(prompt, model_name, generation_config, timeout=timeout)
+            except RetryableLLMError as e:
+                self._wait_to_retry(e, attempt, deadline)
+                attempt += 1
+            except LLMError:
+                self._count('failures')
+                raise
+
+    def stream(self, prompt, model_name=None, generation_config=None, deadline=None):
+        """
+        Yield the model's reply text in chunks as it is produced. Failures are
+        retried as in complete() until the first chunk arrives; after that
+        they are raised, since the caller has already used part of the reply.
+        """
+        model_name = model_name or settings.LLM_MODEL_NAME
+        self._count('calls')
+        attempt = 0
+        while True:
+            timeout = self._start_attempt(deadline)
+            started = False
+            try:
+                for chunk in self.provider.stream(prompt, model_name, generation_config, timeout=timeout):
+                    started = True
+                    yield chunk
+                return
+            except RetryableLLMError as e:
+                if started:
+                    self._count('failures')
+                    raise LLMError(f"Model stream interrupted: {e}") from e
+                self._wait_to_retry(e, attempt, deadline)
+                attempt += 1
+            except LLMError:
+                self._count('failures')
+                raise
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['throttled_seconds'] = round(stats['throttled_seconds'], 3)
+        stats['provider'] = self.provider.name
+        stats['rate_limit_per_minute'] = settings.LLM_RATE_LIMIT_PER_MINUTE
+        return stats
+
+
+def _build_limiter():
+    per_minute = settings.LLM_RATE_LIMIT_PER_MINUTE
+    if not per_minute:
+        return None
+    rate = per_minute / 60
+    capacity = settings.LLM_RATE_LIMIT_BURST or max(1, per_minute // 60)
+    if settings.LLM_RATE_LIMIT_REDIS_URL:
+        return RedisTokenBucket(
+            settings.LLM_RATE_LIMIT_REDIS_URL, f"llm-rate:{settings.LLM_MODEL_NAME}", rate, capacity
+        )
+    return LocalTokenBucket(rate, capacity)
+
+
+def _build_provider():
+    if settings.LLM_PROVIDER == 'gemini':
+        return GeminiProvider(settings.GOOGLE_API_KEY)
+    if settings.LLM_PROVIDER == 'fake':
+        return FakeProvider(latency=settings.LLM_FAKE_LATENCY_SECONDS)
+    raise ImproperlyConfigured(
+        f"Unknown LLM_PROVIDER {settings.LLM_PROVIDER!r}; expected one of {', '.join(LLM_PROVIDERS)}"
+    )
+
+
+def get_llm_client():
+    """
+    Return the process-wide LLM client, created on first use
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient(_build_provider(), _build_limiter())
+    return _client
+
+
+def get_llm_client_stats():
+    if _client is None:
+        return {'started': False}
+    return dict(_client.stats(), started=True)
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quizzes', '0004_llmresponse_quizgenerationjob_fresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quizattempt',
+            name='ungraded_questions',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='useranswer',
+            name='is_correct',
+            field=models.BooleanField(default=False, null=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from documents.models import Document
 from django.contrib.auth import get_user_model
 User = get_user_model()
@@ -58,6 +59,8 @@ class QuizAttempt(models.Model):
     completed_at = models.DateTimeField(auto_now_add=True)
     time_taken = models.IntegerField(default=0)  # in seconds
     user_answers = models.JSONField(default=dict)  # Store all user answers
+    # Answers that could not be evaluated (timeout or model failure); left out of the score
+    ungraded_questions = models.IntegerField(default=0)
     
     class Meta:
         ordering = ['-completed_at']
@@ -69,7 +72,7 @@ class UserAnswer(models.Model):
     attempt = models.ForeignKey(QuizAttempt, on_delete=models.CASCADE, related_name='answers')
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     user_answer = models.TextField()
-    is_correct = models.BooleanField(default=False)
+    is_correct = models.BooleanField(default=False, null=True)  # None: not evaluated
     feedback = models.TextField(blank=True, null=True)
     time_taken = models.IntegerField(default=0)  # in seconds
     
@@ -77,4 +80,57 @@ class UserAnswer(models.Model):
         unique_together = ['attempt', 'question']
     
     def __str__(self):
-        return f"Answer for Q{self.question.id} in Attempt {self.attempt.id}"
\ No newline at end of file
+        return f"Answer for Q{self.question.id} in Attempt {self.attempt.id}"
+
+class QuizGenerationJob(models.Model):
+    STATUSES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    IN_FLIGHT = ('pending', 'running')
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='quiz_jobs')
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='quiz_jobs')
+    quiz_type = models.CharField(max_length=10, choices=Quiz.QUIZ_TYPES)
+    questions_count = models.IntegerField(default=5)
+    difficulty = models.CharField(max_length=10, default='medium')
+    # Hash of the request parameters, used to coalesce identical in-flight requests
+    request_key = models.CharField(max_length=64, db_index=True)
+    fresh = models.BooleanField(default=False)  # bypass the LLM response cache
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending')
+    quiz = models.ForeignKey(Quiz, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['request_key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_in_flight_quiz_job'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.quiz_type.upper()} job for {self.document.title} ({self.status})"
+
+class LLMResponse(models.Model):
+    """
+    Cached model response, keyed by a hash of model name, prompt and
+    generation parameters
+    """
+    key = models.CharField(max_length=64, unique=True)
+    model_name = models.CharField(max_length=100)
+    response_text = models.TextField()
+    size = models.IntegerField(default=0)  # bytes of response_text
+    hits = models.IntegerField(default=0)  # model calls saved
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def __str__(self):
+        return f"{self.model_name} response {self.key[:12]} ({self.hits} hits)"
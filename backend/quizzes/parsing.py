@@ -0,0 +1,399 @@
+import json
+import re
+import threading
+
+SMART_DOUBLE_QUOTES = '“”„‟″'
+
+MCQ_OPTIONS = ('a', 'b', 'c', 'd')
+QUESTION_SCHEMAS = {
+    'mcq': ('question_text', 'option_a', 'option_b', 'option_c', 'option_d', 'correct_answer'),
+    'saq': ('question_text', 'expected_answer'),
+    'laq': ('question_text', 'expected_answer'),
+}
+OPTIONAL_QUESTION_FIELDS = ('explanation', 'topic')
+
+# "a", "A)", "(b)", "Option C", "d. Newton's law"
+ANSWER_LETTER_PATTERN = re.compile(r'^\s*(?:option\s*)?\(?([a-d])(?:[\s).:]|$)', re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _count(kind, name, amount=1):
+    if kind is None:
+        return
+    with _stats_lock:
+        counters = _stats.setdefault(kind, {
+            'replies': 0, 'clean': 0, 'repaired': 0, 'truncated': 0, 'salvaged': 0, 'failed': 0,
+            'items_dropped': 0,
+        })
+        counters[name] += amount
+
+
+def _find_object_end(text, start):
+    """
+    Index just past the object opening at text[start], or None when the
+    text ends first (a truncated reply)
+    """
+    depth = 0
+    in_string = escaped = False
+    for position in range(start, len(text)):
+        char = text[position]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return position + 1
+    return None
+
+
+def _extract(text):
+    start = text.find('{')
+    if start == -1:
+        raise ValueError("No JSON object in response")
+    end = _find_object_end(text, start)
+    return text[start:end], end is None
+
+
+def extract_json_object(text):
+    """
+    The outermost JSON object in a model reply, ignoring code fences and
+    prose around it. A reply cut off mid-object returns everything from its
+    opening brace, for repair_json to close.
+    """
+    return _extract(text)[0]
+
+
+def repair_json(text):
+    """
+    Fix the defects models commonly produce: smart quotes used as string
+    delimiters, raw newlines inside strings and trailing commas before a
+    closing bracket. A truncated reply is cut back to its last complete
+    element and closed: the unterminated item of the outermost open array
+    (the question being written) is dropped rather than kept half-written,
+    as is the unterminated member of the reply object when no array is open.
+    """
+    out = []
+    # Open containers: [closing bracket, output length after the last complete element]
+    stack = []
+    closer = None
+    escaped = False
+
+    def drop_trailing_comma():
+        while out and out[-1].isspace():
+            out.pop()
+        if out and out[-1] == ',':
+            out.pop()
+
+    for char in text:
+        if closer is not None:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == closer or (closer != '"' and char in SMART_DOUBLE_QUOTES):
+                closer = None
+                char = '"'
+            elif char == '"':
+                # A plain quote inside a string delimited by smart quotes
+                char = '\\"'
+            elif char == '\n':
+                char = '\\n'
+            elif char == '\r':
+                continue
+            out.append(char)
+            continue
+
+        if char == '"' or char in SMART_DOUBLE_QUOTES:
+            closer = '"' if char == '"' else SMART_DOUBLE_QUOTES
+            char = '"'
+        elif char in '{[':
+            out.append(char)
+            stack.append(['}' if char == '{' else ']', len(out)])
+            continue
+        elif char in '}]':
+            drop_trailing_comma()
+            if stack:
+                stack.pop()
+        elif char == ',' and stack:
+            stack[-1][1] = len(out)
+        out.append(char)
+
+    if not stack:
+        if closer is not None:
+            out.append('"')
+        return ''.join(out)
+
+    # Truncated: keep the complete elements of the outermost open array (or
+    # of the reply object) and close everything around them
+    level = next((depth for depth, (bracket, _) in enumerate(stack) if bracket == ']'), 0)
+    out = out[:stack[level][1]]
+    drop_trailing_comma()
+    out.extend(bracket for bracket, _ in reversed(stack[:level + 1]))
+    return ''.join(out)
+
+
+def load_json_object(text, kind='reply'):
+    """
+    Parse the outermost JSON object of a model reply, repairing it when
+    plain json.loads fails. Returns (data, repaired, truncated), truncated
+    meaning the reply was cut off and repair dropped its unfinished end.
+    Raises ValueError when even the repaired text is not a JSON object.
+    kind names the counters the outcome is recorded under (None records
+    nothing).
+    """
+    _count(kind, 'replies')
+    try:
+        candidate, truncated = _extract(text)
+    except ValueError:
+        _count(kind, 'failed')
+        raise
+
+    try:
+        data = json.loads(candidate)
+        repaired = False
+    except ValueError:
+        try:
+            data = json.loads(repair_json(candidate))
+        except ValueError as e:
+            _count(kind, 'failed')
+            raise ValueError(f"Failed to parse JSON response: {str(e)}")
+        repaired = True
+
+    if not isinstance(data, dict):
+        _count(kind, 'failed')
+        raise ValueError("Response is not a JSON object")
+    if truncated:
+        _count(kind, 'truncated')
+    return data, repaired, truncated
+
+
+def complete_reply(result):
+    """
+    Whether a parsed reply came from an untruncated response, i.e. whether
+    it is safe to cache and replay
+    """
+    return not result.get('truncated')
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return ''
+    return str(value).strip()
+
+
+def validate_question(data, quiz_type):
+    """
+    The question in data normalized to quiz_type's schema, or None when a
+    required field is missing or empty. MCQ answers may be given as "A",
+    "(b)", "Option C" or the text of the correct option.
+    """
+    if not isinstance(data, dict):
+        return None
+    question = {field: _text(data.get(field)) for field in QUESTION_SCHEMAS[quiz_type]}
+    for field in OPTIONAL_QUESTION_FIELDS:
+        question[field] = _text(data.get(field))
+    if not question['topic']:
+        question['topic'] = 'General'
+
+    if quiz_type == 'mcq':
+        answer = question['correct_answer']
+        match = ANSWER_LETTER_PATTERN.match(answer)
+        if match:
+            question['correct_answer'] = match.group(1).lower()
+        else:
+            options = [option for option in MCQ_OPTIONS if question[f'option_{option}'].lower() == answer.lower()]
+            question['correct_answer'] = options[0] if options else ''
+
+    if not all(question[field] for field in QUESTION_SCHEMAS[quiz_type]):
+        return None
+    return question
+
+
+def parse_quiz_reply(text, quiz_type, record=True):
+    """
+    {'questions': [...], 'truncated': bool} holding every well-formed
+    question of a quiz generation reply; malformed questions are dropped
+    rather than failing the quiz. Raises ValueError when no question survives.
+    """
+    kind = 'quiz' if record else None
+    data, repaired, truncated = load_json_object(text, kind)
+    items = data.get('questions')
+    if not isinstance(items, list):
+        _count(kind, 'failed')
+        raise ValueError("Invalid response format: missing questions array")
+
+    questions = [question for question in (validate_question(item, quiz_type) for item in items) if question]
+    if not questions:
+        _count(kind, 'failed')
+        raise ValueError("Response contained no valid questions")
+
+    dropped = len(items) - len(questions)
+    if dropped:
+        _count(kind, 'salvaged')
+        _count(kind, 'items_dropped', dropped)
+    _count(kind, 'repaired' if repaired else 'clean')
+    return {'questions': questions, 'truncated': truncated}
+
+
+def _evaluation(data):
+    if not isinstance(data, dict) or 'is_correct' not in data:
+        return None
+    is_correct = data['is_correct']
+    if isinstance(is_correct, str):
+        if is_correct.strip().lower() not in ('true', 'false', 'yes', 'no'):
+            return None
+        is_correct = is_correct.strip().lower() in ('true', 'yes')
+    elif not isinstance(is_correct, (bool, int)):
+        return None
+    return {
+        'is_correct': bool(is_correct),
+        'feedback': _text(data.get('feedback')) or 'Unable to evaluate answer.',
+        'score': data.get('score'),
+    }
+
+
+def parse_evaluation_reply(text):
+    """
+    {'is_correct', 'feedback', 'score', 'truncated'} from a single-answer
+    grading reply. Raises ValueError when is_correct is missing or not a
+    boolean.
+    """
+    data, repaired, truncated = load_json_object(text, 'evaluation')
+    evaluation = _evaluation(data)
+    if evaluation is None:
+        _count('evaluation', 'failed')
+        raise ValueError("Invalid evaluation format: missing is_correct")
+    _count('evaluation', 'repaired' if repaired else 'clean')
+    return dict(evaluation, truncated=truncated)
+
+
+def parse_evaluation_batch_reply(text):
+    """
+    {'results': {id: evaluation}, 'truncated': bool} for every well-formed
+    entry of a batch grading reply; malformed entries are dropped for the
+    caller to grade again
+    """
+    data, repaired, truncated = load_json_object(text, 'evaluation_batch')
+    items = data.get('results')
+    if not isinstance(items, list):
+        _count('evaluation_batch', 'failed')
+        raise ValueError("Invalid evaluation format: missing results array")
+
+    results = {}
+    for item in items:
+        evaluation = _evaluation(item)
+        try:
+            result_id = int(item['id'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if evaluation is not None:
+            results[result_id] = evaluation
+
+    if len(results) < len(items):
+        _count('evaluation_batch', 'salvaged')
+        _count('evaluation_batch', 'items_dropped', len(items) - len(results))
+    _count('evaluation_batch', 'repaired' if repaired else 'clean')
+    return {'results': results, 'truncated': truncated}
+
+
+def record_stream_result(questions, dropped):
+    """
+    Count a streamed quiz reply: questions kept and malformed ones dropped
+    """
+    _count('quiz_stream', 'replies')
+    if not questions:
+        _count('quiz_stream', 'failed')
+    elif dropped:
+        _count('quiz_stream', 'salvaged')
+    else:
+        _count('quiz_stream', 'clean')
+    if dropped:
+        _count('quiz_stream', 'items_dropped', dropped)
+
+
+def get_parse_stats():
+    """
+    This process's parse outcomes per kind of reply; failure_rate is the
+    share of replies that could not be used at all
+    """
+    with _stats_lock:
+        stats = {kind: dict(counters) for kind, counters in _stats.items()}
+    for counters in stats.values():
+        replies = counters['replies']
+        counters['failure_rate'] = round(counters['failed'] / replies, 4) if replies else 0
+    return stats
+
+
+class QuestionStreamParser:
+    """
+    Pull question objects out of a streamed {"questions": [{...}, ...]}
+    reply as soon as each one is complete. feed() takes the next chunk of
+    text and returns the questions it completed; the scan tracks string
+    literals and nesting, so braces inside question text do not confuse it,
+    and surrounding prose or code fences are skipped. Objects that are not
+    valid JSON are passed through repair_json before being given up on.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self._position = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._start = None
+
+    def _at_question_level(self):
+        # Directly inside the questions array, or a bare top-level array
+        return self._stack[-1:] == ['['] and len(self._stack) <= 2
+
+    def feed(self, chunk):
+        self.text += chunk
+        questions = []
+        for position in range(self._position, len(self.text)):
+            char = self.text[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if char == '{' and self._at_question_level():
+                    self._start = position
+                self._stack.append(char)
+            elif char in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if char == '}' and self._start is not None and self._at_question_level():
+                    questions.append(self._load(self.text[self._start:position + 1]))
+                    self._start = None
+        self._position = len(self.text)
+        return questions
+
+    @staticmethod
+    def _load(text):
+        """
+        The object in text, or None when it cannot be parsed even after repair
+        """
+        for candidate in (text, repair_json(text)):
+            try:
+                return json.loads(candidate)
+            except ValueError:
+                continue
+        return None
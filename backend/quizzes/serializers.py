@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Quiz, Question, QuizAttempt, UserAnswer
+from .models import Quiz, Question, QuizAttempt, QuizGenerationJob, UserAnswer
 
 class QuestionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -21,6 +21,16 @@ class QuizSerializer(serializers.ModelSerializer):
             'created_at', 'questions_count', 'difficulty', 'questions'
         ]
 
+class QuizGenerationJobSerializer(serializers.ModelSerializer):
+    quiz = QuizSerializer(read_only=True)
+    
+    class Meta:
+        model = QuizGenerationJob
+        fields = [
+            'id', 'document', 'quiz_type', 'questions_count', 'difficulty', 'fresh',
+            'status', 'error', 'quiz', 'created_at', 'updated_at'
+        ]
+
 class UserAnswerSerializer(serializers.ModelSerializer):
     question_text = serializers.CharField(source='question.question_text', read_only=True)
     
@@ -41,13 +51,15 @@ class QuizAttemptSerializer(serializers.ModelSerializer):
         model = QuizAttempt
         fields = [
             'id', 'quiz', 'quiz_title', 'document_title', 'score', 
-            'total_questions', 'percentage', 'completed_at', 'time_taken',
+            'total_questions', 'ungraded_questions', 'percentage', 'completed_at', 'time_taken',
             'user_answers', 'user_answers'
         ]
     
     def get_percentage(self, obj):
-        if obj.total_questions > 0:
-            return round((obj.score / obj.total_questions) * 100, 2)
+        # Of the answers that could be evaluated
+        graded_questions = obj.total_questions - obj.ungraded_questions
+        if graded_questions > 0:
+            return round((obj.score / graded_questions) * 100, 2)
         return 0
 
 class QuizGenerateSerializer(serializers.Serializer):
@@ -58,10 +70,14 @@ class QuizGenerateSerializer(serializers.Serializer):
         choices=[('easy', 'Easy'), ('medium', 'Medium'), ('hard', 'Hard')],
         default='medium'
     )
+    # Ask the model again instead of reusing a cached response
+    fresh = serializers.BooleanField(default=False)
 
 class QuizSubmitSerializer(serializers.Serializer):
     answers = serializers.ListField(
         child=serializers.DictField(),
         required=True
     )
-    time_taken = serializers.IntegerField(min_value=0, default=0)
\ No newline at end of file
+    time_taken = serializers.IntegerField(min_value=0, default=0)
+    # Grade several text answers per Gemini call; defaults to GRADING_BATCH_SIZE
+    batch = serializers.BooleanField(required=False, allow_null=True, default=None)
\ No newline at end of file
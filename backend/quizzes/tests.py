@@ -1,3 +1,710 @@
-from django.test import TestCase
+import json
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+import numpy as np
+from documents.embeddings import encode_embedding
+from documents.models import Document, DocumentChunk
+from .context import MIN_OVERLAP_CHARS, _mmr_order, estimate_tokens, pack_chunks, select_context, strip_overlap
+from .llm import _store_response, generate, generate_stream
+from .llm_client import (
+    FakeProvider, LLMClient, LLMDeadlineExceeded, LLMError, LocalTokenBucket, RedisTokenBucket, RetryableLLMError
+)
+from .models import LLMResponse, Question, Quiz, QuizAttempt, UserAnswer
+from .parsing import (
+    QuestionStreamParser, complete_reply, extract_json_object, parse_evaluation_batch_reply,
+    parse_evaluation_reply, parse_quiz_reply, repair_json
+)
+from .serializers import QuizAttemptSerializer
+from .utils import DEFAULT_GRADING_BATCH_SIZE, GRADING_TIMEOUT_FEEDBACK, grade_answers, stream_quiz_questions
 
-# Create your tests here.
+
+def fake_client(provider=None, limiter=None):
+    """
+    Patch the process-wide LLM client with one backed by FakeProvider
+    """
+    return mock.patch('quizzes.llm_client._client', LLMClient(provider or FakeProvider(), limiter))
+
+
+class StreamQuizQuestionsTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='student', password='unused')
+        self.document = Document.objects.create(
+            user=user, title='Mechanics', file='documents/mechanics.pdf', processed=True
+        )
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(
+                document=self.document, content=f"Newton's law number {i} relates force and motion.",
+                chunk_index=i, page_number=i
+            )
+            for i in range(3)
+        ])
+
+    def test_saves_questions_as_they_stream(self):
+        with fake_client():
+            events = list(stream_quiz_questions(self.document, 'mcq', 3))
+
+        kinds = [kind for kind, _ in events]
+        self.assertEqual(kinds, ['quiz', 'question', 'question', 'question', 'done'])
+        quiz = events[-1][1]
+        self.assertEqual(quiz.questions_count, 3)
+        self.assertEqual(Question.objects.filter(quiz=quiz).count(), 3)
+
+    def test_close_after_first_event_deletes_empty_quiz(self):
+        quizzes = Quiz.objects.count()
+        with fake_client():
+            events = stream_quiz_questions(self.document, 'mcq', 3)
+            kind, quiz = next(events)
+            self.assertEqual(kind, 'quiz')
+            self.assertTrue(Quiz.objects.filter(id=quiz.id).exists())
+            events.close()
+
+        self.assertEqual(Quiz.objects.count(), quizzes)
+
+    def test_close_mid_stream_keeps_saved_questions(self):
+        with fake_client():
+            events = stream_quiz_questions(self.document, 'saq', 3)
+            next(events)
+            kind, question = next(events)
+            events.close()
+
+        self.assertEqual(kind, 'question')
+        quiz = Quiz.objects.get(id=question.quiz_id)
+        self.assertEqual(quiz.questions_count, 1)
+        self.assertEqual(quiz.questions.count(), 1)
+
+
+class GradeAnswersBatchingTests(TestCase):
+    def setUp(self):
+        self.pairs = [
+            (Question(question_text=f"Question {i}?", question_type='saq', expected_answer="An answer."), "An answer.")
+            for i in range(7)
+        ]
+
+    def group_sizes(self, batch):
+        with mock.patch(
+            'quizzes.utils._grade_group', side_effect=lambda pairs, deadline: [(True, 'Good.')] * len(pairs)
+        ) as grade_group:
+            results = grade_answers(self.pairs, batch=batch)
+        self.assertEqual(results, [(True, 'Good.')] * len(self.pairs))
+        return sorted((len(call.args[0]) for call in grade_group.call_args_list), reverse=True)
+
+    @override_settings(GRADING_BATCH_SIZE=3)
+    def test_batch_uses_configured_size(self):
+        self.assertEqual(self.group_sizes(batch=True), [3, 3, 1])
+        self.assertEqual(self.group_sizes(batch=None), [3, 3, 1])
+
+    @override_settings(GRADING_BATCH_SIZE=3)
+    def test_batch_false_grades_one_by_one(self):
+        self.assertEqual(self.group_sizes(batch=False), [1] * 7)
+
+    @override_settings(GRADING_BATCH_SIZE=0)
+    def test_batch_without_configured_size_uses_default(self):
+        self.assertEqual(self.group_sizes(batch=True), [DEFAULT_GRADING_BATCH_SIZE, 7 - DEFAULT_GRADING_BATCH_SIZE])
+        self.assertEqual(self.group_sizes(batch=None), [1] * 7)
+
+
+class UngradedAnswersTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='student', password='unused')
+        document = Document.objects.create(
+            user=self.user, title='Mechanics', file='documents/mechanics.pdf', processed=True
+        )
+        self.quiz = Quiz.objects.create(
+            document=document, quiz_type='saq', title='SAQ Quiz', questions_count=3
+        )
+        self.questions = [
+            Question.objects.create(
+                quiz=self.quiz, question_text=f"What does law {i} state?", question_type='saq',
+                expected_answer=f"Law {i} relates force and acceleration."
+            )
+            for i in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_failed_groups_are_not_graded_wrong(self):
+        def grade_group(pairs, deadline):
+            if pairs[0][0] is self.questions[1]:
+                raise RuntimeError("model overloaded")
+            return [(True, 'Good.')] * len(pairs)
+
+        with mock.patch('quizzes.utils._grade_group', side_effect=grade_group):
+            results = grade_answers([(question, "An answer.") for question in self.questions], batch=False)
+
+        self.assertEqual([is_correct for is_correct, _ in results], [True, None, True])
+        self.assertEqual(results[1][1], "Evaluation failed: model overloaded")
+
+    @override_settings(GRADING_BATCH_SIZE=0)
+    def test_submit_leaves_timed_out_answers_out_of_the_score(self):
+        attempt = QuizAttempt.objects.create(user=self.user, quiz=self.quiz, total_questions=3)
+
+        def generate(prompt, **kwargs):
+            if self.questions[2].question_text in prompt:
+                raise LLMDeadlineExceeded("Deadline passed before the model answered")
+            correct = self.questions[0].question_text in prompt
+            return {'is_correct': correct, 'feedback': 'Graded.', 'truncated': False}
+
+        with mock.patch('quizzes.utils.generate', side_effect=generate):
+            response = self.client.post(f'/api/quizzes/attempts/{attempt.id}/submit/', {
+                'answers': [{'question_id': question.id, 'answer': "An answer."} for question in self.questions],
+            }, format='json')
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['score'], 1)
+        self.assertEqual(response.data['ungraded_questions'], 1)
+        self.assertEqual(response.data['percentage'], 50.0)
+
+        answers = {answer.question_id: answer for answer in UserAnswer.objects.filter(attempt=attempt)}
+        self.assertEqual(
+            [answers[question.id].is_correct for question in self.questions], [True, False, None]
+        )
+        self.assertEqual(answers[self.questions[2].id].feedback, GRADING_TIMEOUT_FEEDBACK)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.ungraded_questions, 1)
+        self.assertEqual(QuizAttemptSerializer().get_percentage(attempt), 50.0)
+
+
+def saq(number):
+    return {'question_text': f"Question {number}?", 'expected_answer': f"Answer {number}."}
+
+
+class ScriptedProvider:
+    """
+    Provider replying with fixed text, streamed in chunks of chunk_size
+    """
+
+    name = 'scripted'
+
+    def __init__(self, text, chunk_size=7):
+        self.text = text
+        self.chunk_size = chunk_size
+
+    def complete(self, prompt, model_name, generation_config=None, timeout=None):
+        return self.text
+
+    def stream(self, prompt, model_name, generation_config=None, timeout=None):
+        for start in range(0, len(self.text), self.chunk_size):
+            yield self.text[start:start + self.chunk_size]
+
+
+class ExtractJsonTests(TestCase):
+    def test_outermost_object(self):
+        cases = [
+            ('bare', '{"a": 1}', '{"a": 1}'),
+            ('code fence', '```json\n{"a": {"b": [1, 2]}}\n```', '{"a": {"b": [1, 2]}}'),
+            ('prose around', 'Sure! Here it is: {"a": 1} Hope that helps {"b": 2}', '{"a": 1}'),
+            ('braces in strings', '{"a": "x } y {", "b": "{"}', '{"a": "x } y {", "b": "{"}'),
+            ('escaped quote', '{"a": "say \\"}\\" now"} tail', '{"a": "say \\"}\\" now"}'),
+            ('truncated', 'Here: {"a": [1, {"b": 2', '{"a": [1, {"b": 2'),
+        ]
+        for name, text, expected in cases:
+            with self.subTest(name):
+                self.assertEqual(extract_json_object(text), expected)
+
+    def test_no_object(self):
+        with self.assertRaises(ValueError):
+            extract_json_object('I cannot help with that.')
+
+
+class RepairJsonTests(TestCase):
+    def test_repairs(self):
+        cases = [
+            ('valid', '{"a": [1, 2]}', {'a': [1, 2]}),
+            ('trailing commas', '{"a": [1, 2,], "b": {"c": 3,},}', {'a': [1, 2], 'b': {'c': 3}}),
+            ('smart quotes', '{\u201ca\u201d: \u201cx "y" z\u201d}', {'a': 'x "y" z'}),
+            ('raw newline in string', '{"a": "line\nbreak\r\n"}', {'a': 'line\nbreak\n'}),
+            ('cut inside a question', '{"questions": [{"q": "one"}, {"q": "tw', {'questions': [{'q': 'one'}]}),
+            ('cut before closing brace', '{"questions": [{"q": "one"}, {"q": "two"', {'questions': [{'q': 'one'}]}),
+            ('cut after a comma', '{"questions": [{"q": "one"}, {"q": "two"},', {'questions': [{'q': 'one'}, {'q': 'two'}]}),
+            (
+                'cut in a nested array', '{"questions": [{"q": "one"}, {"q": "two", "tags": ["a", "b',
+                {'questions': [{'q': 'one'}]}
+            ),
+            ('cut in the first question', '{"questions": [{"q": "on', {'questions': []}),
+            ('cut in an object member', '{"is_correct": true, "feedback": "Good b', {'is_correct': True}),
+            ('cut after a brace in a string', '{"questions": [{"q": "a { b"}, {"q": "c } d', {'questions': [{'q': 'a { b'}]}),
+        ]
+        for name, text, expected in cases:
+            with self.subTest(name):
+                self.assertEqual(json.loads(repair_json(text)), expected)
+
+
+class ParseRepliesTests(TestCase):
+    def test_quiz_replies(self):
+        questions = [saq(1), saq(2)]
+        complete = json.dumps({'questions': questions})
+        cases = [
+            ('clean', complete, questions, False),
+            ('code fence', f"```json\n{complete}\n```", questions, False),
+            ('truncated', complete[:-20], questions[:1], True),
+            (
+                'malformed item dropped', json.dumps({'questions': [saq(1), {'question_text': 'No answer?'}]}),
+                questions[:1], False
+            ),
+            ('extra fields ignored', json.dumps({'questions': [dict(saq(1), difficulty='hard')]}), questions[:1], False),
+        ]
+        for name, text, expected, truncated in cases:
+            with self.subTest(name):
+                result = parse_quiz_reply(text, 'saq', record=False)
+                self.assertEqual(
+                    [(question['question_text'], question['expected_answer']) for question in result['questions']],
+                    [(question['question_text'], question['expected_answer']) for question in expected]
+                )
+                self.assertEqual(result['truncated'], truncated)
+                self.assertEqual(complete_reply(result), not truncated)
+
+    def test_unusable_quiz_replies(self):
+        cases = [
+            ('no json', 'Sorry, I cannot do that.'),
+            ('no questions array', '{"items": []}'),
+            ('cut in the only question', '{"questions": [{"question_text": "Question 1?", "expected_ans'),
+            ('no valid question', '{"questions": [{"question_text": ""}]}'),
+        ]
+        for name, text in cases:
+            with self.subTest(name), self.assertRaises(ValueError):
+                parse_quiz_reply(text, 'saq', record=False)
+
+    def test_mcq_answer_letters(self):
+        options = {f'option_{option}': f"Option {option}" for option in 'abcd'}
+        for answer, expected in [('B', 'b'), ('(c)', 'c'), ('Option D', 'd'), ('a. Force', 'a'), ('Option c', 'c')]:
+            with self.subTest(answer):
+                reply = json.dumps({'questions': [dict(options, question_text='Q?', correct_answer=answer)]})
+                self.assertEqual(parse_quiz_reply(reply, 'mcq', record=False)['questions'][0]['correct_answer'], expected)
+
+    def test_evaluation_replies(self):
+        self.assertEqual(
+            parse_evaluation_reply('```json\n{"is_correct": "yes", "feedback": "Good.", "score": 8}\n```'),
+            {'is_correct': True, 'feedback': 'Good.', 'score': 8, 'truncated': False}
+        )
+        truncated = parse_evaluation_reply('{"is_correct": false, "feedback": "Missing the')
+        self.assertEqual((truncated['is_correct'], truncated['truncated']), (False, True))
+        with self.assertRaises(ValueError):
+            parse_evaluation_reply('{"feedback": "Good."}')
+
+    def test_evaluation_batch_replies(self):
+        cases = [
+            (
+                'clean', '{"results": [{"id": 0, "is_correct": true, "feedback": "a"}, {"id": "1", "is_correct": false}]}',
+                {0: True, 1: False}, False
+            ),
+            (
+                'truncated item dropped',
+                '{"results": [{"id": 0, "is_correct": true, "feedback": "a"}, {"id": 1, "is_correct": fal',
+                {0: True}, True
+            ),
+            (
+                'malformed items dropped',
+                '{"results": [{"id": 0, "is_correct": "maybe"}, {"is_correct": true}, {"id": 2, "is_correct": true}]}',
+                {2: True}, False
+            ),
+        ]
+        for name, text, expected, truncated in cases:
+            with self.subTest(name):
+                result = parse_evaluation_batch_reply(text)
+                self.assertEqual(
+                    {result_id: evaluation['is_correct'] for result_id, evaluation in result['results'].items()}, expected
+                )
+                self.assertEqual(result['truncated'], truncated)
+
+
+class QuestionStreamParserTests(TestCase):
+    def feed(self, text, chunk_size):
+        parser = QuestionStreamParser()
+        objects = []
+        for start in range(0, len(text), chunk_size):
+            objects.extend(parser.feed(text[start:start + chunk_size]))
+        return objects
+
+    def test_emits_each_question_once_complete(self):
+        cases = [
+            ('plain', json.dumps({'questions': [saq(1), saq(2)]}), [saq(1), saq(2)]),
+            ('code fence and prose', 'Here you go:\n```json\n' + json.dumps({'questions': [saq(1)]}) + '\n```', [saq(1)]),
+            ('bare array', json.dumps([saq(1), saq(2)]), [saq(1), saq(2)]),
+            (
+                'braces and escapes in strings', json.dumps({'questions': [{'q': 'a } " { b'}, {'q': '\\'}]}),
+                [{'q': 'a } " { b'}, {'q': '\\'}]
+            ),
+            (
+                'nested objects stay whole', json.dumps({'questions': [{'q': 'x', 'meta': {'n': [1, {'m': 2}]}}]}),
+                [{'q': 'x', 'meta': {'n': [1, {'m': 2}]}}]
+            ),
+            ('trailing comma repaired', '{"questions": [{"q": "x",}, {"q": "y"}]}', [{'q': 'x'}, {'q': 'y'}]),
+            ('unparseable item', '{"questions": [{"q": }, {"q": "y"}]}', [None, {'q': 'y'}]),
+            ('truncated tail not emitted', '{"questions": [{"q": "x"}, {"q": "y', [{'q': 'x'}]),
+        ]
+        for name, text, expected in cases:
+            for chunk_size in (1, 5, len(text)):
+                with self.subTest(name, chunk_size=chunk_size):
+                    self.assertEqual(self.feed(text, chunk_size), expected)
+
+
+class TruncatedRepliesCacheTests(TestCase):
+    complete_text = json.dumps({'questions': [saq(1), saq(2)]})
+
+    def parse(self, text):
+        return parse_quiz_reply(text, 'saq', record=False)
+
+    def test_generate_caches_only_complete_replies(self):
+        cases = [('complete', self.complete_text, 1), ('truncated', self.complete_text[:-20], 0)]
+        for name, text, stored in cases:
+            with self.subTest(name), fake_client(ScriptedProvider(text)):
+                LLMResponse.objects.all().delete()
+                result = generate(f'prompt {name}', parse=self.parse, cache_if=complete_reply)
+                self.assertEqual(len(result['questions']), 2 if stored else 1)
+                self.assertEqual(LLMResponse.objects.count(), stored)
+
+    def test_generate_stream_caches_only_complete_replies(self):
+        cases = [('complete', self.complete_text, 1), ('truncated', self.complete_text[:-20], 0)]
+        for name, text, stored in cases:
+            with self.subTest(name), fake_client(ScriptedProvider(text)):
+                LLMResponse.objects.all().delete()
+                chunks = list(generate_stream(f'prompt {name}', parse=self.parse, cache_if=complete_reply))
+                self.assertEqual(''.join(chunks), text)
+                self.assertEqual(LLMResponse.objects.count(), stored)
+
+    def test_truncated_reply_is_asked_again(self):
+        with fake_client(ScriptedProvider(self.complete_text[:-20])):
+            generate('prompt', parse=self.parse, cache_if=complete_reply)
+        with fake_client(ScriptedProvider(self.complete_text)):
+            self.assertEqual(len(generate('prompt', parse=self.parse, cache_if=complete_reply)['questions']), 2)
+        with fake_client(ScriptedProvider('unused')):
+            # Now served from the cache
+            self.assertEqual(len(generate('prompt', parse=self.parse, cache_if=complete_reply)['questions']), 2)
+
+
+class FakeClock:
+    """
+    Stands in for the time module in quizzes.llm_client: sleep() advances
+    monotonic() instantly and every sleep is recorded
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FlakyProvider(FakeProvider):
+    """
+    FakeProvider failing its first calls with the given errors, recording
+    the timeout each attempt was given
+    """
+
+    def __init__(self, errors=(), latency=0):
+        super().__init__(latency)
+        self.errors = list(errors)
+        self.timeouts = []
+
+    def complete(self, prompt, model_name, generation_config=None, timeout=None):
+        self.timeouts.append(timeout)
+        if self.errors:
+            raise self.errors.pop(0)
+        return super().complete(prompt, model_name, generation_config, timeout)
+
+    def stream(self, prompt, model_name, generation_config=None, timeout=None):
+        self.timeouts.append(timeout)
+        if self.errors:
+            raise self.errors.pop(0)
+        yield from super().stream(prompt, model_name, generation_config, timeout)
+
+
+@override_settings(
+    LLM_MAX_RETRIES=3, LLM_BACKOFF_BASE_SECONDS=0.5, LLM_BACKOFF_MAX_SECONDS=4, LLM_REQUEST_TIMEOUT_SECONDS=30
+)
+class LLMClientTests(TestCase):
+    prompt = 'Generate 2 SAQ questions based on the following educational content'
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('quizzes.llm_client.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket_refills_at_rate(self):
+        bucket = LocalTokenBucket(rate=2, capacity=2)
+        # The burst is free, then each token waits for its share of the refill
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+        self.clock.now += 10
+        # Refill is capped at the capacity
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0.5])
+
+    def test_redis_bucket_falls_back_to_local_limiting(self):
+        bucket = RedisTokenBucket('redis://127.0.0.1:1/0', 'llm-rate:test', rate=1, capacity=1)
+        with self.assertLogs('quizzes.llm_client', 'WARNING'):
+            self.assertEqual([bucket.reserve(), bucket.reserve()], [0, 1.0])
+
+    def test_throttle_waits_for_the_limiter(self):
+        client = LLMClient(FakeProvider(), LocalTokenBucket(rate=1, capacity=1))
+        client.complete(self.prompt)
+        client.complete(self.prompt)
+        self.assertEqual(self.clock.sleeps, [1.0])
+        self.assertEqual(client.stats()['throttled'], 1)
+
+    def test_throttle_past_the_deadline_fails_fast(self):
+        client = LLMClient(FakeProvider(), LocalTokenBucket(rate=0.1, capacity=1))
+        client.complete(self.prompt)
+        with self.assertRaises(LLMDeadlineExceeded):
+            client.complete(self.prompt, deadline=self.clock.now + 5)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_retries_retryable_errors(self):
+        provider = FlakyProvider([RetryableLLMError("overloaded"), RetryableLLMError("rate limited")])
+        client = LLMClient(provider)
+        with mock.patch('quizzes.llm_client.random.uniform', side_effect=lambda low, high: high):
+            reply = client.complete(self.prompt)
+
+        self.assertEqual(len(json.loads(reply)['questions']), 2)
+        # Exponential ceilings of the full-jitter backoff
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+        stats = client.stats()
+        self.assertEqual((stats['attempts'], stats['retries'], stats['failures']), (3, 2, 0))
+
+    def test_backoff_is_jittered_and_capped(self):
+        client = LLMClient(FakeProvider())
+        for attempt in range(8):
+            with self.subTest(attempt=attempt):
+                ceiling = min(4, 0.5 * 2 ** attempt)
+                delays = [client._backoff(attempt) for _ in range(50)]
+                self.assertTrue(all(0 <= delay <= ceiling for delay in delays))
+                self.assertGreater(len(set(delays)), 1)
+
+    def test_gives_up_after_max_retries(self):
+        provider = FlakyProvider([RetryableLLMError("overloaded")] * 5)
+        client = LLMClient(provider)
+        with self.assertRaisesRegex(LLMError, "after 4 attempts"):
+            client.complete(self.prompt)
+        self.assertEqual(len(provider.timeouts), 4)
+        self.assertEqual(client.stats()['failures'], 1)
+
+    def test_non_retryable_error_passes_through(self):
+        error = LLMError("API key not valid")
+        provider = FlakyProvider([error])
+        client = LLMClient(provider)
+        with self.assertRaises(LLMError) as raised:
+            client.complete(self.prompt)
+        self.assertIs(raised.exception, error)
+        self.assertEqual(len(provider.timeouts), 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_backoff_never_sleeps_past_the_deadline(self):
+        provider = FlakyProvider([RetryableLLMError("overloaded")] * 5)
+        client = LLMClient(provider)
+        deadline = self.clock.now + 2
+        with mock.patch('quizzes.llm_client.random.uniform', side_effect=lambda low, high: high):
+            with self.assertRaises(LLMDeadlineExceeded):
+                client.complete(self.prompt, deadline=deadline)
+
+        # 0.5 and 1.0 fit in the 2 seconds; the next 2.0 second wait would not
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+        self.assertLessEqual(self.clock.now, deadline)
+        # Each attempt's timeout is capped by the time left
+        self.assertEqual(provider.timeouts, [2, 1.5, 0.5])
+
+    def test_slow_attempts_are_bounded_by_the_deadline(self):
+        client = LLMClient(FlakyProvider(latency=5))
+        with self.assertRaises(LLMDeadlineExceeded):
+            client.complete(self.prompt, deadline=self.clock.now + 3)
+        self.assertLessEqual(self.clock.now, 1003)
+
+    def test_stream_retries_before_the_first_chunk(self):
+        client = LLMClient(FlakyProvider([RetryableLLMError("overloaded")]))
+        text = ''.join(client.stream(self.prompt))
+        self.assertEqual(text, FakeProvider().complete(self.prompt, 'model'))
+        self.assertEqual(client.stats()['retries'], 1)
+
+    def test_stream_interrupted_after_the_first_chunk_is_not_retried(self):
+        provider = FlakyProvider()
+
+        def interrupted(*args, **kwargs):
+            yield '{"questions": ['
+            raise RetryableLLMError("connection reset")
+
+        client = LLMClient(provider)
+        with mock.patch.object(provider, 'stream', side_effect=interrupted):
+            chunks = client.stream(self.prompt)
+            self.assertEqual(next(chunks), '{"questions": [')
+            with self.assertRaisesRegex(LLMError, "interrupted"):
+                next(chunks)
+        self.assertEqual(client.stats()['retries'], 0)
+
+
+class LLMCachePruneTests(TestCase):
+    def prune_calls(self, stores):
+        with mock.patch('quizzes.llm._stats', {'stored': 0, 'evicted': 0}), \
+                mock.patch('quizzes.llm.prune_cache') as prune_cache:
+            for number in range(stores):
+                _store_response(f'key-{number}', 'fake:model', 'reply')
+        return prune_cache.call_count
+
+    def test_prunes_every_n_stores(self):
+        for every, stores, expected in [(1, 3, 3), (2, 5, 2), (50, 49, 0), (50, 100, 2), (0, 2, 2)]:
+            with self.subTest(every=every, stores=stores), override_settings(LLM_CACHE_PRUNE_EVERY=every):
+                self.assertEqual(self.prune_calls(stores), expected)
+
+
+class StripOverlapTests(TestCase):
+    def test_strip_overlap(self):
+        seam = "the net force on a body equals its rate of change of momentum"
+        cases = [
+            ('splitter overlap', f"Newton's second law: {seam}", f"{seam} and so F = ma.", "and so F = ma."),
+            ('no overlap', "Light bends at a boundary.", "Mirrors reflect light.", "Mirrors reflect light."),
+            ('shared letter only', "The unit is the volt", "t is measured in seconds.", "t is measured in seconds."),
+            ('shared short word', "energy is conserved in a closed system",
+             "system boundaries matter.", "system boundaries matter."),
+            ('repeat shorter than the minimum', "motion in one dimension", "one dimension only.", "one dimension only."),
+            # Ends inside a word of previous ("momentum" vs "um ..."): not a splitter seam
+            ('inside a word', "rate of change of momentum of the system",
+             "um of the system is what we measure.", "um of the system is what we measure."),
+            ('whole current repeated', f"Recall: {seam}", seam, ""),
+        ]
+        for name, previous, current, expected in cases:
+            with self.subTest(name):
+                self.assertEqual(strip_overlap(previous, current), expected)
+
+    def test_minimum_overlap_length(self):
+        words = "alpha beta gamma delta epsilon zeta eta theta"
+        for size in range(MIN_OVERLAP_CHARS - 3, MIN_OVERLAP_CHARS + 4):
+            overlap = words[-size:]
+            if not (overlap[0] != ' ' and words[-size - 1] == ' '):
+                continue
+            with self.subTest(size=size):
+                stripped = strip_overlap(f"Greek letters: {words}", f"{overlap} iota kappa")
+                self.assertEqual(stripped == "iota kappa", size >= MIN_OVERLAP_CHARS)
+
+    @override_settings(DOCUMENT_CHUNK_OVERLAP=30)
+    def test_overlap_longer_than_the_splitter_overlap_is_kept(self):
+        repeat = "forty characters of text repeated twice!"
+        self.assertEqual(strip_overlap(f"Intro {repeat}", f"{repeat} tail"), f"{repeat} tail")
+
+
+class PackChunksTests(TestCase):
+    def overlapping_rows(self, count, overlap):
+        """
+        count consecutive chunks of one page, each repeating the last
+        overlap characters of the one before
+        """
+        words = [f"word{number:03d}" for number in range(count * 40)]
+        text = ' '.join(words)
+        step = len(text) // count
+        rows = []
+        for number in range(count):
+            start = max(number * step - overlap, 0)
+            while start and text[start - 1] != ' ':
+                start += 1
+            end = (number + 1) * step
+            while end < len(text) and text[end] != ' ':
+                end += 1
+            rows.append((number, 1, text[start:end].strip()))
+        return rows
+
+    def test_budget_is_charged_for_stripped_text(self):
+        rows = self.overlapping_rows(6, overlap=120)
+        full = sum(estimate_tokens(content) for _, _, content in rows)
+        stripped = sum(
+            estimate_tokens(strip_overlap(rows[i - 1][2], content) if i else content)
+            for i, (_, _, content) in enumerate(rows)
+        )
+        self.assertLess(stripped, full - 100)
+
+        # A budget the stripped texts fit in, but the full chunks do not
+        selected, texts = pack_chunks(rows, range(len(rows)), stripped)
+        self.assertEqual(selected, list(range(len(rows))))
+        self.assertLessEqual(sum(estimate_tokens(text) for text in texts), stripped)
+        # Every word of the page exactly once, in order
+        words = ' '.join(texts).split()
+        self.assertEqual(words, sorted(set(words)))
+
+    def test_out_of_order_picks_get_the_neighbour_discount(self):
+        rows = self.overlapping_rows(3, overlap=120)
+        stripped_middle = estimate_tokens(strip_overlap(rows[0][2], rows[1][2]))
+        budget = estimate_tokens(rows[0][2]) + stripped_middle + 2
+        # Picking the later chunk first still ends at the stripped total
+        selected, texts = pack_chunks(rows, [1, 0, 2], budget)
+        self.assertEqual(selected, [0, 1])
+        self.assertEqual(texts[1], strip_overlap(rows[0][2], rows[1][2]))
+
+    def test_no_stripping_across_pages_or_gaps(self):
+        shared = "momentum is conserved when no external force acts"
+        rows = [
+            (0, 1, f"Page one ends: {shared}"),
+            (1, 2, f"{shared} on page two."),
+            (3, 2, f"{shared} after a gap."),
+        ]
+        _, texts = pack_chunks(rows, [0, 1, 2], 1000)
+        self.assertEqual(texts, [content for _, _, content in rows])
+
+    def test_stops_within_budget(self):
+        rows = [(i, i, 'x' * 400) for i in range(10)]
+        selected, texts = pack_chunks(rows, range(10), 350)
+        self.assertEqual(len(selected), 3)
+        self.assertLessEqual(sum(estimate_tokens(text) for text in texts), 350)
+
+
+class MMRTests(TestCase):
+    def test_skips_near_duplicates(self):
+        rng = np.random.default_rng(0)
+        themes = np.eye(32)[:3]
+        # Five near-copies of the first theme, one chunk each of the others
+        vectors = np.vstack([themes[0] + rng.normal(0, 0.01, 32) for _ in range(5)] + [themes[1], themes[2]])
+        first_three = list(_mmr_order(vectors, diversity=0.5))[:3]
+        self.assertEqual(len([pick for pick in first_three if pick < 5]), 1)
+        self.assertEqual(set(first_three) & {5, 6}, {5, 6})
+
+    def test_orders_every_vector_once(self):
+        vectors = np.random.default_rng(1).standard_normal((20, 8))
+        self.assertEqual(sorted(_mmr_order(vectors, diversity=0.3)), list(range(20)))
+
+    def test_without_diversity_follows_relevance(self):
+        vectors = np.array([[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]])
+        # The centroid leans to the first axis, so the near-parallel pair comes first
+        self.assertEqual(list(_mmr_order(vectors, diversity=0)), [1, 0, 2])
+
+
+class SelectContextTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='teacher', password='unused')
+        self.document = Document.objects.create(
+            user=user, title='Mechanics', file='documents/mechanics.pdf', processed=True
+        )
+
+    def add_chunks(self, contents, vectors=None):
+        DocumentChunk.objects.bulk_create([
+            DocumentChunk(
+                document=self.document, content=content, chunk_index=i, page_number=1,
+                embeddings=encode_embedding(vectors[i]) if vectors is not None else None
+            )
+            for i, content in enumerate(contents)
+        ])
+
+    def test_diverse_chunks_in_reading_order(self):
+        rng = np.random.default_rng(2)
+        themes = np.eye(16)[:2]
+        contents = [f"Kinematics passage {i}. " * 10 for i in range(4)] + ["Thermodynamics passage. " * 10]
+        vectors = [themes[0] + rng.normal(0, 0.01, 16) for _ in range(4)] + [themes[1]]
+        self.add_chunks(contents, vectors)
+
+        budget = estimate_tokens(contents[0]) + estimate_tokens(contents[-1])
+        context = select_context(self.document, token_budget=budget)
+        parts = context.split("\n\n")
+        self.assertEqual(len(parts), 2)
+        self.assertIn("Thermodynamics", parts[-1])
+        self.assertLessEqual(sum(estimate_tokens(part) for part in parts), budget)
+
+    def test_without_vectors_spreads_across_the_document(self):
+        contents = [f"Section {i} content. " * 10 for i in range(9)]
+        self.add_chunks(contents)
+        context = select_context(self.document, token_budget=estimate_tokens(contents[0]) * 3 + 2)
+        self.assertEqual(
+            [part.split()[1] for part in context.split("\n\n")], ['0', '4', '8']
+        )
+
+    def test_empty_document(self):
+        self.assertEqual(select_context(self.document), '')
@@ -1,11 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import QuizViewSet, QuizAttemptViewSet
+from .views import QuizViewSet, QuizAttemptViewSet, generate_quiz_stream
 
 router = DefaultRouter()
 router.register(r'quizzes', QuizViewSet, basename='quiz')
 router.register(r'attempts', QuizAttemptViewSet, basename='quizattempt')
 
 urlpatterns = [
+    # Server-Sent Events quiz generation (streams under both WSGI and ASGI)
+    path('quizzes/generate/stream/', generate_quiz_stream, name='quiz-generate-stream'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
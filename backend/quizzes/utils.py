@@ -1,15 +1,32 @@
+import hashlib
 import json
-import google.generativeai as genai
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from datetime import timedelta
+from celery import shared_task
 from django.conf import settings
-from documents.models import Document, DocumentChunk
-from .models import Quiz, Question
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from documents.models import Document
+from .context import select_context
+from .llm import generate, generate_stream
+from .llm_client import LLMDeadlineExceeded
+from .models import Quiz, Question, QuizGenerationJob
+from .parsing import (
+    QuestionStreamParser, complete_reply, parse_evaluation_batch_reply, parse_evaluation_reply,
+    parse_quiz_reply, record_stream_result, validate_question
+)
 
-# Configure Gemini
-genai.configure(api_key=settings.GOOGLE_API_KEY)
+# Answers per prompt when batch grading is requested but GRADING_BATCH_SIZE is off
+DEFAULT_GRADING_BATCH_SIZE = 5
 
-def generate_quiz_questions(document_id, quiz_type, questions_count, user, difficulty='medium'):
+GRADING_TIMEOUT_FEEDBACK = "Evaluation timed out. Please try again later."
+
+def generate_quiz_questions(document_id, quiz_type, questions_count, user, difficulty='medium', use_cache=True, deadline=None):
     """
-    Generate quiz questions using Gemini AI
+    Generate quiz questions using Gemini AI. use_cache=False asks the model
+    for fresh questions instead of reusing a cached response; deadline (a
+    time.monotonic() value) bounds the model call including retries.
     """
     try:
         document = Document.objects.get(id=document_id, user=user)
@@ -17,19 +34,17 @@ def generate_quiz_questions(document_id, quiz_type, questions_count, user, diffi
         if not document.processed:
             raise ValueError("Document is not processed yet")
         
-        # Get relevant content from document
-        chunks = DocumentChunk.objects.filter(document=document).order_by('chunk_index')[:15]
-        content = "\n".join([chunk.content for chunk in chunks])
+        # Diverse content from across the document, within the prompt token budget
+        content = select_context(document)
         
         # Create prompt based on quiz type
         prompt = create_quiz_prompt(content, quiz_type, questions_count, difficulty)
         
-        # Generate questions using Gemini
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        response = model.generate_content(prompt)
-        
-        # Parse response
-        quiz_data = parse_quiz_response(response.text, quiz_type)
+        # Generate and parse questions using Gemini (cached by prompt)
+        quiz_data = generate(
+            prompt, parse=lambda text: parse_quiz_response(text, quiz_type), use_cache=use_cache,
+            deadline=deadline, cache_if=complete_reply
+        )
         
         # Create quiz in database
         return create_quiz_from_data(quiz_data, document, quiz_type, questions_count, difficulty)
@@ -37,6 +52,86 @@ def generate_quiz_questions(document_id, quiz_type, questions_count, user, diffi
     except Exception as e:
         raise Exception(f"Error generating quiz: {str(e)}")
 
+def quiz_request_key(user_id, document_id, quiz_type, questions_count, difficulty, fresh=False):
+    params = [user_id, document_id, quiz_type, questions_count, difficulty, fresh]
+    return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+def start_quiz_generation(user, document, quiz_type, questions_count, difficulty, fresh=False):
+    """
+    Queue a quiz generation job, or return the identical one already in
+    flight. Returns (job, created).
+    """
+    request_key = quiz_request_key(user.id, document.id, quiz_type, questions_count, difficulty, fresh)
+    
+    # A job whose worker died would block identical requests forever
+    stale_before = timezone.now() - timedelta(seconds=settings.QUIZ_JOB_STALE_SECONDS)
+    QuizGenerationJob.objects.filter(
+        request_key=request_key, status__in=QuizGenerationJob.IN_FLIGHT, updated_at__lt=stale_before
+    ).update(status='failed', error='Generation timed out')
+    
+    job = QuizGenerationJob.objects.filter(
+        request_key=request_key, status__in=QuizGenerationJob.IN_FLIGHT
+    ).first()
+    if job is not None:
+        return job, False
+    
+    try:
+        with transaction.atomic():
+            job = QuizGenerationJob.objects.create(
+                user=user,
+                document=document,
+                quiz_type=quiz_type,
+                questions_count=questions_count,
+                difficulty=difficulty,
+                fresh=fresh,
+                request_key=request_key
+            )
+    except IntegrityError:
+        # An identical request created its job between our check and insert
+        job = QuizGenerationJob.objects.filter(
+            request_key=request_key, status__in=QuizGenerationJob.IN_FLIGHT
+        ).first()
+        if job is not None:
+            return job, False
+        raise
+    
+    transaction.on_commit(lambda: generate_quiz_job.delay(job.id))
+    return job, True
+
+@shared_task
+def generate_quiz_job(job_id):
+    """
+    Celery task running a queued quiz generation job
+    """
+    job = QuizGenerationJob.objects.select_related('user').get(id=job_id)
+    if job.status not in QuizGenerationJob.IN_FLIGHT:
+        return f"Job {job_id} already {job.status}"
+    
+    job.status = 'running'
+    job.save(update_fields=['status', 'updated_at'])
+    
+    try:
+        quiz = generate_quiz_questions(
+            document_id=job.document_id,
+            quiz_type=job.quiz_type,
+            questions_count=job.questions_count,
+            user=job.user,
+            difficulty=job.difficulty,
+            use_cache=not job.fresh,
+            # Stop calling the model once the job would be treated as lost
+            deadline=time.monotonic() + settings.QUIZ_JOB_STALE_SECONDS
+        )
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        return f"Job {job_id} failed: {e}"
+    
+    job.status = 'done'
+    job.quiz = quiz
+    job.save(update_fields=['status', 'quiz', 'updated_at'])
+    return f"Job {job_id} created quiz {quiz.id}"
+
 def create_quiz_prompt(content, quiz_type, questions_count, difficulty):
     """
     Create a detailed prompt for quiz generation
@@ -46,7 +141,7 @@ def create_quiz_prompt(content, quiz_type, questions_count, difficulty):
     based on the following educational content from a Physics textbook. Difficulty level: {difficulty}.
     
     CONTENT:
-    {content[:8000]}  # Limit content length
+    {content}
     
     REQUIREMENTS:
     """
@@ -127,31 +222,13 @@ def create_quiz_prompt(content, quiz_type, questions_count, difficulty):
     
     return base_prompt + "\n\n" + output_format + "\n\nIMPORTANT: Return ONLY JSON, no other text."
 
-def parse_quiz_response(response_text, quiz_type):
+def parse_quiz_response(response_text, quiz_type, record=True):
     """
-    Parse Gemini response and extract quiz data
+    Parse Gemini response and extract quiz data: the outermost JSON object
+    is repaired if needed and only questions matching the quiz type's schema
+    are kept (see quizzes.parsing)
     """
-    try:
-        # Clean response text
-        cleaned_text = response_text.strip()
-        if '```json' in cleaned_text:
-            cleaned_text = cleaned_text.split('```json')[1].split('```')[0]
-        elif '```' in cleaned_text:
-            cleaned_text = cleaned_text.split('```')[1]
-        
-        # Parse JSON
-        quiz_data = json.loads(cleaned_text)
-        
-        # Validate structure
-        if 'questions' not in quiz_data or not isinstance(quiz_data['questions'], list):
-            raise ValueError("Invalid response format: missing questions array")
-        
-        return quiz_data
-        
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse JSON response: {str(e)}")
-    except Exception as e:
-        raise ValueError(f"Error parsing quiz response: {str(e)}")
+    return parse_quiz_reply(response_text, quiz_type, record=record)
 
 def create_quiz_from_data(quiz_data, document, quiz_type, questions_count, difficulty):
     """
@@ -161,35 +238,98 @@ def create_quiz_from_data(quiz_data, document, quiz_type, questions_count, diffi
     quiz = Quiz.objects.create(
         document=document,
         quiz_type=quiz_type,
-        title=f"{quiz_type.upper()} Quiz - {document.title} - {difficulty.title()}",
+        title=quiz_title(document, quiz_type, difficulty),
         questions_count=len(quiz_data['questions']),
         difficulty=difficulty
     )
     
     # Create questions
-    for idx, q_data in enumerate(quiz_data['questions']):
-        question = Question(
-            quiz=quiz,
-            question_text=q_data.get('question_text', ''),
-            question_type=quiz_type,
-            topic=q_data.get('topic', 'General')
-        )
-        
-        if quiz_type == 'mcq':
-            question.option_a = q_data.get('option_a', '')
-            question.option_b = q_data.get('option_b', '')
-            question.option_c = q_data.get('option_c', '')
-            question.option_d = q_data.get('option_d', '')
-            question.correct_answer = q_data.get('correct_answer', '').lower()
-            question.explanation = q_data.get('explanation', '')
-        else:  # saq or laq
-            question.expected_answer = q_data.get('expected_answer', '')
-            question.explanation = q_data.get('explanation', '')
-        
-        question.save()
+    for q_data in quiz_data['questions']:
+        build_question(quiz, quiz_type, q_data).save()
     
     return quiz
 
+def quiz_title(document, quiz_type, difficulty):
+    return f"{quiz_type.upper()} Quiz - {document.title} - {difficulty.title()}"
+
+def build_question(quiz, quiz_type, q_data):
+    """
+    Unsaved Question of quiz from one parsed question object
+    """
+    question = Question(
+        quiz=quiz,
+        question_text=q_data.get('question_text', ''),
+        question_type=quiz_type,
+        topic=q_data.get('topic', 'General')
+    )
+    
+    if quiz_type == 'mcq':
+        question.option_a = q_data.get('option_a', '')
+        question.option_b = q_data.get('option_b', '')
+        question.option_c = q_data.get('option_c', '')
+        question.option_d = q_data.get('option_d', '')
+        question.correct_answer = q_data.get('correct_answer', '').lower()
+        question.explanation = q_data.get('explanation', '')
+    else:  # saq or laq
+        question.expected_answer = q_data.get('expected_answer', '')
+        question.explanation = q_data.get('explanation', '')
+    
+    return question
+
+def stream_quiz_questions(document, quiz_type, questions_count, difficulty='medium', use_cache=True, deadline=None):
+    """
+    Generate a quiz from the model's streamed reply, saving each question as
+    soon as its JSON object is complete. Yields ('quiz', quiz) once the quiz
+    row exists, ('question', question) per saved question and finally
+    ('done', quiz). Closing the generator early keeps the questions saved so
+    far; a quiz that got none is deleted.
+    """
+    content = select_context(document)
+    prompt = create_quiz_prompt(content, quiz_type, questions_count, difficulty)
+    
+    quiz = Quiz.objects.create(
+        document=document,
+        quiz_type=quiz_type,
+        title=quiz_title(document, quiz_type, difficulty),
+        questions_count=0,
+        difficulty=difficulty
+    )
+    
+    parser = QuestionStreamParser()
+    saved = dropped = 0
+    chunks = generate_stream(
+        prompt, parse=lambda text: parse_quiz_response(text, quiz_type, record=False), use_cache=use_cache,
+        deadline=deadline, cache_if=complete_reply
+    )
+    try:
+        # Inside the try, so a client gone after the first event leaves no empty quiz behind
+        yield 'quiz', quiz
+        for chunk in chunks:
+            for q_data in parser.feed(chunk):
+                q_data = validate_question(q_data, quiz_type)
+                if q_data is None:
+                    dropped += 1
+                    continue
+                # Read the reply to the end (so it gets cached) but ignore extra questions
+                if saved >= questions_count:
+                    continue
+                question = build_question(quiz, quiz_type, q_data)
+                question.save()
+                saved += 1
+                yield 'question', question
+    finally:
+        chunks.close()
+        record_stream_result(saved, dropped)
+        if saved:
+            quiz.questions_count = saved
+            quiz.save(update_fields=['questions_count'])
+        else:
+            quiz.delete()
+    
+    if not saved:
+        raise ValueError("The model returned no questions")
+    yield 'done', quiz
+
 def evaluate_answer(question, user_answer):
     """
     Evaluate user's answer against correct answer
@@ -209,9 +349,10 @@ def evaluate_answer(question, user_answer):
     
     return is_correct, feedback
 
-def evaluate_text_answer(question, user_answer):
+def evaluate_text_answer(question, user_answer, deadline=None):
     """
-    Use Gemini to evaluate text answers for SAQ/LAQ
+    Use Gemini to evaluate text answers for SAQ/LAQ. is_correct is None
+    when the answer could not be evaluated.
     """
     try:
         prompt = f"""
@@ -237,16 +378,132 @@ def evaluate_text_answer(question, user_answer):
         - Clarity of explanation
         """
         
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        response = model.generate_content(prompt)
+        # Identical answers to the same question reuse the cached evaluation
+        evaluation = generate(prompt, parse=parse_evaluation_reply, deadline=deadline, cache_if=complete_reply)
         
-        # Parse evaluation
-        evaluation = json.loads(response.text.strip())
+        return evaluation['is_correct'], evaluation['feedback']
         
-        is_correct = evaluation.get('is_correct', False)
-        feedback = evaluation.get('feedback', 'Unable to evaluate answer.')
+    except LLMDeadlineExceeded:
+        return None, GRADING_TIMEOUT_FEEDBACK
+    except Exception as e:
+        return None, f"Evaluation failed: {str(e)}"
+
+def evaluate_text_answers_batch(pairs, deadline=None):
+    """
+    Evaluate several SAQ/LAQ (question, answer) pairs in one Gemini call.
+    Answers missing or malformed in the reply, or a reply that cannot be
+    parsed at all, are evaluated one by one instead.
+    """
+    items = "\n".join(
+        f"""
+        ID: {position}
+        QUESTION: {question.question_text}
+        EXPECTED ANSWER: {question.expected_answer}
+        STUDENT'S ANSWER: {user_answer}
+        """
+        for position, (question, user_answer) in enumerate(pairs)
+    )
+    prompt = f"""
+        Evaluate each student's answer below against the expected answer.
+        {items}
         
-        return is_correct, feedback
+        Provide evaluations in this exact JSON format, one entry per ID:
+        {{
+            "results": [
+                {{
+                    "id": 0,
+                    "is_correct": true/false,
+                    "feedback": "constructive feedback explaining what's good and what needs improvement",
+                    "score": 0-10
+                }}
+            ]
+        }}
         
-    except Exception as e:
-        return False, f"Evaluation failed: {str(e)}"
\ No newline at end of file
+        Consider:
+        - Key concepts covered
+        - Accuracy of information
+        - Completeness of answer
+        - Clarity of explanation
+        """
+    
+    try:
+        by_id = generate(
+            prompt, parse=parse_evaluation_batch_reply, deadline=deadline, cache_if=complete_reply
+        )['results']
+    except Exception:
+        by_id = {}
+    
+    results = []
+    for position, (question, user_answer) in enumerate(pairs):
+        result = by_id.get(position)
+        if result is None:
+            results.append(evaluate_text_answer(question, user_answer, deadline))
+        else:
+            results.append((result['is_correct'], result['feedback']))
+    return results
+
+def _grade_group(pairs, deadline):
+    try:
+        if len(pairs) == 1:
+            return [evaluate_text_answer(*pairs[0], deadline=deadline)]
+        return evaluate_text_answers_batch(pairs, deadline)
+    finally:
+        # Grading threads live outside the request cycle (the LLM cache uses the database)
+        close_old_connections()
+
+def grade_answers(pairs, batch=None):
+    """
+    Grade (question, answer) pairs, returning (is_correct, feedback) in the
+    same order. MCQs are graded locally; SAQ/LAQ answers go to Gemini
+    concurrently, at most GRADING_CONCURRENCY calls at once, either one
+    answer per call or, with batch (default: GRADING_BATCH_SIZE > 1),
+    GRADING_BATCH_SIZE answers per call (DEFAULT_GRADING_BATCH_SIZE when
+    it is unset); batch=False always grades one answer per call. Answers
+    that could not be evaluated, because the call failed or took longer
+    than GRADING_TIMEOUT_SECONDS, get is_correct None.
+    """
+    results = [None] * len(pairs)
+    text_positions = []
+    for position, (question, user_answer) in enumerate(pairs):
+        if question.question_type == 'mcq':
+            results[position] = evaluate_answer(question, user_answer)
+        else:
+            text_positions.append(position)
+    
+    if not text_positions:
+        return results
+    
+    batch_size = settings.GRADING_BATCH_SIZE
+    if batch is False:
+        batch_size = 1
+    elif batch:
+        batch_size = batch_size or DEFAULT_GRADING_BATCH_SIZE
+    batch_size = max(batch_size, 1)
+    groups = [text_positions[i:i + batch_size] for i in range(0, len(text_positions), batch_size)]
+    
+    concurrency = min(settings.GRADING_CONCURRENCY, len(groups))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='grading')
+    started = time.monotonic()
+    # Groups beyond the first `concurrency` wait for a free thread first
+    deadlines = [
+        started + settings.GRADING_TIMEOUT_SECONDS * (index // concurrency + 1)
+        for index in range(len(groups))
+    ]
+    try:
+        futures = [
+            executor.submit(_grade_group, [pairs[position] for position in group], deadline)
+            for group, deadline in zip(groups, deadlines)
+        ]
+        for group, deadline, future in zip(groups, deadlines, futures):
+            try:
+                group_results = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FuturesTimeoutError:
+                group_results = [(None, GRADING_TIMEOUT_FEEDBACK)] * len(group)
+            except Exception as e:
+                group_results = [(None, f"Evaluation failed: {str(e)}")] * len(group)
+            for position, result in zip(group, group_results):
+                results[position] = result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return results
@@ -1,13 +1,181 @@
+import json
+import queue
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from django.db.models import Q, Count, Avg
-from .models import Quiz, Question, QuizAttempt, UserAnswer
+from documents.models import Document
+from documents.search_pool import BoundedExecutor, SearchPoolFull
+from documents.views import authenticate_request
+from .models import Quiz, Question, QuizAttempt, QuizGenerationJob, UserAnswer
 from .serializers import (
     QuizSerializer, QuestionSerializer, QuizAttemptSerializer,
-    QuizGenerateSerializer, QuizSubmitSerializer
+    QuizGenerateSerializer, QuizGenerationJobSerializer, QuizSubmitSerializer
 )
-from .utils import generate_quiz_questions, evaluate_answer
+from .llm import get_cache_stats
+from .llm_client import get_llm_client_stats
+from .parsing import get_parse_stats
+from .utils import grade_answers, start_quiz_generation, stream_quiz_questions
+
+KEEP_ALIVE_MESSAGE = ": keep-alive\n\n"
+
+_stream_pool = None
+_stream_pool_lock = threading.Lock()
+
+def _question_id(answer_data):
+    try:
+        return int(answer_data.get('question_id'))
+    except (TypeError, ValueError):
+        return None
+
+def get_stream_pool():
+    """
+    Return the process-wide pool running streamed quiz generations
+    """
+    global _stream_pool
+    if _stream_pool is None:
+        with _stream_pool_lock:
+            if _stream_pool is None:
+                _stream_pool = BoundedExecutor(settings.QUIZ_STREAM_WORKERS, settings.QUIZ_STREAM_QUEUE_DEPTH)
+    return _stream_pool
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _produce_quiz_events(send, stop, document, params):
+    """
+    Run on the stream pool: generate the quiz and send each event as an SSE
+    message, then None. Stops after the current question once stop is set
+    (the client went away).
+    """
+    events = stream_quiz_questions(
+        document,
+        quiz_type=params['quiz_type'],
+        questions_count=params['questions_count'],
+        difficulty=params['difficulty'],
+        use_cache=not params['fresh'],
+        deadline=time.monotonic() + settings.QUIZ_JOB_STALE_SECONDS
+    )
+    try:
+        for kind, obj in events:
+            if stop.is_set():
+                break
+            if kind == 'question':
+                send(_sse('question', QuestionSerializer(obj).data))
+            else:
+                send(_sse(kind, QuizSerializer(obj).data))
+    except Exception as e:
+        send(_sse('error', {'error': f"Error generating quiz: {str(e)}"}))
+    finally:
+        events.close()
+        send(None)
+
+def _relay_messages(messages, stop):
+    """
+    Yield the producer's SSE messages until its final None, with a
+    keep-alive comment after QUIZ_STREAM_KEEPALIVE_SECONDS of silence so
+    proxies keep the connection open while the model thinks
+    """
+    try:
+        while True:
+            try:
+                message = messages.get(timeout=settings.QUIZ_STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield KEEP_ALIVE_MESSAGE
+                continue
+            if message is None:
+                return
+            yield message
+    finally:
+        # Closed early when the client goes away
+        stop.set()
+
+async def _relay_messages_async(messages, stop):
+    """
+    _relay_messages for ASGI: the blocking wait runs on a worker thread
+    """
+    get = sync_to_async(messages.get, thread_sensitive=False)
+    try:
+        while True:
+            try:
+                message = await get(timeout=settings.QUIZ_STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield KEEP_ALIVE_MESSAGE
+                continue
+            if message is None:
+                return
+            yield message
+    finally:
+        stop.set()
+
+@csrf_exempt
+async def generate_quiz_stream(request):
+    """
+    Generate a quiz as Server-Sent Events: 'quiz' once it is created, one
+    'question' per question as soon as the model has written it (each is
+    already saved), then 'done' with the whole quiz, or 'error'. Takes the
+    same body as the generate action; generation runs on a bounded pool, so
+    saturation returns 503.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Method not allowed"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    try:
+        user = await sync_to_async(authenticate_request)(request)
+    except APIException as e:
+        return JsonResponse({"error": str(e.detail)}, status=e.status_code)
+    if not user or not user.is_authenticated:
+        return JsonResponse(
+            {"error": "Authentication credentials were not provided."},
+            status=status.HTTP_403_FORBIDDEN
+        )
+    
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = QuizGenerateSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    params = serializer.validated_data
+    
+    document = await Document.objects.filter(id=params['document_id'], user=user).afirst()
+    if document is None:
+        return JsonResponse({'error': 'Document not found'}, status=status.HTTP_404_NOT_FOUND)
+    if not document.processed:
+        return JsonResponse({'error': 'Document is not processed yet'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    messages = queue.Queue()
+    stop = threading.Event()
+    try:
+        get_stream_pool().submit(_produce_quiz_events, messages.put, stop, document, params)
+    except SearchPoolFull:
+        response = JsonResponse(
+            {"error": "Quiz generation is busy, please retry shortly"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        response['Retry-After'] = '1'
+        return response
+    
+    # Django buffers a sync iterator whole under ASGI and cannot stream an
+    # async one under WSGI, so relay with whichever the server streams
+    if isinstance(request, ASGIRequest):
+        stream = _relay_messages_async(messages, stop)
+    else:
+        stream = _relay_messages(messages, stop)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 class QuizViewSet(viewsets.ModelViewSet):
     serializer_class = QuizSerializer
@@ -17,23 +185,62 @@ class QuizViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['post'])
     def generate(self, request):
+        """
+        Queue quiz generation and return the job to poll; an identical
+        request already in flight returns that job instead
+        """
         serializer = QuizGenerateSerializer(data=request.data)
         if serializer.is_valid():
-            try:
-                quiz = generate_quiz_questions(
-                    document_id=serializer.validated_data['document_id'],
-                    quiz_type=serializer.validated_data['quiz_type'],
-                    questions_count=serializer.validated_data['questions_count'],
-                    user=request.user,
-                    difficulty=serializer.validated_data['difficulty']
-                )
-                return Response(QuizSerializer(quiz).data)
-            except Exception as e:
+            document = Document.objects.filter(
+                id=serializer.validated_data['document_id'], user=request.user
+            ).first()
+            if document is None:
+                return Response({'error': 'Document not found'}, status=status.HTTP_404_NOT_FOUND)
+            if not document.processed:
                 return Response(
-                    {'error': str(e)},
+                    {'error': 'Document is not processed yet'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            
+            job, created = start_quiz_generation(
+                request.user,
+                document,
+                quiz_type=serializer.validated_data['quiz_type'],
+                questions_count=serializer.validated_data['questions_count'],
+                difficulty=serializer.validated_data['difficulty'],
+                fresh=serializer.validated_data['fresh']
+            )
+            data = QuizGenerationJobSerializer(job).data
+            data['coalesced'] = not created
+            return Response(data, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>\d+)')
+    def job(self, request, job_id=None):
+        """
+        Status of a generation job, with the quiz attached once done
+        """
+        job = QuizGenerationJob.objects.select_related('quiz__document').filter(
+            id=job_id, user=request.user
+        ).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(QuizGenerationJobSerializer(job).data)
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def metrics(self, request):
+        """
+        LLM response cache hit rate, model calls saved, this process's model
+        call, retry and rate limiting counters, reply parse failure rates and
+        streaming generation load
+        """
+        stream_pool = {'started': False} if _stream_pool is None else dict(_stream_pool.stats(), started=True)
+        return Response({
+            'llm_cache': get_cache_stats(),
+            'llm_client': get_llm_client_stats(),
+            'llm_parsing': get_parse_stats(),
+            'stream_pool': stream_pool,
+        })
 
 class QuizAttemptViewSet(viewsets.ModelViewSet):
     serializer_class = QuizAttemptSerializer
@@ -72,38 +279,39 @@ class QuizAttemptViewSet(viewsets.ModelViewSet):
             time_taken = serializer.validated_data['time_taken']
             
             try:
-                score = 0
+                # Grade every answer up front: MCQs locally, text answers concurrently
+                question_ids = [_question_id(answer_data) for answer_data in answers]
+                questions = Question.objects.filter(quiz=attempt.quiz).in_bulk(
+                    [question_id for question_id in question_ids if question_id is not None]
+                )
+                graded = [
+                    (questions[question_id], answer_data)
+                    for question_id, answer_data in zip(question_ids, answers)
+                    if question_id in questions
+                ]
+                results = grade_answers(
+                    [(question, answer_data.get('answer', '')) for question, answer_data in graded],
+                    batch=serializer.validated_data.get('batch')
+                )
                 
-                # Process each answer
-                for answer_data in answers:
-                    question_id = answer_data.get('question_id')
-                    user_answer = answer_data.get('answer', '')
-                    question_time = answer_data.get('time_taken', 0)
-                    
-                    try:
-                        question = Question.objects.get(id=question_id, quiz=attempt.quiz)
-                        
-                        # Evaluate answer
-                        is_correct, feedback = evaluate_answer(question, user_answer)
-                        
-                        if is_correct:
-                            score += 1
-                        
-                        # Save user answer
-                        UserAnswer.objects.create(
-                            attempt=attempt,
-                            question=question,
-                            user_answer=user_answer,
-                            is_correct=is_correct,
-                            feedback=feedback,
-                            time_taken=question_time
-                        )
-                        
-                    except Question.DoesNotExist:
-                        continue
+                score = sum(1 for is_correct, _ in results if is_correct)
+                # Answers the model could not evaluate count neither right nor wrong
+                ungraded = sum(1 for is_correct, _ in results if is_correct is None)
+                UserAnswer.objects.bulk_create([
+                    UserAnswer(
+                        attempt=attempt,
+                        question=question,
+                        user_answer=answer_data.get('answer', ''),
+                        is_correct=is_correct,
+                        feedback=feedback,
+                        time_taken=answer_data.get('time_taken', 0)
+                    )
+                    for (question, answer_data), (is_correct, feedback) in zip(graded, results)
+                ])
                 
                 # Update attempt
                 attempt.score = score
+                attempt.ungraded_questions = ungraded
                 attempt.time_taken = time_taken
                 attempt.user_answers = answers  # Store raw answers
                 attempt.save()
@@ -112,10 +320,12 @@ class QuizAttemptViewSet(viewsets.ModelViewSet):
                 from progress.utils import update_user_progress
                 update_user_progress(attempt)
                 
+                graded_questions = attempt.total_questions - ungraded
                 return Response({
                     'score': score,
                     'total_questions': attempt.total_questions,
-                    'percentage': round((score / attempt.total_questions) * 100, 2),
+                    'ungraded_questions': ungraded,
+                    'percentage': round((score / graded_questions) * 100, 2) if graded_questions > 0 else 0,
                     'attempt_id': attempt.id
                 })
                 
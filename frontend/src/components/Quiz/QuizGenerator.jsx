@@ -27,6 +27,7 @@ const QuizGenerator = ({ documents, onQuizGenerated }) => {
   const [difficulty, setDifficulty] = useState('medium')
   const [generating, setGenerating] = useState(false)
   const [error, setError] = useState('')
+  const [receivedCount, setReceivedCount] = useState(0)
 
   const handleGenerateQuiz = async () => {
     if (!selectedDocument) {
@@ -36,16 +37,32 @@ const QuizGenerator = ({ documents, onQuizGenerated }) => {
 
     setGenerating(true)
     setError('')
+    setReceivedCount(0)
 
     try {
-      const response = await quizAPI.generate({
+      // Questions arrive (already saved) one by one as the model writes them
+      let quiz = null
+      let streamError = ''
+      await quizAPI.generateStream({
         document_id: selectedDocument,
         quiz_type: quizType,
         questions_count: questionsCount,
         difficulty: difficulty,
+      }, (event, data) => {
+        if (event === 'question') {
+          setReceivedCount((count) => count + 1)
+        } else if (event === 'done') {
+          quiz = data
+        } else if (event === 'error') {
+          streamError = data.error
+        }
       })
       
-      onQuizGenerated(response.data)
+      if (!quiz) {
+        setError(streamError || 'Failed to generate quiz. Please try again.')
+        return
+      }
+      onQuizGenerated(quiz)
     } catch (error) {
       setError(error.response?.data?.error || 'Failed to generate quiz. Please try again.')
       console.error('Quiz generation error:', error)
@@ -139,7 +156,7 @@ const QuizGenerator = ({ documents, onQuizGenerated }) => {
             sx={{ height: '56px' }}
             startIcon={generating ? null : <QuizIcon />}
           >
-            {generating ? 'Generating...' : 'Generate'}
+            {generating ? `Generating... ${receivedCount}/${questionsCount}` : 'Generate'}
           </Button>
         </Grid>
         
@@ -18,6 +18,7 @@ import {
 import {
   CheckCircle as CorrectIcon,
   Cancel as IncorrectIcon,
+  HelpOutline as UngradedIcon,
   EmojiEvents as TrophyIcon,
   Replay as RetryIcon,
   Home as HomeIcon,
@@ -35,7 +36,7 @@ const QuizResults = ({ attempt, quiz, onRetake }) => {
     )
   }
 
-  const { score, total_questions, percentage, user_answers, time_taken } = attempt
+  const { score, total_questions, ungraded_questions, percentage, user_answers, time_taken } = attempt
   const correctAnswers = user_answers?.filter(answer => answer.is_correct).length || score
 
   const getPerformanceColor = (percentage) => {
@@ -106,6 +107,11 @@ const QuizResults = ({ attempt, quiz, onRetake }) => {
               <Typography variant="body2" color="textSecondary">
                 Correct Answers
               </Typography>
+              {ungraded_questions > 0 && (
+                <Typography variant="caption" color="warning.main">
+                  {ungraded_questions} not evaluated, left out of the score
+                </Typography>
+              )}
             </CardContent>
           </Card>
         </Grid>
@@ -182,7 +188,9 @@ const QuizResults = ({ attempt, quiz, onRetake }) => {
                 <ListItem alignItems="flex-start" sx={{ py: 2 }}>
                   <Box sx={{ display: 'flex', alignItems: 'flex-start', width: '100%' }}>
                     <Box sx={{ mr: 2, mt: 0.5 }}>
-                      {userAnswer.is_correct ? (
+                      {userAnswer.is_correct === null ? (
+                        <UngradedIcon color="warning" />
+                      ) : userAnswer.is_correct ? (
                         <CorrectIcon color="success" />
                       ) : (
                         <IncorrectIcon color="error" />
@@ -198,9 +206,9 @@ const QuizResults = ({ attempt, quiz, onRetake }) => {
                           label={`Your answer: ${userAnswer.user_answer}`}
                           variant="outlined"
                           size="small"
-                          color={userAnswer.is_correct ? 'success' : 'error'}
+                          color={userAnswer.is_correct === null ? 'warning' : userAnswer.is_correct ? 'success' : 'error'}
                         />
-                        {!userAnswer.is_correct && userAnswer.correct_answer && (
+                        {userAnswer.is_correct === false && userAnswer.correct_answer && (
                           <Chip
                             label={`Correct: ${userAnswer.correct_answer}`}
                             variant="outlined"
@@ -212,7 +220,7 @@ const QuizResults = ({ attempt, quiz, onRetake }) => {
                       
                       {userAnswer.feedback && (
                         <Alert 
-                          severity={userAnswer.is_correct ? "success" : "error"} 
+                          severity={userAnswer.is_correct === null ? "warning" : userAnswer.is_correct ? "success" : "error"} 
                           sx={{ mt: 1 }}
                           icon={false}
                         >
@@ -61,11 +61,60 @@ export const documentAPI = {
   reprocess: (id) => api.post(`/documents/${id}/reprocess/`),
 };
 
+// Read a Server-Sent Events response from a POST, calling onEvent(event, data)
+// for each message. Resolves when the stream ends.
+const postEventStream = async (url, body, onEvent) => {
+  const headers = { 'Content-Type': 'application/json' };
+  const token = localStorage.getItem('access_token');
+  if (token) {
+    headers.Authorization = `Bearer ${token}`;
+  }
+
+  const response = await fetch(`${API_BASE_URL}${url}`, {
+    method: 'POST',
+    headers,
+    body: JSON.stringify(body),
+    credentials: 'include',
+  });
+  if (!response.ok) {
+    const data = await response.json().catch(() => ({}));
+    const error = new Error(data.error || `Request failed with status ${response.status}`);
+    error.response = { status: response.status, data };
+    throw error;
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      const data = [];
+      for (const line of message.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data.push(line.slice(6));
+      }
+      // Comment-only messages are keep-alives
+      if (data.length) onEvent(event, JSON.parse(data.join('\n')));
+    }
+  }
+};
+
 // Quizzes API
 export const quizAPI = {
   getAll: () => api.get('/quizzes/quizzes/'),
   get: (id) => api.get(`/quizzes/quizzes/${id}/`),
   generate: (data) => api.post('/quizzes/quizzes/generate/', data),
+  getGenerationJob: (jobId) => api.get(`/quizzes/quizzes/jobs/${jobId}/`),
+  generateStream: (data, onEvent) =>
+    postEventStream('/quizzes/quizzes/generate/stream/', data, onEvent),
   createAttempt: (quizId) => api.post('/quizzes/attempts/', { quiz_id: quizId }),
   submitAttempt: (attemptId, data) => 
     api.post(`/quizzes/attempts/${attemptId}/submit/`, data),
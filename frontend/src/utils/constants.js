@@ -30,6 +30,8 @@ export const API_ENDPOINTS = {
   QUIZZES: {
     BASE: '/quizzes/quizzes/',
     GENERATE: '/quizzes/quizzes/generate/',
+    GENERATE_STREAM: '/quizzes/quizzes/generate/stream/',
+    JOB: '/quizzes/quizzes/jobs/{id}/',
     ATTEMPTS: '/quizzes/attempts/',
     STATS: '/quizzes/attempts/stats/',
   },